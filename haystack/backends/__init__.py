@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 import re
+import threading
 from copy import deepcopy
 from time import time
 from django.conf import settings
 from django.core import signals
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.base import ModelBase
 from django.utils import tree
 from django.utils.encoding import force_unicode
-from haystack.constants import VALID_FILTERS
+from haystack.constants import VALID_FILTERS, COMMIT_IMMEDIATE, COMMIT_BATCH, COMMIT_NONE, COMMIT_POLICIES
 from haystack.exceptions import SearchBackendError, MoreLikeThisError, FacetingError
+from haystack.query_cache import get_query_cache
 from haystack.query_utils import SQ, SearchNode
+from haystack.utils import get_identifier
 try:
     set
 except NameError:
@@ -22,6 +26,13 @@ VALID_GAPS = ['year', 'month', 'day', 'hour', 'minute', 'second']
 # A means to inspect all search queries that have run in the last request.
 queries = []
 
+# Backends handed out by ``BaseSearchBackend.shared``, keyed by class & site.
+_shared_backends = {}
+_shared_backends_lock = threading.Lock()
+
+# Per-thread, whether failed writes get logged rather than raised.
+_fail_silently = threading.local()
+
 
 # Per-request, reset the ghetto query log.
 # Probably not extraordinarily thread-safe but should only matter when
@@ -35,6 +46,37 @@ if settings.DEBUG:
     signals.request_started.connect(reset_search_queries)
 
 
+def get_commit_policy():
+    """Returns the ``HAYSTACK_COMMIT_POLICY``, checking it's a known one."""
+    policy = getattr(settings, 'HAYSTACK_COMMIT_POLICY', COMMIT_IMMEDIATE)
+    
+    if not policy in COMMIT_POLICIES:
+        raise ImproperlyConfigured("HAYSTACK_COMMIT_POLICY must be one of %s, not '%s'." % (', '.join(["'%s'" % name for name in COMMIT_POLICIES]), policy))
+    
+    return policy
+
+
+def get_fail_silently():
+    """
+    Whether backends that catch errors writing to the search engine (like
+    Solr being unreachable) should only log them, as they do by default.
+    """
+    return getattr(_fail_silently, 'value', True)
+
+
+def set_fail_silently(fail_silently):
+    """
+    Sets ``get_fail_silently`` for the current thread, returning the previous
+    value so it can be restored.
+    
+    Code that has to know whether its writes made it (like the update queue,
+    which only acknowledges entries once they've been applied) turns this off.
+    """
+    previous = get_fail_silently()
+    _fail_silently.value = fail_silently
+    return previous
+
+
 def log_query(func):
     """
     A decorator for pseudo-logging search queries. Used in the ``SearchBackend``
@@ -65,6 +107,10 @@ class BaseSearchBackend(object):
     RESERVED_WORDS = []
     RESERVED_CHARACTERS = []
     
+    # Whether several processes can write to the index at the same time (as
+    # ``update_index --workers`` does).
+    CONCURRENT_WRITERS = True
+    
     """
     Abstract search engine base class.
     """
@@ -75,7 +121,48 @@ class BaseSearchBackend(object):
             from haystack import site
             self.site = site
     
-    def update(self, index, iterable):
+    @classmethod
+    def shared(cls, site=None):
+        """
+        Returns the instance of this backend shared by everything using
+        ``site`` (the main site by default), creating it on first use.
+        
+        Setting up a backend can be costly (Whoosh builds its schema & opens
+        the index), so queries & indexes share one instead of each building
+        their own.
+        """
+        if site is None:
+            from haystack import site
+        
+        key = (cls, site)
+        
+        try:
+            return _shared_backends[key]
+        except KeyError:
+            pass
+        
+        _shared_backends_lock.acquire()
+        
+        try:
+            if not key in _shared_backends:
+                _shared_backends[key] = cls(site=site)
+            
+            return _shared_backends[key]
+        finally:
+            _shared_backends_lock.release()
+    
+    def cache_identity(self):
+        """
+        Returns what sets this backend's results apart from another's, so the
+        query cache (``HAYSTACK_QUERY_CACHE``) keeps them apart: the backend's
+        class and the models registered with its site (which limit the
+        results). Backends that connect to a search engine add where it is.
+        """
+        registered = ["%s.%s" % (model._meta.app_label, model._meta.module_name) for model in self.site.get_indexed_models()]
+        registered.sort()
+        return (type(self).__module__, type(self).__name__, tuple(registered))
+    
+    def update(self, index, iterable, commit=True):
         """
         Updates the backend when given a SearchIndex and a collection of
         documents.
@@ -85,7 +172,19 @@ class BaseSearchBackend(object):
         """
         raise NotImplementedError
     
-    def remove(self, obj_or_string):
+    def update_batches(self, index, batches, commit=True):
+        """
+        Updates the backend from an iterable of batches of objects (like
+        ``SearchIndex.get_batches``), as ``update_index`` does.
+        
+        By default, this calls ``update`` for each batch. Backends that can
+        fetch the next batch while the last one is still being written should
+        override it.
+        """
+        for batch in batches:
+            self.update(index, batch, commit=commit)
+    
+    def remove(self, obj_or_string, commit=True):
         """
         Removes a document/object from the backend. Can be either a model
         instance or the identifier (i.e. ``app_name.model_name.id``) in the
@@ -96,7 +195,19 @@ class BaseSearchBackend(object):
         """
         raise NotImplementedError
     
-    def clear(self, models=[]):
+    def remove_many(self, iterable, commit=True):
+        """
+        Removes a collection of documents/objects (instances or identifiers,
+        as with ``remove``) from the backend.
+        
+        By default, this calls ``remove`` for each one. Backends should
+        override it with something that removes them all in one go if they
+        can.
+        """
+        for obj_or_string in iterable:
+            self.remove(obj_or_string, commit=commit)
+    
+    def clear(self, models=[], commit=True):
         """
         Clears the backend of all documents/objects for a collection of models.
         
@@ -105,6 +216,59 @@ class BaseSearchBackend(object):
         """
         raise NotImplementedError
     
+    def commit(self):
+        """
+        Makes any changes written with ``commit=False`` visible to searches.
+        
+        Backends that commit every write regardless don't need to override
+        this.
+        """
+        pass
+    
+    def start_session(self):
+        """
+        Prepares for a long run of writes (like a whole ``update_index``),
+        which ends with ``end_session`` (or ``cancel_session`` on failure).
+        
+        Backends that can hold resources open across writes, rather than
+        setting up & committing each time, can override these.
+        """
+        pass
+    
+    def end_session(self):
+        """Finishes the writes started with ``start_session``."""
+        pass
+    
+    def cancel_session(self):
+        """Abandons the session started with ``start_session``."""
+        pass
+    
+    def should_commit(self, batch=False):
+        """
+        Returns the ``commit`` argument writes should use under the
+        ``HAYSTACK_COMMIT_POLICY``.
+        
+        Writes that are part of a ``batch`` don't commit under the ``'batch'``
+        policy, leaving it to ``commit_batch`` once they're all done.
+        """
+        policy = get_commit_policy()
+        
+        if policy == COMMIT_NONE:
+            return False
+        
+        if policy == COMMIT_BATCH:
+            return not batch
+        
+        return True
+    
+    def commit_batch(self):
+        """
+        Finishes a batch of writes made with ``should_commit(batch=True)``,
+        committing them if the policy is ``'batch'``.
+        """
+        if get_commit_policy() == COMMIT_BATCH:
+            self.commit()
+    
     @log_query
     def search(self, query_string, sort_by=None, start_offset=0, end_offset=None,
                fields='', highlight=False, facets=None, date_facets=None, query_facets=None,
@@ -125,6 +289,18 @@ class BaseSearchBackend(object):
         """
         raise NotImplementedError
     
+    def count(self, query_string, **kwargs):
+        """
+        Takes a query to search on and returns the number of matching results.
+        
+        Accepts the same arguments as ``search``. By default, this runs a
+        search that asks for no results. Backends should override it with
+        something that doesn't fetch or process any documents if they can.
+        """
+        kwargs['start_offset'] = 0
+        kwargs['end_offset'] = 0
+        return self.search(query_string, **kwargs).get('hits', 0)
+    
     def prep_value(self, value):
         """
         Hook to give the backend a chance to prep an attribute value before
@@ -202,6 +378,7 @@ class BaseSearchQuery(object):
         self.date_facets = {}
         self.query_facets = {}
         self.narrow_queries = set()
+        self.fields = []
         self._raw_query = None
         self._raw_query_params = {}
         self._more_like_this = False
@@ -210,7 +387,7 @@ class BaseSearchQuery(object):
         self._hit_count = None
         self._facet_counts = None
         self._spelling_suggestion = None
-        self.backend = backend or SearchBackend()
+        self.backend = backend or SearchBackend.shared()
     
     def __str__(self):
         return self.build_query()
@@ -234,7 +411,7 @@ class BaseSearchQuery(object):
         except ImportError:
             raise SearchBackendError("The backend this query was pickled with '%s.SearchBackend' could not be loaded." % backend_used)
         
-        self.backend = loaded_backend.SearchBackend()
+        self.backend = loaded_backend.SearchBackend.shared()
     
     def has_run(self):
         """Indicates if any query has been been run."""
@@ -273,6 +450,9 @@ class BaseSearchQuery(object):
         if self.boost:
             kwargs['boost'] = self.boost
         
+        if self.fields:
+            kwargs['fields'] = self.fields
+        
         return kwargs
     
     def run(self, spelling_query=None):
@@ -280,7 +460,7 @@ class BaseSearchQuery(object):
         final_query = self.build_query()
         kwargs = self.build_params(spelling_query=spelling_query)
         
-        results = self.backend.search(final_query, **kwargs)
+        results = self.run_backend(('search', final_query, kwargs), self.backend.search, final_query, **kwargs)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
         self._facet_counts = results.get('facets', {})
@@ -295,7 +475,8 @@ class BaseSearchQuery(object):
             raise MoreLikeThisError("No instance was provided to determine 'More Like This' results.")
         
         additional_query_string = self.build_query()
-        results = self.backend.more_like_this(self._mlt_instance, additional_query_string)
+        key = ('more_like_this', get_identifier(self._mlt_instance), additional_query_string)
+        results = self.run_backend(key, self.backend.more_like_this, self._mlt_instance, additional_query_string)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
     
@@ -304,28 +485,66 @@ class BaseSearchQuery(object):
         kwargs = self.build_params()
         kwargs.update(self._raw_query_params)
         
-        results = self.backend.search(self._raw_query, **kwargs)
+        results = self.run_backend(('search', self._raw_query, kwargs), self.backend.search, self._raw_query, **kwargs)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
         self._facet_counts = results.get('facets', {})
         self._spelling_suggestion = results.get('spelling_suggestion', None)
     
+    def run_count(self):
+        """
+        Executes the query, only asking the backend for the number of results.
+        
+        Cached (see ``HAYSTACK_QUERY_CACHE``) apart from the results, so the
+        count is shared by every page of the same query.
+        """
+        kwargs = {}
+        
+        if self.narrow_queries:
+            kwargs['narrow_queries'] = self.narrow_queries
+        
+        if self._raw_query:
+            # As in ``run_raw``, the raw params win.
+            final_query = self._raw_query
+            kwargs.update(self._raw_query_params)
+        else:
+            final_query = self.build_query()
+        
+        self._hit_count = self.run_backend(('count', final_query, kwargs), self.backend.count, final_query, **kwargs)
+    
+    def run_backend(self, key, method, *args, **kwargs):
+        """
+        Calls ``method`` on the backend, unless the query cache (see
+        ``HAYSTACK_QUERY_CACHE``) already has the results for ``key``, which
+        should identify the query & its params.
+        """
+        query_cache = get_query_cache()
+        
+        if query_cache is None:
+            return method(*args, **kwargs)
+        
+        cache_key = query_cache.make_key(self.backend, key, self.models)
+        results = query_cache.get(cache_key)
+        
+        if results is None:
+            results = method(*args, **kwargs)
+            query_cache.set(cache_key, results)
+        
+        return results
+    
     def get_count(self):
         """
         Returns the number of results the backend found for the query.
         
-        If the query has not been run, this will execute the query and store
-        the results.
+        If the query has not been run, this will only ask the backend for the
+        count (not the results) and store it.
         """
         if self._hit_count is None:
             if self._more_like_this:
                 # Special case for MLT.
                 self.run_mlt()
-            elif self._raw_query:
-                # Special case for raw queries.
-                self.run_raw()
             else:
-                self.run()
+                self.run_count()
         
         return self._hit_count
     
@@ -575,6 +794,15 @@ class BaseSearchQuery(object):
         """Adds a existing facet on a field."""
         self.narrow_queries.add(query)
     
+    def add_field(self, field):
+        """
+        Limits the stored fields fetched for each result. Once any are added,
+        only those fields (plus what's needed to build the ``SearchResult``)
+        are fetched.
+        """
+        if not field in self.fields:
+            self.fields.append(field)
+    
     def _reset(self):
         """
         Resets the instance's internal state to appear as though no query has
@@ -589,7 +817,7 @@ class BaseSearchQuery(object):
         if klass is None:
             klass = self.__class__
         
-        clone = klass()
+        clone = klass(backend=self.backend)
         clone.query_filter = deepcopy(self.query_filter)
         clone.order_by = self.order_by[:]
         clone.models = self.models.copy()
@@ -599,9 +827,9 @@ class BaseSearchQuery(object):
         clone.date_facets = self.date_facets.copy()
         clone.query_facets = self.query_facets.copy()
         clone.narrow_queries = self.narrow_queries.copy()
+        clone.fields = self.fields[:]
         clone.start_offset = self.start_offset
         clone.end_offset = self.end_offset
-        clone.backend = self.backend
         clone._raw_query = self._raw_query
         clone._raw_query_params = self._raw_query_params
         return clone
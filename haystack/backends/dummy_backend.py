@@ -29,13 +29,16 @@ class DummySearchResult(SearchResult):
 
 
 class SearchBackend(BaseSearchBackend):
-    def update(self, indexer, iterable):
+    def update(self, indexer, iterable, commit=True):
         pass
     
-    def remove(self, obj):
+    def remove(self, obj, commit=True):
         pass
     
-    def clear(self, models):
+    def remove_many(self, iterable, commit=True):
+        pass
+    
+    def clear(self, models=[], commit=True):
         pass
     
     @log_query
@@ -67,7 +70,7 @@ class SearchBackend(BaseSearchBackend):
 class SearchQuery(BaseSearchQuery):
     def __init__(self, backend=None):
         super(SearchQuery, self).__init__(backend=backend)
-        self.backend = backend or SearchBackend()
+        self.backend = backend or SearchBackend.shared()
     
     def build_query_fragment(self, field, filter_type, value):
         result = ''
@@ -5,17 +5,23 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models.loading import get_model
 from django.utils.encoding import force_unicode
-from haystack.backends import BaseSearchBackend, BaseSearchQuery, log_query
+from haystack.backends import BaseSearchBackend, BaseSearchQuery, log_query, get_commit_policy, get_fail_silently, set_fail_silently
+from haystack.constants import COMMIT_WITHIN, DEFAULT_BATCH_SIZE, DEFAULT_COMMIT_WITHIN
 from haystack.exceptions import MissingDependency, MoreLikeThisError
 from haystack.fields import DateField, DateTimeField, IntegerField, \
     FloatField, BooleanField, MultiValueField, MultiValueIntegerField, \
     SimpleCharField, PickleField
-from haystack.models import SearchResult
+from haystack.models import DeferredValue, SearchResult
 from haystack.utils import get_identifier
+from haystack.utils.pool import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SIZE, get_pool
 try:
     set
 except NameError:
     from sets import Set as set
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
 try:
     from django.db.models.sql.query import get_proxied_model
 except ImportError:
@@ -29,12 +35,93 @@ except ImportError:
 
 BACKEND_NAME = 'solr'
 
+# The fields every ``SearchResult`` is built from.
+REQUIRED_FIELDS = ['id', 'django_ct', 'django_id', 'score']
+
 
 class EmptyResults(object):
     hits = 0
     docs = []
 
 
+class SolrConnection(Solr):
+    """
+    A ``pysolr.Solr`` that can also ask Solr to commit within a number of
+    milliseconds, rather than straight away or not at all.
+    """
+    def add(self, docs, commit=True, commit_within=None):
+        if commit_within is None:
+            return super(SolrConnection, self).add(docs, commit=commit)
+        
+        # pysolr has no way to set ``commitWithin``, so build the message here.
+        message = ET.Element('add', commitWithin=str(commit_within))
+        
+        for doc in docs:
+            d = ET.SubElement(message, 'doc')
+            
+            for key, value in doc.items():
+                if not hasattr(value, '__iter__'):
+                    value = [value]
+                
+                for v in value:
+                    f = ET.SubElement(d, 'field', name=key)
+                    f.text = self._from_python(v)
+        
+        self._update(ET.tostring(message))
+    
+    def delete(self, id=None, q=None, commit=True, commit_within=None, **kwargs):
+        if commit_within is None:
+            return super(SolrConnection, self).delete(id=id, q=q, commit=commit, **kwargs)
+        
+        if id is None and q is None:
+            raise ValueError('You must specify "id" or "q".')
+        elif id is not None and q is not None:
+            raise ValueError('You many only specify "id" OR "q", not both.')
+        elif id is not None:
+            m = '<delete commitWithin="%d"><id>%s</id></delete>' % (commit_within, id)
+        else:
+            m = '<delete commitWithin="%d"><query>%s</query></delete>' % (commit_within, q)
+        
+        self._update(m)
+    
+    def delete_many(self, ids, commit=True, commit_within=None):
+        """Deletes the documents with the given ids in a single request."""
+        message = ET.Element('delete')
+        
+        if commit_within is not None:
+            message.set('commitWithin', str(commit_within))
+        
+        for id in ids:
+            ET.SubElement(message, 'id').text = id
+        
+        self._update(ET.tostring(message))
+        
+        if commit and commit_within is None:
+            self.commit()
+
+
+class PooledSolr(SolrConnection):
+    """
+    A ``pysolr.Solr`` that sends its requests over the shared keep-alive
+    connections of a ``ConnectionPool`` rather than a new connection each.
+    """
+    def __init__(self, url, pool=None, **kwargs):
+        super(PooledSolr, self).__init__(url, **kwargs)
+        
+        if pool is None:
+            pool = get_pool(url, timeout=self.timeout)
+        
+        self.pool = pool
+    
+    def _send_request(self, method, path, body=None, headers=None):
+        status, response_headers, response = self.pool.request(method, path, body, headers)
+        
+        if status != 200:
+            raise SolrError(self._extract_error(response_headers, response))
+        
+        return response
+
+
 class SearchBackend(BaseSearchBackend):
     # Word reserved by Solr for special use.
     RESERVED_WORDS = (
@@ -58,10 +145,81 @@ class SearchBackend(BaseSearchBackend):
             raise ImproperlyConfigured('You must specify a HAYSTACK_SOLR_URL in your settings.')
         
         timeout = getattr(settings, 'HAYSTACK_SOLR_TIMEOUT', 10)
-        self.conn = Solr(settings.HAYSTACK_SOLR_URL, timeout=timeout)
+        pool_size = getattr(settings, 'HAYSTACK_SOLR_POOL_SIZE', DEFAULT_MAX_SIZE)
+        
+        if pool_size:
+            pool = get_pool(settings.HAYSTACK_SOLR_URL, max_size=pool_size, timeout=timeout,
+                            idle_timeout=getattr(settings, 'HAYSTACK_SOLR_POOL_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT))
+            self.conn = PooledSolr(settings.HAYSTACK_SOLR_URL, pool=pool, timeout=timeout)
+        else:
+            self.conn = SolrConnection(settings.HAYSTACK_SOLR_URL, timeout=timeout)
         self.log = logging.getLogger('haystack')
     
+    def cache_identity(self):
+        return super(SearchBackend, self).cache_identity() + (self.conn.url,)
+    
     def update(self, index, iterable, commit=True):
+        docs = self._prepare_docs(index, iterable)
+        
+        if len(docs) > 0:
+            self._add_docs(docs, commit=commit)
+    
+    def update_batches(self, index, batches, commit=True):
+        """
+        With ``HAYSTACK_PIPELINE_PREPARE_WORKERS`` set, runs a single
+        ``IndexingPipeline`` over all of the batches, so the next batch is
+        fetched from the database while earlier ones are still being prepared
+        and sent to Solr.
+        """
+        prepare_workers = getattr(settings, 'HAYSTACK_PIPELINE_PREPARE_WORKERS', 0)
+        
+        if prepare_workers > 0:
+            objs = (obj for batch in batches for obj in batch)
+            return self.update_pipelined(index, objs, commit=commit, prepare_workers=prepare_workers)
+        
+        return super(SearchBackend, self).update_batches(index, batches, commit=commit)
+    
+    def update_pipelined(self, index, iterable, commit=True, prepare_workers=1):
+        """
+        Like ``update``, but fetches, prepares and sends the documents to Solr
+        at the same time, using an ``IndexingPipeline``. ``iterable`` is
+        consumed lazily, in the calling thread, so it can be a generator that
+        queries the database as it goes.
+        
+        Documents are sent without committing, followed by a single commit
+        once everything has been written. Chunks that fail to be written are
+        handled as ``update`` handles them: logged, or raised (stopping the
+        pipeline) if ``get_fail_silently`` is off.
+        """
+        from haystack.utils.pipeline import IndexingPipeline
+        written = []
+        fail_silently = get_fail_silently()
+        
+        # Under the ``'within'`` policy, each chunk carries its own deadline.
+        chunk_commit = commit and self._commit_within() is not None
+        
+        def write(docs):
+            # The writers have threads of their own, so they get the
+            # caller's setting passed on.
+            set_fail_silently(fail_silently)
+            self._add_docs(docs, commit=chunk_commit)
+            written.append(len(docs))
+        
+        pipeline = IndexingPipeline(
+            lambda objs: self._prepare_docs(index, objs),
+            write,
+            prepare_workers=prepare_workers,
+            write_workers=getattr(settings, 'HAYSTACK_PIPELINE_WRITE_WORKERS', 1),
+            chunk_size=getattr(settings, 'HAYSTACK_PIPELINE_CHUNK_SIZE', 100),
+            queue_size=getattr(settings, 'HAYSTACK_PIPELINE_QUEUE_SIZE', 4)
+        )
+        
+        pipeline.run(iterable)
+        
+        if commit and written and self._commit_within() is None:
+            self.commit()
+    
+    def _prepare_docs(self, index, iterable):
         docs = []
         
         try:
@@ -75,47 +233,112 @@ class SearchBackend(BaseSearchBackend):
         except UnicodeDecodeError:
             sys.stderr.write("Chunk failed.\n")
         
-        if len(docs) > 0:
-            try:
-                # Sometimes jetty returns BadStatusLine, so let's retry
-                for i in range(3):
-                    try:
-                        self.conn.add(docs, commit=commit)
-                        break
-                    except httplib.BadStatusLine:
-                        if i == 2:
-                            raise
-            except (IOError, SolrError), e:
-                self.log.error("Failed to add documents to Solr: %s", e)
+        return docs
+    
+    def _add_docs(self, docs, commit=True):
+        try:
+            # Sometimes jetty returns BadStatusLine, so let's retry
+            for i in range(3):
+                try:
+                    self.conn.add(docs, **self._commit_kwargs(commit))
+                    break
+                except httplib.BadStatusLine:
+                    if i == 2:
+                        raise
+        except (IOError, SolrError), e:
+            self.log.error("Failed to add %d documents ('%s' to '%s') to Solr: %s", len(docs), docs[0]['id'], docs[-1]['id'], e)
+            
+            if not get_fail_silently():
+                raise
+    
+    def _commit_within(self):
+        """
+        The milliseconds Solr is given to commit a write in, or ``None`` if
+        writes commit straight away.
+        """
+        if get_commit_policy() != COMMIT_WITHIN:
+            return None
+        
+        return int(getattr(settings, 'HAYSTACK_COMMIT_WITHIN', DEFAULT_COMMIT_WITHIN))
+    
+    def _commit_kwargs(self, commit):
+        """The commit arguments for a write to ``self.conn``."""
+        commit_within = self._commit_within()
+        
+        if commit and commit_within is not None:
+            return {'commit': False, 'commit_within': commit_within}
+        
+        return {'commit': commit}
+    
+    def commit(self):
+        try:
+            self.conn.commit()
+        except (IOError, SolrError), e:
+            self.log.error("Failed to commit documents to Solr: %s", e)
+            
+            if not get_fail_silently():
+                raise
     
     def remove(self, obj_or_string, commit=True):
         solr_id = get_identifier(obj_or_string)
         
         try:
-            self.conn.delete(id=solr_id, commit=commit)
+            self.conn.delete(id=solr_id, **self._commit_kwargs(commit))
         except (IOError, SolrError), e:
             self.log.error("Failed to remove document '%s' from Solr: %s", solr_id, e)
+            
+            if not get_fail_silently():
+                raise
+    
+    def remove_many(self, iterable, commit=True):
+        """
+        Removes the documents in as few requests as possible, up to
+        ``HAYSTACK_BATCH_SIZE`` ids apiece, committing once at the end.
+        """
+        solr_ids = [get_identifier(obj_or_string) for obj_or_string in iterable]
+        batch_size = getattr(settings, 'HAYSTACK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        commit_within = None
+        
+        if commit:
+            commit_within = self._commit_within()
+        
+        try:
+            for start in xrange(0, len(solr_ids), batch_size):
+                self.conn.delete_many(solr_ids[start:start + batch_size], commit=False, commit_within=commit_within)
+            
+            if solr_ids and commit and commit_within is None:
+                self.conn.commit()
+        except (IOError, SolrError), e:
+            self.log.error("Failed to remove %d documents from Solr: %s", len(solr_ids), e)
+            
+            if not get_fail_silently():
+                raise
     
     def clear(self, models=[], commit=True):
         try:
             if not models:
                 # *:* matches all docs in Solr
-                self.conn.delete(q='*:*', commit=commit)
+                self.conn.delete(q='*:*', **self._commit_kwargs(commit))
             else:
                 models_to_delete = []
                 
                 for model in models:
                     models_to_delete.append("django_ct:%s.%s" % (model._meta.app_label, model._meta.module_name))
                 
-                self.conn.delete(q=" OR ".join(models_to_delete), commit=commit)
+                self.conn.delete(q=" OR ".join(models_to_delete), **self._commit_kwargs(commit))
             
             # Run an optimize post-clear. http://wiki.apache.org/solr/FAQ#head-9aafb5d8dff5308e8ea4fcf4b71f19f029c4bb99
-            self.conn.optimize()
+            # Optimizing commits too, so it's skipped when we're not committing.
+            if commit and getattr(settings, 'HAYSTACK_SOLR_OPTIMIZE_AFTER_CLEAR', True):
+                self.conn.optimize()
         except (IOError, SolrError), e:
             if len(models):
                 self.log.error("Failed to clear Solr index of models '%s': %s", ','.join(models_to_delete), e)
             else:
                 self.log.error("Failed to clear Solr index: %s", e)
+            
+            if not get_fail_silently():
+                raise
     
     @log_query
     def search(self, query_string, sort_by=None, start_offset=0, end_offset=None,
@@ -133,6 +356,11 @@ class SearchBackend(BaseSearchBackend):
         }
         
         if fields:
+            if isinstance(fields, (list, tuple, set)):
+                # Whatever is needed to build the ``SearchResult`` is always
+                # fetched.
+                fields = ' '.join(REQUIRED_FIELDS + [field for field in fields if not field in REQUIRED_FIELDS])
+            
             kwargs['fl'] = fields
         
         if sort_by is not None:
@@ -201,6 +429,37 @@ class SearchBackend(BaseSearchBackend):
         
         return self._process_results(raw_results, highlight=highlight)
     
+    @log_query
+    def count(self, query_string, narrow_queries=None, limit_to_registered_models=True, **kwargs):
+        if len(query_string) == 0:
+            return 0
+        
+        # No rows, so Solr only has to count the matches.
+        kwargs = {
+            'fl': 'id',
+            'rows': 0,
+        }
+        
+        if limit_to_registered_models:
+            # Using narrow queries, limit the results to only models registered
+            # with the current site.
+            narrow_queries = set(narrow_queries or [])
+            registered_models = self.build_registered_models_list()
+            
+            if len(registered_models) > 0:
+                narrow_queries.add('django_ct:(%s)' % ' OR '.join(registered_models))
+        
+        if narrow_queries:
+            kwargs['fq'] = list(narrow_queries)
+        
+        try:
+            raw_results = self.conn.search(query_string, **kwargs)
+        except (IOError, SolrError), e:
+            self.log.error("Failed to count results from Solr using '%s': %s", query_string, e)
+            return 0
+        
+        return raw_results.hits
+    
     def more_like_this(self, model_instance, additional_query_string=None,
                        start_offset=0, end_offset=None,
                        limit_to_registered_models=True, **kwargs):
@@ -253,7 +512,7 @@ class SearchBackend(BaseSearchBackend):
     
     def _process_results(self, raw_results, highlight=False):
         from haystack import site
-        results = []
+        rows = []
         hits = raw_results.hits
         facets = {}
         spelling_suggestion = None
@@ -286,12 +545,14 @@ class SearchBackend(BaseSearchBackend):
             model = get_model(app_label, model_name)
             
             if model and model in indexed_models:
+                index = site.get_index(model)
+                
                 for key, value in raw_result.items():
-                    index = site.get_index(model)
                     string_key = str(key)
                     
                     if string_key in index.fields and hasattr(index.fields[string_key], 'convert'):
-                        additional_fields[string_key] = index.fields[string_key].convert(value)
+                        # Converted on first access, if at all.
+                        additional_fields[string_key] = DeferredValue(index.fields[string_key], value)
                     else:
                         additional_fields[string_key] = self.conn._to_python(value)
                 
@@ -302,13 +563,12 @@ class SearchBackend(BaseSearchBackend):
                 if raw_result['id'] in getattr(raw_results, 'highlighting', {}):
                     additional_fields['highlighted'] = raw_results.highlighting[raw_result['id']]
                 
-                result = SearchResult(app_label, model_name, raw_result['django_id'], raw_result['score'], **additional_fields)
-                results.append(result)
+                rows.append((app_label, model_name, raw_result['django_id'], raw_result['score'], additional_fields))
             else:
                 hits -= 1
         
         return {
-            'results': results,
+            'results': SearchResult.build_results(rows),
             'hits': hits,
             'facets': facets,
             'spelling_suggestion': spelling_suggestion,
@@ -369,7 +629,7 @@ class SearchBackend(BaseSearchBackend):
 class SearchQuery(BaseSearchQuery):
     def __init__(self, backend=None):
         super(SearchQuery, self).__init__(backend=backend)
-        self.backend = backend or SearchBackend()
+        self.backend = backend or SearchBackend.shared()
 
     def matching_all_fragment(self):
         return '*:*'
@@ -450,7 +710,10 @@ class SearchQuery(BaseSearchQuery):
         if spelling_query:
             kwargs['spelling_query'] = spelling_query
         
-        results = self.backend.search(final_query, **kwargs)
+        if self.fields:
+            kwargs['fields'] = self.fields
+        
+        results = self.run_backend(('search', final_query, kwargs), self.backend.search, final_query, **kwargs)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
         self._facet_counts = results.get('facets', {})
@@ -469,6 +732,7 @@ class SearchQuery(BaseSearchQuery):
         if self.end_offset is not None:
             kwargs['end_offset'] = self.end_offset - self.start_offset
         
-        results = self.backend.more_like_this(self._mlt_instance, additional_query_string, **kwargs)
+        key = ('more_like_this', get_identifier(self._mlt_instance), additional_query_string, kwargs)
+        results = self.run_backend(key, self.backend.more_like_this, self._mlt_instance, additional_query_string, **kwargs)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
@@ -1,6 +1,7 @@
 import os
 import re
 import shutil
+import threading
 import warnings
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -10,7 +11,7 @@ from django.utils.encoding import force_unicode
 from haystack.backends import BaseSearchBackend, BaseSearchQuery, log_query
 from haystack.fields import DateField, DateTimeField, IntegerField, FloatField, BooleanField, MultiValueField
 from haystack.exceptions import MissingDependency, SearchBackendError
-from haystack.models import SearchResult
+from haystack.models import DeferredValue, SearchResult
 from haystack.utils import get_identifier
 try:
     set
@@ -30,6 +31,7 @@ try:
     from whoosh import index
     from whoosh.qparser import QueryParser
     from whoosh.filedb.filestore import FileStorage
+    from whoosh.filedb.filewriting import NO_MERGE, MERGE_SMALL, OPTIMIZE
     from whoosh.spelling import SpellChecker
 except ImportError:
     raise MissingDependency("The 'whoosh' backend requires the installation of 'Whoosh'. Please refer to the documentation.")
@@ -42,6 +44,13 @@ if not hasattr(whoosh, '__version__') or whoosh.__version__ < (0, 3, 5):
 DATETIME_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(\.\d{3,6}Z?)?$')
 BACKEND_NAME = 'whoosh'
 
+# How segments get merged when a session commits. See ``HAYSTACK_WHOOSH_MERGE``.
+MERGE_POLICIES = {
+    'none': NO_MERGE,
+    'small': MERGE_SMALL,
+    'optimize': OPTIMIZE,
+}
+
 
 class SearchBackend(BaseSearchBackend):
     # Word reserved by Whoosh for special use.
@@ -59,13 +68,22 @@ class SearchBackend(BaseSearchBackend):
         '[', ']', '^', '"', '~', '*', '?', ':', '.',
     )
     
+    # Whoosh locks the index while a writer is open, so only one process can
+    # write at a time.
+    CONCURRENT_WRITERS = False
+    
     def __init__(self, site=None):
         super(SearchBackend, self).__init__(site)
         self.setup_complete = False
+        # Each thread's session writer, as the backend is shared.
+        self._session = threading.local()
         
         if not hasattr(settings, 'HAYSTACK_WHOOSH_PATH'):
             raise ImproperlyConfigured('You must specify a HAYSTACK_WHOOSH_PATH in your settings.')
     
+    def cache_identity(self):
+        return super(SearchBackend, self).cache_identity() + (settings.HAYSTACK_WHOOSH_PATH,)
+    
     def setup(self):
         """
         Defers loading until needed.
@@ -129,13 +147,111 @@ class SearchBackend(BaseSearchBackend):
         
         return (content_field_name, Schema(**schema_fields))
     
+    def start_session(self, postlimit=None):
+        """
+        Opens a single writer that ``update``, ``remove`` & ``remove_many``
+        use (in this thread) until ``end_session``, rather than each opening
+        and committing their own. Sessions nest, with only the outermost one
+        committing.
+        
+        ``postlimit`` is roughly how many bytes of postings the writer buffers
+        in memory before flushing them to disk, falling back to
+        ``HAYSTACK_WHOOSH_POST_LIMIT`` (or Whoosh's default of 32MB).
+        
+        Nothing written in a session is searchable until it ends. Like any
+        Whoosh writer, it holds the index's lock the whole time, and it only
+        replaces documents committed before it started.
+        """
+        if not self.setup_complete:
+            self.setup()
+        
+        depth = getattr(self._session, 'depth', 0)
+        
+        if depth == 0:
+            if postlimit is None:
+                postlimit = getattr(settings, 'HAYSTACK_WHOOSH_POST_LIMIT', None)
+            
+            writer_kwargs = {}
+            
+            if postlimit:
+                writer_kwargs['postlimit'] = postlimit
+            
+            self.index = self.index.refresh()
+            self._session.writer = self.index.writer(**writer_kwargs)
+        
+        self._session.depth = depth + 1
+    
+    def end_session(self, merge=None):
+        """
+        Commits the session's writes, merging segments according to
+        ``merge`` (``'none'``, ``'small'`` or ``'optimize'``, falling back
+        to ``HAYSTACK_WHOOSH_MERGE``, which defaults to ``'small'``).
+        """
+        depth = getattr(self._session, 'depth', 0)
+        
+        if depth == 0:
+            return
+        
+        self._session.depth = depth - 1
+        
+        if depth > 1:
+            return
+        
+        if merge is None:
+            merge = getattr(settings, 'HAYSTACK_WHOOSH_MERGE', 'small')
+        
+        if not merge in MERGE_POLICIES:
+            self.cancel_session()
+            raise ImproperlyConfigured("The Whoosh merge policy must be one of %s, not '%s'." % (', '.join(["'%s'" % name for name in sorted(MERGE_POLICIES)]), merge))
+        
+        writer = self._session.writer
+        self._session.writer = None
+        writer.commit(mergetype=MERGE_POLICIES[merge])
+        self.index = self.index.refresh()
+        self.update_spelling()
+    
+    def cancel_session(self):
+        """Throws away everything written in the session."""
+        writer = getattr(self._session, 'writer', None)
+        self._session.depth = 0
+        self._session.writer = None
+        
+        if writer is not None:
+            writer.cancel()
+    
+    def update_spelling(self):
+        # If spelling support is desired, add to the dictionary.
+        if getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False) is True:
+            sp = SpellChecker(self.storage)
+            sp.add_field(self.index, self.content_field_name)
+    
     def update(self, index, iterable, commit=True):
         if not self.setup_complete:
             self.setup()
         
+        writer = getattr(self._session, 'writer', None)
+        
+        if writer is not None:
+            self._write_docs(writer, index, iterable)
+            return
+        
         self.index = self.index.refresh()
         writer = self.index.writer()
         
+        try:
+            self._write_docs(writer, index, iterable)
+        except:
+            writer.cancel()
+            raise
+        
+        if len(iterable) > 0:
+            # For now, commit no matter what, as we run into locking issues otherwise.
+            writer.commit()
+            self.update_spelling()
+        else:
+            writer.cancel()
+    
+    def _write_docs(self, writer, index, iterable):
         for obj in iterable:
             doc = index.prepare(obj)
             
@@ -145,20 +261,17 @@ class SearchBackend(BaseSearchBackend):
                 doc[key] = self._from_python(doc[key])
             
             writer.update_document(**doc)
-        
-        if len(iterable) > 0:
-            # For now, commit no matter what, as we run into locking issues otherwise.
-            writer.commit()
-            
-            # If spelling support is desired, add to the dictionary.
-            if getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False) is True:
-                sp = SpellChecker(self.storage)
-                sp.add_field(self.index, self.content_field_name)
     
     def remove(self, obj_or_string, commit=True):
         if not self.setup_complete:
             self.setup()
         
+        writer = getattr(self._session, 'writer', None)
+        
+        if writer is not None:
+            writer.delete_by_term('id', unicode(get_identifier(obj_or_string)))
+            return
+        
         self.index = self.index.refresh()
         whoosh_id = get_identifier(obj_or_string)
         self.index.delete_by_query(q=self.parser.parse(u'id:"%s"' % whoosh_id))
@@ -166,6 +279,32 @@ class SearchBackend(BaseSearchBackend):
         # For now, commit no matter what, as we run into locking issues otherwise.
         self.index.commit()
     
+    def remove_many(self, iterable, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        
+        writer = getattr(self._session, 'writer', None)
+        
+        if writer is not None:
+            for obj_or_string in iterable:
+                writer.delete_by_term('id', unicode(get_identifier(obj_or_string)))
+            
+            return
+        
+        self.index = self.index.refresh()
+        # A single writer (and searcher) for the lot, rather than one apiece.
+        writer = self.index.writer()
+        
+        try:
+            for obj_or_string in iterable:
+                writer.delete_by_term('id', unicode(get_identifier(obj_or_string)))
+        except:
+            writer.cancel()
+            raise
+        
+        # For now, commit no matter what, as we run into locking issues otherwise.
+        writer.commit()
+    
     def clear(self, models=[], commit=True):
         if not self.setup_complete:
             self.setup()
@@ -239,7 +378,7 @@ class SearchBackend(BaseSearchBackend):
                 if order_by.startswith('-'):
                     reverse_counter += 1
             
-            if len(sort_by) > 1 and reverse_counter > 1:
+            if len(sort_by) > 1 and reverse_counter > 1 and reverse_counter < len(sort_by):
                 raise SearchBackendError("Whoosh does not handle more than one field and any field being ordered in reverse.")
             
             for order_by in sort_by:
@@ -253,8 +392,13 @@ class SearchBackend(BaseSearchBackend):
                     
                     if len(sort_by_list) == 1:
                         reverse = False
-                
-            sort_by = sort_by_list[0]
+            
+            if len(sort_by_list) > 1 and reverse_counter in (0, len(sort_by_list)):
+                # Every field goes the same way, so Whoosh can sort by all of
+                # them (like a field and then ``id`` to break ties).
+                sort_by = tuple(sort_by_list)
+            else:
+                sort_by = sort_by_list[0]
         
         if facets is not None:
             warnings.warn("Whoosh does not handle faceting.", Warning, stacklevel=2)
@@ -267,17 +411,7 @@ class SearchBackend(BaseSearchBackend):
         
         narrowed_results = None
         self.index = self.index.refresh()
-        
-        if limit_to_registered_models:
-            # Using narrow queries, limit the results to only models registered
-            # with the current site.
-            if narrow_queries is None:
-                narrow_queries = set()
-            
-            registered_models = self.build_registered_models_list()
-            
-            if len(registered_models) > 0:
-                narrow_queries.add('django_ct:(%s)' % ' OR '.join(registered_models))
+        narrow_queries = self.build_narrow_queries(narrow_queries, limit_to_registered_models)
         
         if narrow_queries is not None:
             # Potentially expensive? I don't see another way to do it in Whoosh...
@@ -310,7 +444,7 @@ class SearchBackend(BaseSearchBackend):
             if narrowed_results:
                 raw_results.filter(narrowed_results)
             
-            return self._process_results(raw_results, start_offset, end_offset, highlight=highlight, query_string=query_string, spelling_query=spelling_query)
+            return self._process_results(raw_results, start_offset, end_offset, highlight=highlight, query_string=query_string, spelling_query=spelling_query, fields=fields)
         else:
             if getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False):
                 if spelling_query:
@@ -326,6 +460,61 @@ class SearchBackend(BaseSearchBackend):
                 'spelling_suggestion': spelling_suggestion,
             }
     
+    @log_query
+    def count(self, query_string, narrow_queries=None, limit_to_registered_models=True, **kwargs):
+        if not self.setup_complete:
+            self.setup()
+        
+        query_string = force_unicode(query_string)
+        
+        # Same as ``search``, empty & one-character queries find nothing.
+        if len(query_string) == 0 or (len(query_string) <= 1 and query_string != u'*'):
+            return 0
+        
+        self.index = self.index.refresh()
+        
+        if not self.index.doc_count():
+            return 0
+        
+        parsed_query = self.parser.parse(query_string)
+        
+        if parsed_query is None:
+            return 0
+        
+        searcher = self.index.searcher()
+        
+        try:
+            # Only collect the matching document numbers. Nothing gets scored,
+            # sorted or loaded.
+            docs = set(parsed_query.docs(searcher))
+            
+            for nq in self.build_narrow_queries(narrow_queries, limit_to_registered_models) or []:
+                if not docs:
+                    break
+                
+                docs.intersection_update(self.parser.parse(force_unicode(nq)).docs(searcher))
+        finally:
+            searcher.close()
+        
+        return len(docs)
+    
+    def build_narrow_queries(self, narrow_queries=None, limit_to_registered_models=True):
+        """
+        Adds a narrow query limiting the results to the models registered with
+        the current site (unless told not to) to ``narrow_queries``.
+        """
+        if limit_to_registered_models:
+            # Using narrow queries, limit the results to only models registered
+            # with the current site.
+            # Copy, so the query's own narrow queries are left alone.
+            narrow_queries = set(narrow_queries or [])
+            registered_models = self.build_registered_models_list()
+            
+            if len(registered_models) > 0:
+                narrow_queries.add('django_ct:(%s)' % ' OR '.join(registered_models))
+        
+        return narrow_queries
+    
     def more_like_this(self, model_instance, additional_query_string=None):
         warnings.warn("Whoosh does not handle More Like This.", Warning, stacklevel=2)
         return {
@@ -333,9 +522,16 @@ class SearchBackend(BaseSearchBackend):
             'hits': 0,
         }
     
-    def _process_results(self, raw_results, start_offset, end_offset, highlight=False, query_string='', spelling_query=None):
+    def _process_results(self, raw_results, start_offset, end_offset, highlight=False, query_string='', spelling_query=None, fields=None):
         from haystack import site
-        results = []
+        rows = []
+        wanted_fields = None
+        
+        if fields:
+            # Whoosh hands back every stored field regardless, but only the
+            # ones asked for (plus what builds the ``SearchResult``) get
+            # converted.
+            wanted_fields = set(fields) | set(['id', 'django_ct', 'django_id'])
         
         # It's important to grab the hits first before slicing. Otherwise, this
         # can cause pagination failures.
@@ -353,16 +549,21 @@ class SearchBackend(BaseSearchBackend):
             model = get_model(app_label, model_name)
             
             if model and model in indexed_models:
+                index = site.get_index(model)
+                
                 for key, value in raw_result.items():
-                    index = site.get_index(model)
                     string_key = str(key)
                     
+                    if wanted_fields is not None and not string_key in wanted_fields:
+                        continue
+                    
                     if string_key in index.fields and hasattr(index.fields[string_key], 'convert'):
                         # Special-cased due to the nature of KEYWORD fields.
                         if isinstance(index.fields[string_key], MultiValueField):
                             additional_fields[string_key] = value.split(',')
                         else:
-                            additional_fields[string_key] = index.fields[string_key].convert(value)
+                            # Converted on first access, if at all.
+                            additional_fields[string_key] = DeferredValue(index.fields[string_key], value)
                     else:
                         additional_fields[string_key] = self._to_python(value)
                 
@@ -376,7 +577,7 @@ class SearchBackend(BaseSearchBackend):
                     terms = [term.replace('*', '') for term in query_string.split()]
                     
                     additional_fields['highlighted'] = {
-                        self.content_field_name: [highlight(additional_fields.get(self.content_field_name), terms, sa, ContextFragmenter(terms), UppercaseFormatter())],
+                        self.content_field_name: [highlight(raw_result.get(self.content_field_name), terms, sa, ContextFragmenter(terms), UppercaseFormatter())],
                     }
                 
                 if hasattr(raw_results, 'score'):
@@ -387,8 +588,7 @@ class SearchBackend(BaseSearchBackend):
                 if score is None:
                     score = 0
                 
-                result = SearchResult(app_label, model_name, raw_result['django_id'], score, **additional_fields)
-                results.append(result)
+                rows.append((app_label, model_name, raw_result['django_id'], score, additional_fields))
             else:
                 hits -= 1
         
@@ -399,7 +599,7 @@ class SearchBackend(BaseSearchBackend):
                 spelling_suggestion = self.create_spelling_suggestion(query_string)
         
         return {
-            'results': results,
+            'results': SearchResult.build_results(rows),
             'hits': hits,
             'facets': facets,
             'spelling_suggestion': spelling_suggestion,
@@ -495,7 +695,7 @@ class SearchBackend(BaseSearchBackend):
 class SearchQuery(BaseSearchQuery):
     def __init__(self, backend=None):
         super(SearchQuery, self).__init__(backend=backend)
-        self.backend = backend or SearchBackend()
+        self.backend = backend or SearchBackend.shared()
     
     
     def build_query_fragment(self, field, filter_type, value):
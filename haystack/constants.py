@@ -8,8 +8,26 @@ FILTER_SEPARATOR = '__'
 # The maximum number of items to display in a SearchQuerySet.__repr__
 REPR_OUTPUT_SIZE = 20
 
+# Number of objects to load from the database at a time when indexing.
+DEFAULT_BATCH_SIZE = 1000
+
 # Number of SearchResults to load at a time.
 ITERATOR_LOAD_PER_QUERY = 10
 
+# The most SearchResults to load at a time while iterating. The number loaded
+# doubles with each query until it reaches this.
+ITERATOR_MAX_LOAD_PER_QUERY = 1000
+
 # Separator that is used to store denormalized data
 DOTATTR_SEPARATOR = '0_0_0'
+
+# When writes to the index get committed. See ``HAYSTACK_COMMIT_POLICY``.
+COMMIT_IMMEDIATE = 'immediate'
+COMMIT_WITHIN = 'within'
+COMMIT_BATCH = 'batch'
+COMMIT_NONE = 'none'
+COMMIT_POLICIES = (COMMIT_IMMEDIATE, COMMIT_WITHIN, COMMIT_BATCH, COMMIT_NONE)
+
+# Milliseconds the search engine may wait before committing, under the
+# ``'within'`` policy.
+DEFAULT_COMMIT_WITHIN = 1000
@@ -1,12 +1,14 @@
 import re
-import cPickle as pickle
-import base64
 
+from django.conf import settings
+from django.core.signals import request_started
 from django.utils import datetime_safe
+from django.utils.encoding import force_unicode
 from django.template import loader, Context
 
 from haystack.exceptions import SearchFieldError
 from haystack.utils import check_attr
+from haystack.utils import serialization
 
 
 class NOT_PROVIDED:
@@ -16,23 +18,78 @@ class NOT_PROVIDED:
 DATETIME_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})(T|\s+)(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2}).*?$')
 
 
+# Compiled templates for ``use_template`` fields, keyed by template name.
+_template_cache = {}
+
+
+def get_template(template_name):
+    """
+    Returns the compiled template, loading (and caching) it on first use.
+    """
+    try:
+        return _template_cache[template_name]
+    except KeyError:
+        template = loader.get_template(template_name)
+        _template_cache[template_name] = template
+        return template
+
+
+def clear_template_cache(**kwargs):
+    """
+    Empties the template cache, so that edited templates get picked up.
+    """
+    _template_cache.clear()
+
+
+# Per-request, let changes to the templates show up during development.
+if settings.DEBUG:
+    request_started.connect(clear_template_cache)
+
+
+def accessor_probes(attr_name, separator='__'):
+    """
+    Returns the compound names ``check_attr`` probes for before settling on
+    the first piece of ``attr_name``. If an instance has none of them, it
+    resolves ``attr_name`` the same way as any other instance of its class.
+    """
+    pieces = attr_name.split(separator)
+    
+    if len(pieces) < 2:
+        return ()
+    
+    probes = [attr_name]
+    
+    for piece in pieces[1:]:
+        probe = separator.join([pieces[0], piece])
+        
+        if not probe in probes:
+            probes.append(probe)
+    
+    return tuple(probes)
+
+
 # All the SearchFields variants.
 
 class SearchField(object):
     """The base implementation of a search field."""
     def __init__(self, model_attr=None, use_template=False, template_name=None,
                  document=False, indexed=True, stored=True, default=NOT_PROVIDED,
-                 null=False):
+                 null=False, text_attrs=None):
         # Track what the index thinks this field is called.
         self.instance_name = None
         self.model_attr = model_attr
         self.use_template = use_template
         self.template_name = template_name
+        self.text_attrs = text_attrs
         self.document = document
         self.indexed = indexed
         self.stored = stored
         self._default = default
         self.null = null
+        # Resolved ``model_attr`` accessor chains, keyed by model class.
+        self._accessor_cache = {}
+        # Template names, keyed by model class.
+        self._template_names = {}
     
     def has_default(self):
         """Returns a boolean of whether this field has a default value."""
@@ -45,84 +102,156 @@ class SearchField(object):
             return self._default()
         
         return self._default
-
+    
     def prepare(self, obj):
         """
         Takes data from the provided object and prepares it for storage in the
         index.
         """
-        # Give priority to a template.
-        if self.use_template:
+        # Give priority to a plain list of attributes, then a template.
+        if self.text_attrs:
+            return self.prepare_text_attrs(obj)
+        elif self.use_template:
             return self.prepare_template(obj)
         elif self.model_attr is not None:
-            # Check for `__` in the field for looking through the
-            # relation.
-            attrs = self.model_attr.split('__')
-            current_object = obj
-
-            def _r():
-                raise SearchFieldError(
-                    "The model '%s' does not have a model_attr '%s'." % (
-                        repr(current_object), self.model_attr))
-
-            self._attr = ''
-            self._attr_for_check = self.model_attr
-            i = -1
-            while True:
-                i += 1
-
-                # If we have dynamically generated attribute, that has
-                # `__` in it's name, for example
-                # `model_insatance.some__dynamic__attr` we need to handle
-                # such case
-                def generate_attr_name():
-                    self._attr_for_check = re.sub(r'^%s(?:__)?' % self._attr, '', self._attr_for_check)
-
-                    # Proccess pidorasen exceptions
-                    if i == 0:
-                        try:
-                            return {
-                                'composition__firm__url': 'composition__firm',
-                            }[self._attr_for_check]
-                        except KeyError:
-                            pass
-
-                    return check_attr(current_object, self._attr_for_check)
-
-                self._attr = generate_attr_name()
-
-                if not self._attr and not self._attr_for_check:
-                    break
-                elif not self._attr:
-                    _r()
-                try:
-                    current_object = getattr(current_object, self._attr)
-                except AttributeError:
-                    _r()
-                # If we have `model_instance__some_callable__its_attr`
-                if callable(current_object):
-                    current_object = current_object()
-
-                if current_object is None:
-                    if self.has_default():
-                        current_object = self._default
-                        # Fall out of the loop, given any further attempts at
-                        # accesses will fail misreably.
-                        break
-                    elif self.null:
-                        current_object = None
-                        # Fall out of the loop, given any further attempts at
-                        # accesses will fail misreably.
-                        break
-                    else:
-                        raise SearchFieldError("The model '%s' has an empty model_attr '%s' and doesn't allow a default or null value." % (repr(current_object), attr))
-            return current_object
-
+            accessors = self._accessor_cache.get(type(obj))
+            
+            if accessors is not None:
+                value = self.resolve_cached_model_attr(obj, accessors)
+                
+                if value is not NOT_PROVIDED:
+                    return value
+            
+            return self.resolve_model_attr(obj)
+        
         if self.has_default():
             return self.default
         else:
             return None
     
+    def resolve_model_attr(self, obj):
+        """
+        Looks up ``model_attr`` on the object, following relations (and
+        dynamically added attributes with ``__`` in their names) as needed.
+        
+        When the lookup only goes through plain attributes, the chain of
+        accessors it took is cached for the object's class, so that later
+        objects of the same class skip the probing.
+        """
+        # Check for `__` in the field for looking through the
+        # relation.
+        current_object = obj
+        
+        def _r():
+            raise SearchFieldError(
+                "The model '%s' does not have a model_attr '%s'." % (
+                    repr(current_object), self.model_attr))
+        
+        # Kept local (rather than on ``self``) so that the same field can
+        # safely prepare several objects at once from different threads.
+        attr = ''
+        attr_for_check = self.model_attr
+        accessors = []
+        cacheable = True
+        i = -1
+        while True:
+            i += 1
+            
+            # If we have dynamically generated attribute, that has
+            # `__` in it's name, for example
+            # `model_insatance.some__dynamic__attr` we need to handle
+            # such case
+            attr_for_check = re.sub(r'^%s(?:__)?' % attr, '', attr_for_check)
+            attr = None
+            
+            # Proccess pidorasen exceptions
+            if i == 0:
+                attr = {
+                    'composition__firm__url': 'composition__firm',
+                }.get(attr_for_check)
+                probes = ()
+            
+            if attr is None:
+                attr = check_attr(current_object, attr_for_check)
+                probes = accessor_probes(attr_for_check)
+                
+                # Only plain (single piece) attributes resolve the same way
+                # for every instance of a class.
+                if attr and '__' in attr:
+                    cacheable = False
+            
+            if not attr and not attr_for_check:
+                break
+            elif not attr:
+                _r()
+            
+            accessors.append((attr, probes, type(current_object)))
+            
+            try:
+                current_object = getattr(current_object, attr)
+            except AttributeError:
+                _r()
+            # If we have `model_instance__some_callable__its_attr`
+            if callable(current_object):
+                current_object = current_object()
+            
+            if current_object is None:
+                # Don't cache a partial chain.
+                return self.empty_model_attr(obj)
+        
+        if cacheable:
+            self._accessor_cache[type(obj)] = tuple(accessors)
+        
+        return current_object
+    
+    def resolve_cached_model_attr(self, obj, accessors):
+        """
+        Follows a previously cached chain of accessors.
+        
+        Returns ``NOT_PROVIDED`` if the chain doesn't apply to this object
+        (a different class along the way or a dynamic ``__`` attribute on the
+        instance), in which case ``resolve_model_attr`` should be used.
+        """
+        current_object = obj
+        
+        for attr, probes, klass in accessors:
+            if type(current_object) is not klass:
+                return NOT_PROVIDED
+            
+            instance_dict = getattr(current_object, '__dict__', None)
+            
+            if instance_dict:
+                for probe in probes:
+                    if probe in instance_dict:
+                        return NOT_PROVIDED
+            
+            try:
+                current_object = getattr(current_object, attr)
+            except Exception:
+                # ``hasattr`` swallows these, so leave it to the slow path
+                # to report them the same way it always has.
+                return NOT_PROVIDED
+            
+            if callable(current_object):
+                current_object = current_object()
+            
+            if current_object is None:
+                return self.empty_model_attr(obj)
+        
+        return current_object
+    
+    def empty_model_attr(self, obj):
+        """
+        Handles a ``model_attr`` lookup that came up empty, falling back to
+        the default (or ``None`` when ``null=True``).
+        """
+        if self.has_default():
+            return self._default
+        elif self.null:
+            return None
+        else:
+            raise SearchFieldError("The model '%s' has an empty model_attr '%s' and doesn't allow a default or null value." % (repr(obj), self.model_attr))
+    
     def prepare_template(self, obj):
         """
         Flattens an object for indexing.
@@ -138,11 +267,46 @@ class SearchField(object):
         if self.template_name is not None:
             template_name = self.template_name
         else:
-            template_name = 'search/indexes/%s/%s_%s.txt' % (obj._meta.app_label, obj._meta.module_name, self.instance_name)
+            template_name = self._template_names.get(type(obj))
+            
+            if template_name is None:
+                template_name = 'search/indexes/%s/%s_%s.txt' % (obj._meta.app_label, obj._meta.module_name, self.instance_name)
+                self._template_names[type(obj)] = template_name
         
-        t = loader.get_template(template_name)
+        t = get_template(template_name)
         return t.render(Context({'object': obj}))
     
+    def prepare_text_attrs(self, obj):
+        """
+        Flattens an object for indexing without a template.
+        
+        Looks up each of the ``text_attrs`` (following relations with
+        ``__``), calling any callables, and joins the values that aren't
+        ``None`` with newlines. Much cheaper than rendering a template for a
+        plain list of attributes.
+        """
+        values = []
+        
+        for attr_name in self.text_attrs:
+            value = obj
+            
+            for attr in attr_name.split('__'):
+                try:
+                    value = getattr(value, attr)
+                except AttributeError:
+                    raise SearchFieldError("The model '%s' does not have a text_attr '%s'." % (repr(obj), attr_name))
+                
+                if callable(value):
+                    value = value()
+                
+                if value is None:
+                    break
+            
+            if value is not None:
+                values.append(force_unicode(value))
+        
+        return u'\n'.join(values)
+    
     def convert(self, value):
         """
         Handles conversion between the data found and the type of the field.
@@ -254,13 +418,42 @@ class SimpleCharField(CharField):
 
 
 class PickleField(SearchField):
+    """
+    Stores arbitrary Python data, serialized with a codec from
+    ``haystack.utils.serialization``.
+    
+    ``codec`` is one of ``'pickle'`` (the default), ``'json'`` or
+    ``'msgpack'``. Payloads of at least ``compress_threshold`` bytes get
+    compressed with zlib. Both default to the ``HAYSTACK_PICKLE_CODEC`` &
+    ``HAYSTACK_PICKLE_COMPRESS_THRESHOLD`` settings. Data stored with the
+    other codecs can be read back whatever the field is currently set to,
+    but pickled data only by fields using ``'pickle'``. The original
+    (untagged) base64-encoded pickles are only read back if
+    ``allow_legacy`` (or the ``HAYSTACK_PICKLE_ALLOW_LEGACY`` setting) is
+    ``True``.
+    """
+    def __init__(self, codec=None, compress_threshold=None, allow_legacy=None, **kwargs):
+        super(PickleField, self).__init__(**kwargs)
+        
+        if codec is None:
+            codec = getattr(settings, 'HAYSTACK_PICKLE_CODEC', 'pickle')
+        
+        if compress_threshold is None:
+            compress_threshold = getattr(settings, 'HAYSTACK_PICKLE_COMPRESS_THRESHOLD', None)
+        
+        if allow_legacy is None:
+            allow_legacy = getattr(settings, 'HAYSTACK_PICKLE_ALLOW_LEGACY', False)
+        
+        self.codec = serialization.get_codec(codec)
+        self.compress_threshold = compress_threshold
+        self.allow_legacy = allow_legacy
+    
     def prepare(self, obj):
         field_data = super(PickleField, self).prepare(obj)
-        return base64.b64encode(pickle.dumps(field_data))
-
+        return serialization.encode(field_data, self.codec, self.compress_threshold)
+    
     def convert(self, value):
         if value is None:
             return None
-        # Sometimes solr returns data that can not be unpickled, so we
-        # need base64 encode/decode
-        return pickle.loads(base64.b64decode(value))
+        
+        return serialization.decode(value, self.codec, self.allow_legacy)
@@ -1,13 +1,64 @@
-from django.db.models import signals
+import copy
+import threading
+from django.conf import settings
+from django.db.models import signals, ForeignKey
+from django.db.models.fields import FieldDoesNotExist
 from django.utils.encoding import force_unicode
 import haystack
+from haystack.constants import DEFAULT_BATCH_SIZE
 from haystack.fields import *
+from haystack.query_cache import invalidate_model
+from haystack import update_buffer
+from haystack import update_queue
 from haystack.utils import get_identifier
 
 
+class SearchFieldDict(dict):
+    """
+    Holds the ``fields`` of a ``SearchIndex``, counting the changes made to
+    it in ``version``. That lets ``prepare`` tell whether its plan is still
+    current without comparing the fields every time.
+    """
+    version = 0
+    
+    def __setitem__(self, key, value):
+        super(SearchFieldDict, self).__setitem__(key, value)
+        self.version += 1
+    
+    def __delitem__(self, key):
+        super(SearchFieldDict, self).__delitem__(key)
+        self.version += 1
+    
+    def clear(self):
+        super(SearchFieldDict, self).clear()
+        self.version += 1
+    
+    def pop(self, *args):
+        value = super(SearchFieldDict, self).pop(*args)
+        self.version += 1
+        return value
+    
+    def popitem(self):
+        item = super(SearchFieldDict, self).popitem()
+        self.version += 1
+        return item
+    
+    def setdefault(self, key, default=None):
+        value = super(SearchFieldDict, self).setdefault(key, default)
+        self.version += 1
+        return value
+    
+    def update(self, *args, **kwargs):
+        super(SearchFieldDict, self).update(*args, **kwargs)
+        self.version += 1
+    
+    def copy(self):
+        return SearchFieldDict(self)
+
+
 class DeclarativeMetaclass(type):
     def __new__(cls, name, bases, attrs):
-        attrs['fields'] = {}
+        attrs['fields'] = SearchFieldDict()
         
         # Inherit any fields from parent(s).
         try:
@@ -53,7 +104,7 @@ class SearchIndex(object):
     
     def __init__(self, model, backend=None):
         self.model = model
-        self.backend = backend or haystack.backend.SearchBackend()
+        self.backend = backend or haystack.backend.SearchBackend.shared()
         self.prepared_data = None
         content_fields = []
         
@@ -63,6 +114,73 @@ class SearchIndex(object):
         
         if not len(content_fields) == 1:
             raise SearchFieldError("An index must have one (and only one) SearchField with document=True.")
+        
+        self._setup_text_attrs(content_fields[0])
+        self._prepare_plan_fields = None
+        self._prepare_plan_version = None
+    
+    def _setup_text_attrs(self, content_field):
+        """
+        Lets ``Meta.text_attrs`` (a list of attribute names) build the
+        document field's text directly, skipping the template.
+        """
+        text_attrs = getattr(getattr(self, 'Meta', None), 'text_attrs', None)
+        
+        if not text_attrs:
+            return
+        
+        # The fields are shared by the class, so change a copy.
+        field = copy.copy(self.fields[content_field])
+        field.text_attrs = list(text_attrs)
+        self.fields = self.fields.copy()
+        self.fields[content_field] = field
+    
+    def _compile_prepare_plan(self):
+        """
+        Works out what ``prepare`` needs to do for each field.
+        
+        Builds the ordered list of ``(field_name, field.prepare)`` pairs, the
+        ``prepare_FOO`` overrides (run after all the fields, so they can see
+        the rest of the prepared data) and the ``null=True`` fields to drop
+        when empty. ``prepare`` calls this on first use and again whenever
+        ``fields`` gets replaced or changed (see ``SearchFieldDict``).
+        """
+        if not isinstance(self.fields, SearchFieldDict):
+            self.fields = SearchFieldDict(self.fields)
+        
+        prepare_plan = []
+        prepare_overrides = []
+        null_fields = []
+        fields = self.fields
+        version = fields.version
+        
+        for field_name, field in fields.items():
+            prepare_plan.append((field_name, field.prepare))
+            
+            if hasattr(self, "prepare_%s" % field_name):
+                prepare_overrides.append((field_name, getattr(self, "prepare_%s" % field_name)))
+            
+            if field.null is True:
+                null_fields.append(field_name)
+        
+        self._prepare_plan = prepare_plan
+        self._prepare_overrides = prepare_overrides
+        self._null_fields = null_fields
+        self._prepare_plan_version = version
+        # Set last, so other threads don't use a half-built plan.
+        self._prepare_plan_fields = fields
+    
+    def _get_prepared_data(self):
+        local = self.__dict__.setdefault('_local', threading.local())
+        return getattr(local, 'prepared_data', None)
+    
+    def _set_prepared_data(self, value):
+        local = self.__dict__.setdefault('_local', threading.local())
+        local.prepared_data = value
+    
+    # Kept per-thread, so that several threads (see
+    # ``haystack.utils.pipeline``) can prepare objects with the same index.
+    prepared_data = property(_get_prepared_data, _set_prepared_data)
     
     def _setup_save(self, model):
         """A hook for controlling what happens when the registered model is saved."""
@@ -85,34 +203,126 @@ class SearchIndex(object):
         Get the default QuerySet to index when doing a full update.
         
         Subclasses can override this method to avoid indexing certain objects.
+        
+        The related objects the fields' ``model_attr`` lookups go through are
+        fetched in the same query (see ``get_select_related``).
         """
-        return self.model._default_manager.all()
+        queryset = self.model._default_manager.all()
+        related = self.get_select_related()
+        
+        if related:
+            queryset = queryset.select_related(*related)
+        
+        return queryset
+    
+    def get_select_related(self):
+        """
+        Returns the relations (like ``['author', 'composition__firm']``) that
+        the fields' ``model_attr`` lookups follow, so they can be joined in
+        when fetching objects to index rather than loaded one object at a time.
+        
+        Only ``ForeignKey``/``OneToOneField`` hops are included; the path
+        stops at the first piece that isn't one. Subclasses can override this
+        to add to or trim the list (or return an empty list to disable it).
+        """
+        related = []
+        
+        attr_names = []
+        
+        for field_name, field in self.fields.items():
+            if field.text_attrs:
+                attr_names.extend(field.text_attrs)
+            elif field.model_attr and not field.use_template:
+                attr_names.append(field.model_attr)
+        
+        for attr_name in attr_names:
+            model = self.model
+            path = []
+            
+            for piece in attr_name.split('__'):
+                try:
+                    model_field = model._meta.get_field(piece)
+                except FieldDoesNotExist:
+                    break
+                
+                if not isinstance(model_field, ForeignKey):
+                    break
+                
+                path.append(piece)
+                model = model_field.rel.to
+            
+            if path and not '__'.join(path) in related:
+                related.append('__'.join(path))
+        
+        # Drop paths another one already covers.
+        return sorted([path for path in related if not [other for other in related if other.startswith(path + '__')]])
+    
+    def get_batches(self, queryset=None, batch_size=None):
+        """
+        Yields lists of objects from the ``QuerySet`` (``get_queryset`` by
+        default) in primary key order, ``batch_size`` at a time.
+        
+        Each batch seeks past the last primary key of the previous batch
+        (``pk__gt``) instead of using an ever-growing ``OFFSET``, so every
+        batch costs the same regardless of how deep into the table it is. No
+        up-front ``count()`` is needed either.
+        """
+        if queryset is None:
+            queryset = self.get_queryset()
+        
+        if batch_size is None:
+            batch_size = getattr(settings, 'HAYSTACK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        
+        queryset = queryset.order_by(self.model._meta.pk.name)
+        last_pk = None
+        
+        while True:
+            if last_pk is None:
+                batch_qs = queryset
+            else:
+                batch_qs = queryset.filter(pk__gt=last_pk)
+            
+            batch = list(batch_qs[:batch_size])
+            
+            if not batch:
+                break
+            
+            yield batch
+            
+            if len(batch) < batch_size:
+                break
+            
+            last_pk = batch[-1].pk
     
     def prepare(self, obj):
         """
         Fetches and adds/alters data before indexing.
         """
-        self.prepared_data = {
+        self.prepared_data = prepared_data = {
             'id': get_identifier(obj),
             'django_ct': "%s.%s" % (obj._meta.app_label, obj._meta.module_name),
             'django_id': force_unicode(obj.pk),
         }
         
-        for field_name, field in self.fields.items():
-            self.prepared_data[field_name] = field.prepare(obj)
+        # Fields added, removed or replaced since the plan was built
+        # invalidate it.
+        fields = self.fields
         
-        for field_name, field in self.fields.items():
-            if hasattr(self, "prepare_%s" % field_name):
-                value = getattr(self, "prepare_%s" % field_name)(obj)
-                self.prepared_data[field_name] = value
+        if fields is not self._prepare_plan_fields or fields.version != self._prepare_plan_version:
+            self._compile_prepare_plan()
+        
+        for field_name, prepare_field in self._prepare_plan:
+            prepared_data[field_name] = prepare_field(obj)
+        
+        for field_name, prepare_override in self._prepare_overrides:
+            prepared_data[field_name] = prepare_override(obj)
         
         # Remove any fields that lack a value and are `null=True`.
-        for field_name, field in self.fields.items():
-            if field.null is True:
-                if self.prepared_data[field_name] is None:
-                    del(self.prepared_data[field_name])
+        for field_name in self._null_fields:
+            if prepared_data[field_name] is None:
+                del(prepared_data[field_name])
         
-        return self.prepared_data
+        return prepared_data
     
     def get_content_field(self):
         """Returns the field that supplies the primary document to be indexed."""
@@ -122,7 +332,19 @@ class SearchIndex(object):
     
     def update(self):
         """Update the entire index"""
-        self.backend.update(self, self.get_queryset())
+        commit = self.backend.should_commit(batch=True)
+        self.backend.start_session()
+        
+        try:
+            for batch in self.get_batches():
+                self.backend.update(self, batch, commit=commit)
+        except:
+            self.backend.cancel_session()
+            raise
+        
+        self.backend.end_session()
+        self.backend.commit_batch()
+        invalidate_model(self.model)
     
     def update_object(self, instance, **kwargs):
         """
@@ -131,18 +353,29 @@ class SearchIndex(object):
         """
         # Check to make sure we want to index this first.
         if self.should_update(instance, **kwargs):
-            self.backend.update(self, [instance])
+            self.backend.update(self, [instance], commit=self.backend.should_commit())
+            invalidate_model(self.model)
     
     def remove_object(self, instance, **kwargs):
         """
         Remove an object from the index. Attached to the class's 
         post-delete hook.
         """
-        self.backend.remove(instance)
+        self.backend.remove(instance, commit=self.backend.should_commit())
+        invalidate_model(self.model)
+    
+    def remove_objects(self, iterable):
+        """
+        Remove many objects (or their identifiers) from the index in one
+        backend call.
+        """
+        self.backend.remove_many(iterable, commit=self.backend.should_commit())
+        invalidate_model(self.model)
     
     def clear(self):
         """Clear the entire index."""
-        self.backend.clear(models=[self.model])
+        self.backend.clear(models=[self.model], commit=self.backend.should_commit())
+        invalidate_model(self.model)
     
     def reindex(self):
         """Completely clear the index for this model and rebuild it."""
@@ -189,7 +422,28 @@ class RealTimeSearchIndex(SearchIndex):
     """
     A variant of the ``SearchIndex`` that constantly keeps the index fresh,
     as opposed to requiring a cron job.
+    
+    If an update buffer is open (see ``haystack.update_buffer``), changes are
+    collected there & sent in bulk when it's flushed, rather than one object
+    at a time.
     """
+    def update_object(self, instance, **kwargs):
+        buffer = update_buffer.get_buffer()
+        
+        if not buffer.is_active():
+            return super(RealTimeSearchIndex, self).update_object(instance, **kwargs)
+        
+        if self.should_update(instance, **kwargs):
+            buffer.update(self, instance)
+    
+    def remove_object(self, instance, **kwargs):
+        buffer = update_buffer.get_buffer()
+        
+        if not buffer.is_active():
+            return super(RealTimeSearchIndex, self).remove_object(instance, **kwargs)
+        
+        buffer.remove(self, instance)
+    
     def _setup_save(self, model):
         signals.post_save.connect(self.update_object, sender=model)
     
@@ -203,6 +457,52 @@ class RealTimeSearchIndex(SearchIndex):
         signals.post_delete.disconnect(self.remove_object, sender=model)
 
 
+class QueuedSearchIndex(SearchIndex):
+    """
+    A variant of the ``SearchIndex`` that records saves & deletes in the
+    update queue (``haystack.update_queue``) rather than updating the index
+    right away. Run the ``process_search_queue`` command to apply them.
+    
+    Saving an object then only costs a local write, no matter how slow the
+    search engine is. Changes are queued before the saving transaction
+    commits; see ``haystack.update_queue`` for how that's handled.
+    """
+    queue = None
+    
+    def get_queue(self):
+        if self.queue is None:
+            return update_queue.get_queue()
+        
+        return self.queue
+    
+    def _setup_save(self, model):
+        signals.post_save.connect(self.enqueue_update, sender=model)
+    
+    def _setup_delete(self, model):
+        signals.post_delete.connect(self.enqueue_delete, sender=model)
+    
+    def _teardown_save(self, model):
+        signals.post_save.disconnect(self.enqueue_update, sender=model)
+    
+    def _teardown_delete(self, model):
+        signals.post_delete.disconnect(self.enqueue_delete, sender=model)
+    
+    def enqueue_update(self, instance, **kwargs):
+        """
+        Queues an update for a single object. Attached to the class's
+        post-save hook.
+        """
+        if self.should_update(instance, **kwargs):
+            self.get_queue().enqueue(self.model, instance.pk, update_queue.UPDATE)
+    
+    def enqueue_delete(self, instance, **kwargs):
+        """
+        Queues the removal of a single object. Attached to the class's
+        post-delete hook.
+        """
+        self.get_queue().enqueue(self.model, instance.pk, update_queue.DELETE)
+
+
 class BasicSearchIndex(SearchIndex):
     text = CharField(document=True, use_template=True)
 
@@ -288,7 +588,7 @@ class ModelSearchIndex(SearchIndex):
     
     def __init__(self, model, backend=None):
         self.model = model
-        self.backend = backend or haystack.backend.SearchBackend()
+        self.backend = backend or haystack.backend.SearchBackend.shared()
         self.prepared_data = None
         content_fields = []
         
@@ -316,3 +616,7 @@ class ModelSearchIndex(SearchIndex):
         
         if not len(content_fields) == 1:
             raise SearchFieldError("An index must have one (and only one) SearchField with document=True.")
+        
+        self._setup_text_attrs(content_fields[0])
+        self._prepare_plan_fields = None
+        self._prepare_plan_version = None
@@ -14,7 +14,7 @@ class Command(NoArgsCommand):
         from haystack import backend, site
         
         default_operator = getattr(settings, 'HAYSTACK_DEFAULT_OPERATOR', DEFAULT_OPERATOR)
-        content_field_name, fields = backend.SearchBackend().build_schema(site.all_searchfields())
+        content_field_name, fields = backend.SearchBackend.shared().build_schema(site.all_searchfields())
         
         t = loader.get_template('search_configuration/solr.xml')
         c = Context({
@@ -24,7 +24,12 @@ class Command(NoArgsCommand):
         print "Removing all documents from your index because you said so."
         
         from haystack import backend
-        sb = backend.SearchBackend()
-        sb.clear()
+        sb = backend.SearchBackend.shared()
+        sb.clear(commit=sb.should_commit())
+        
+        from haystack.query_cache import invalidate_model
+        
+        for model in site.get_indexed_models():
+            invalidate_model(model)
         
         print "All documents removed."
@@ -0,0 +1,51 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from haystack.constants import DEFAULT_BATCH_SIZE
+from haystack.management.commands.update_index import load_site
+
+
+BATCH_SIZE = getattr(settings, 'HAYSTACK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+class Command(NoArgsCommand):
+    help = "Applies the updates & deletes queued by QueuedSearchIndexes."
+    option_list = NoArgsCommand.option_list + (
+        make_option('-b', '--batch-size', action='store', dest='batchsize',
+            default=BATCH_SIZE, type='int',
+            help='Number of queued changes to apply at once.'
+        ),
+        make_option('-l', '--limit', action='store', dest='limit',
+            default=None, type='int',
+            help='Stop after this many queued changes. Default is to drain the whole queue.'
+        ),
+        make_option('-s', '--site', action='store', dest='site',
+            type='string', help='The site object to use when indexing (like `search_sites.mysite`).'
+        ),
+    )
+    
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+    
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+    
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity', default='1',
+                type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+    
+    def handle_noargs(self, **options):
+        from haystack.update_queue import process_queue
+        verbosity = int(options.get('verbosity', 1))
+        batchsize = options.get('batchsize') or BATCH_SIZE
+        site = load_site(options.get('site'))
+        
+        processed, updated, removed = process_queue(site=site, batch_size=batchsize, limit=options.get('limit'))
+        
+        if verbosity >= 1:
+            print "Processed %d queued changes: %d objects updated, %d removed." % (processed, updated, removed)
@@ -0,0 +1,144 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import AppCommand
+from django.db import reset_queries
+from django.utils.encoding import smart_str
+from haystack.constants import DEFAULT_BATCH_SIZE
+from haystack.management.commands.update_index import load_site
+from haystack.query_cache import invalidate_model
+
+
+BATCH_SIZE = getattr(settings, 'HAYSTACK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def find_stale(site, model, batchsize):
+    """
+    Yields lists of the identifiers of ``model``'s documents whose objects
+    are no longer in the index's ``get_queryset``, a page at a time.
+    
+    The index is scanned in ``id`` order (seeking rather than using offsets),
+    and each page of ids is looked up in the database with a single query, so
+    memory use depends only on ``batchsize``. Removing a page's stale
+    documents doesn't disturb the scan. The scan goes through the index's own
+    backend, so another ``site`` prunes the engine it indexes into.
+    """
+    from haystack import backend
+    from haystack.query import SearchQuerySet
+    index = site.get_index(model)
+    prefix = u"%s.%s" % (model._meta.app_label, model._meta.module_name)
+    query = backend.SearchQuery(backend=index.backend)
+    results = SearchQuerySet(site=site, query=query).filter(django_ct=prefix).only('id').scan(page_size=batchsize)
+    last_pk = None
+    
+    while True:
+        pks = []
+        
+        for result in results:
+            pk = unicode(result.pk)
+            
+            # Whoosh's range queries can let a few already-seen documents
+            # back in, so only ever move forward.
+            if last_pk is not None and pk <= last_pk:
+                continue
+            
+            pks.append(pk)
+            last_pk = pk
+            
+            if len(pks) >= batchsize:
+                break
+        
+        if not pks:
+            break
+        
+        found = set([unicode(pk) for pk in index.get_queryset().filter(pk__in=pks).values_list('pk', flat=True)])
+        stale = [u"%s.%s" % (prefix, pk) for pk in pks if not pk in found]
+        
+        if stale:
+            yield stale
+        
+        if len(pks) < batchsize:
+            break
+
+
+class Command(AppCommand):
+    help = "Removes documents from the index whose objects no longer exist."
+    option_list = AppCommand.option_list + (
+        make_option('-b', '--batch-size', action='store', dest='batchsize',
+            default=BATCH_SIZE, type='int',
+            help='Number of documents to check (and remove) at once.'
+        ),
+        make_option('-s', '--site', action='store', dest='site',
+            type='string', help='The site object to use when pruning (like `search_sites.mysite`).'
+        ),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report the stale documents without removing them.'
+        ),
+    )
+    
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+    
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+    
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity', default='1',
+                type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+    
+    def handle(self, *apps, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.batchsize = options.get('batchsize') or BATCH_SIZE
+        self.site = options.get('site')
+        self.dry_run = options.get('dry_run', False)
+        
+        if not apps:
+            self.handle_app(None, **options)
+        else:
+            return super(Command, self).handle(*apps, **options)
+    
+    def handle_app(self, app, **options):
+        from django.db.models import get_models
+        site = load_site(self.site)
+        indexed_models = site.get_indexed_models()
+        
+        for model in get_models(app):
+            if not model in indexed_models:
+                if self.verbosity >= 2:
+                    print "Skipping '%s' - no index." % model
+                continue
+            
+            verbose_name_plural = smart_str(model._meta.verbose_name_plural)
+            backend = site.get_index(model).backend
+            commit = backend.should_commit(batch=True)
+            total = 0
+            
+            if self.verbosity >= 1:
+                print "Pruning %s." % verbose_name_plural
+            
+            for stale in find_stale(site, model, self.batchsize):
+                if self.verbosity >= 2:
+                    for identifier in stale:
+                        print "  %s" % smart_str(identifier)
+                
+                if not self.dry_run:
+                    backend.remove_many(stale, commit=commit)
+                
+                total += len(stale)
+                
+                # Clear out the DB connections queries because it bloats up RAM.
+                reset_queries()
+            
+            if not self.dry_run:
+                backend.commit_batch()
+                invalidate_model(model)
+            
+            if self.verbosity >= 1:
+                if self.dry_run:
+                    print "Found %d stale %s." % (total, verbose_name_plural)
+                else:
+                    print "Removed %d stale %s." % (total, verbose_name_plural)
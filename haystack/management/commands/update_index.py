@@ -1,13 +1,112 @@
 import datetime
+import os
+import time
 from optparse import make_option
 from django.conf import settings
 from django.core.management.base import AppCommand, CommandError
 from django.db import reset_queries
 from django.utils.encoding import smart_str
+from haystack.constants import DEFAULT_BATCH_SIZE
+from haystack.query_cache import invalidate_model
 
 
-DEFAULT_BATCH_SIZE = getattr(settings, 'HAYSTACK_BATCH_SIZE', 1000)
+BATCH_SIZE = getattr(settings, 'HAYSTACK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
 DEFAULT_AGE = None
+DEFAULT_WORKERS = 0
+
+
+def load_site(site_path=None):
+    """
+    Returns the ``SearchSite`` found at the dotted path provided (like
+    ``search_sites.mysite``), falling back to the main site.
+    """
+    # Cause the default site to load.
+    from haystack import site
+    
+    if site_path:
+        path_bits = site_path.split('.')
+        module_name = '.'.join(path_bits[:-1])
+        site_name = path_bits[-1]
+        
+        try:
+            module = __import__(module_name, {}, {}, [''])
+            site = getattr(module, site_name)
+        except (ImportError, NameError):
+            pass
+    
+    return site
+
+
+def build_pk_ranges(qs, batchsize):
+    """
+    Splits a ``QuerySet`` (ordered by primary key) into keyset ranges of
+    roughly ``batchsize`` objects each.
+    
+    Yields ``(lower, upper)`` tuples, where ``lower`` is exclusive and
+    ``upper`` is inclusive. ``None`` means unbounded. Each boundary is found by
+    seeking past the previous one, so no query ever has to skip more than
+    ``batchsize`` rows.
+    """
+    lower = None
+    
+    while True:
+        range_qs = qs
+        
+        if lower is not None:
+            range_qs = qs.filter(pk__gt=lower)
+        
+        upper = list(range_qs.values_list('pk', flat=True)[batchsize - 1:batchsize])
+        
+        if not upper:
+            # Whatever is left fits in a single (open-ended) range.
+            if list(range_qs.values_list('pk', flat=True)[:1]):
+                yield (lower, None)
+            
+            break
+        
+        yield (lower, upper[0])
+        lower = upper[0]
+
+
+# Per-process state for the ``--workers`` pool. Each worker gets its own
+# backend (and therefore its own connection to the search engine) and will
+# open its own database connection on first use.
+_worker_site = None
+_worker_backend = None
+
+
+def init_worker(site_path):
+    global _worker_site, _worker_backend
+    from haystack import backend
+    _worker_site = load_site(site_path)
+    _worker_backend = backend.SearchBackend(site=_worker_site)
+
+
+def update_worker(args):
+    """
+    Indexes a single keyset range. Runs inside a worker process.
+    
+    Returns a tuple of ``(pid, lower, upper, indexed_count, elapsed)``.
+    """
+    from django.db.models import get_model
+    app_label, model_name, lower, upper, extra_lookup_kwargs = args
+    start_time = time.time()
+    model = get_model(app_label, model_name)
+    index = _worker_site.get_index(model)
+    qs = index.get_queryset().filter(**extra_lookup_kwargs).order_by(model._meta.pk.name)
+    
+    if lower is not None:
+        qs = qs.filter(pk__gt=lower)
+    
+    if upper is not None:
+        qs = qs.filter(pk__lte=upper)
+    
+    batch = list(qs)
+    _worker_backend.update(index, batch, commit=_worker_backend.should_commit(batch=True))
+    
+    # Clear out the DB connections queries because it bloats up RAM.
+    reset_queries()
+    return (os.getpid(), lower, upper, len(batch), time.time() - start_time)
 
 
 class Command(AppCommand):
@@ -18,12 +117,16 @@ class Command(AppCommand):
             help='Number of hours back to consider objects new.'
         ),
         make_option('-b', '--batch-size', action='store', dest='batchsize',
-            default=DEFAULT_BATCH_SIZE, type='int',
+            default=BATCH_SIZE, type='int',
             help='Number of items to index at once.'
         ),
         make_option('-s', '--site', action='store', dest='site',
             type='string', help='The site object to use when reindexing (like `search_sites.mysite`).'
         ),
+        make_option('-w', '--workers', action='store', dest='workers',
+            default=DEFAULT_WORKERS, type='int',
+            help='Number of worker processes to index with. Default is 0 (index in this process).'
+        ),
     )
     
     # Django 1.0.X compatibility.
@@ -43,9 +146,19 @@ class Command(AppCommand):
     
     def handle(self, *apps, **options):
         self.verbosity = int(options.get('verbosity', 1))
-        self.batchsize = options.get('batchsize', DEFAULT_BATCH_SIZE)
+        self.batchsize = options.get('batchsize', BATCH_SIZE)
         self.age = options.get('age', DEFAULT_AGE)
         self.site = options.get('site')
+        self.workers = options.get('workers', DEFAULT_WORKERS)
+        
+        if self.workers < 0:
+            raise CommandError("The number of workers can not be negative.")
+        
+        if self.workers > 1:
+            from haystack import backend
+            
+            if not backend.SearchBackend.CONCURRENT_WRITERS:
+                raise CommandError("The '%s' backend only allows one writer at a time, so '--workers' can not be more than 1." % backend.BACKEND_NAME)
         
         if not apps:
             self.handle_app(None, **options)
@@ -53,21 +166,13 @@ class Command(AppCommand):
             return super(Command, self).handle(*apps, **options)
     
     def handle_app(self, app, **options):
-        # Cause the default site to load.
-        from haystack import site
         from django.db.models import get_models
         from haystack.exceptions import NotRegistered
+        site = load_site(self.site)
+        pool = None
         
-        if self.site:
-            path_bits = self.site.split('.')
-            module_name = '.'.join(path_bits[:-1])
-            site_name = path_bits[-1]
-            
-            try:
-                module = __import__(module_name, {}, {}, [''])
-                site = getattr(module, site_name)
-            except (ImportError, NameError):
-                pass
+        if self.workers:
+            pool = self.create_pool()
         
         for model in get_models(app):
             try:
@@ -87,24 +192,102 @@ class Command(AppCommand):
                     if self.verbosity >= 2:
                         print "No updated date field found for '%s' - not restricting by age." % model.__name__
             
-            # `.select_related()` seems like a good idea here but can fail on
-            # nullable `ForeignKey` as well as what seems like other cases.
+            # A blanket `.select_related()` can fail on nullable `ForeignKey`
+            # as well as what seems like other cases, so only the relations
+            # the index's fields actually use get joined (`get_queryset`).
             qs = index.get_queryset().filter(**extra_lookup_kwargs).order_by(model._meta.pk.name)
-            total = qs.count()
+            
+            if pool is not None:
+                self.update_in_pool(pool, model, qs, extra_lookup_kwargs)
+                index.backend.commit_batch()
+                invalidate_model(model)
+                continue
             
             if self.verbosity >= 1:
-                print "Indexing %d %s." % (total, smart_str(model._meta.verbose_name_plural))
+                print "Indexing %s." % smart_str(model._meta.verbose_name_plural)
             
-            for start in range(0, total, self.batchsize):
-                end = min(start + self.batchsize, total)
-                
-                if self.verbosity >= 2:
-                    print "  indexing %s - %d of %d." % (start+1, end, total)
-                
-                # Get a clone of the QuerySet so that the cache doesn't bloat up
-                # in memory. Useful when reindexing large amounts of data.
-                small_cache_qs = qs.all()
-                index.backend.update(index, small_cache_qs[start:end])
-                
-                # Clear out the DB connections queries because it bloats up RAM.
-                reset_queries()
+            counter = [0]
+            commit = index.backend.should_commit(batch=True)
+            index.backend.start_session()
+            
+            try:
+                # Each batch is a fresh query that seeks past the previous one, so
+                # neither the ``QuerySet`` cache nor the offset grows as we go.
+                # Useful when reindexing large amounts of data. The backend pulls
+                # the batches itself, so it can fetch the next while writing.
+                index.backend.update_batches(index, self.counted_batches(index.get_batches(qs, self.batchsize), counter), commit=commit)
+            except:
+                index.backend.cancel_session()
+                raise
+            
+            index.backend.end_session()
+            index.backend.commit_batch()
+            invalidate_model(model)
+            
+            if self.verbosity >= 1:
+                print "Indexed %d %s." % (counter[0], smart_str(model._meta.verbose_name_plural))
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    def counted_batches(self, batches, counter):
+        """
+        Passes the batches through, adding up how many objects there were in
+        ``counter[0]`` and reporting progress as each one is fetched.
+        """
+        for batch in batches:
+            if self.verbosity >= 2:
+                print "  indexing %s - %d." % (counter[0]+1, counter[0]+len(batch))
+            
+            counter[0] += len(batch)
+            yield batch
+            
+            # Clear out the DB connections queries because it bloats up RAM.
+            reset_queries()
+    
+    def create_pool(self):
+        try:
+            import multiprocessing
+        except ImportError:
+            raise CommandError("The '--workers' option requires the 'multiprocessing' module (Python 2.6+).")
+        
+        from django.db import connection
+        
+        # Don't let the workers inherit (and share) our database connection.
+        # They'll each open their own on first use, as will we.
+        connection.close()
+        return multiprocessing.Pool(self.workers, init_worker, (self.site,))
+    
+    def update_in_pool(self, pool, model, qs, extra_lookup_kwargs):
+        """
+        Hands keyset ranges of ``qs`` out to the worker processes, reporting
+        progress as each range completes.
+        """
+        verbose_name_plural = smart_str(model._meta.verbose_name_plural)
+        
+        if self.verbosity >= 1:
+            print "Indexing %s using %d workers." % (verbose_name_plural, self.workers)
+        
+        # The ranges are handed out as they're found, so the workers can start
+        # on the first while the rest of the table is still being split up.
+        tasks = ((model._meta.app_label, model._meta.module_name, lower, upper, extra_lookup_kwargs) for lower, upper in build_pk_ranges(qs, self.batchsize))
+        start_time = time.time()
+        total = 0
+        per_worker = {}
+        
+        for done, (pid, lower, upper, indexed, elapsed) in enumerate(pool.imap_unordered(update_worker, tasks)):
+            total += indexed
+            per_worker[pid] = per_worker.get(pid, 0) + indexed
+            
+            if self.verbosity >= 2:
+                print "  worker %d indexed %d (pk %s - %s) in %.2fs; %d batches done." % (pid, indexed, lower, upper, elapsed, done + 1)
+        
+        elapsed = time.time() - start_time
+        
+        if self.verbosity >= 1:
+            print "Indexed %d %s in %.2fs (%.1f docs/sec)." % (total, verbose_name_plural, elapsed, total / max(elapsed, 0.001))
+        
+        if self.verbosity >= 1:
+            for pid, indexed in sorted(per_worker.items()):
+                print "  worker %d: %d %s." % (pid, indexed, verbose_name_plural)
@@ -5,9 +5,64 @@ from django.db import models
 from django.utils.encoding import force_unicode
 from django.utils.text import capfirst
 
+from haystack.constants import DOTATTR_SEPARATOR
 from haystack.utils.dotattributes import BaseResult
 from haystack.sites import NotRegistered
-from haystack.utils import is_denorm_attr
+
+
+# Result classes generated by ``SearchResult.schema_class``.
+_schema_classes = {}
+
+
+def resolved_value(value):
+    return value
+
+
+class DeferredValue(object):
+    """
+    A raw value from the search engine along with the field that knows how
+    to convert it.
+    
+    Backends store these in place of converted values, so the conversion
+    (which can be costly, like unpickling a ``PickleField``) only happens if
+    the attribute is actually read. ``SearchResult`` swaps in the converted
+    value on first access.
+    """
+    __slots__ = ('field', 'value')
+    
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+    
+    def resolve(self):
+        return self.field.convert(self.value)
+    
+    def __reduce__(self):
+        # Pickled results carry the converted value rather than the field.
+        return (resolved_value, (self.resolve(),))
+
+
+def resolve_deferred(data, name):
+    """
+    Converts (and memoizes) the value stored under ``name`` if it's still a
+    ``DeferredValue``, returning it either way.
+    """
+    value = data.get(name)
+    
+    if type(value) is DeferredValue:
+        value = data[name] = value.resolve()
+    
+    return value
+
+
+def rebuild_search_result(klass, field_names, state):
+    """Recreates a (possibly generated) ``SearchResult`` when unpickling."""
+    if field_names is not None:
+        klass = klass.schema_class(field_names)
+    
+    result = object.__new__(klass)
+    result.__dict__.update(state)
+    return result
 
 
 # Not a Django model, but tightly tied to them and there doesn't seem to be a
@@ -21,22 +76,110 @@ class SearchResult(BaseResult):
     result will do O(N) database queries, which may not fit your needs for
     performance.
     """
+    # Shared defaults, so that each result only has to carry its own data.
+    log = logging.getLogger('haystack')
+    _object = None
+    _model = None
+    _verbose_name = None
+    _additional_fields = ()
+    stored_fields = None
+    _index_class = None
+    _schema_class = False
+    # The denormalized keys (containing ``DOTATTR_SEPARATOR``), kept up to
+    # date by ``__setattr__``.
+    _denorm_keys = ()
+    
+    # Names that fields from the search engine can't overwrite.
+    reserved_attrs = frozenset([
+        'app_label', 'model_name', 'pk', 'score', '_object', '_model',
+        '_verbose_name', '_additional_fields', 'stored_fields', 'log',
+        '_index_class', '_denorm_keys',
+    ])
+    
     def __init__(self, app_label, model_name, pk, score, **kwargs):
         self.app_label, self.model_name = app_label, model_name
         self.pk = pk
         self.score = score
-        self._object = None
-        self._model = None
-        self._verbose_name = None
-        self._additional_fields = []
-        self.stored_fields = None
-        self.log = logging.getLogger('haystack')
-        self._index_class = None
+        additional_fields = []
+        data = self.__dict__
         
         for key, value in kwargs.items():
-            if not key in self.__dict__:
-                self.__dict__[key] = value
-                self._additional_fields.append(key)
+            if not key in SearchResult.reserved_attrs:
+                data[key] = value
+                additional_fields.append(key)
+        
+        self._additional_fields = additional_fields
+        data['_denorm_keys'] = tuple([key for key in data if DOTATTR_SEPARATOR in key])
+    
+    @classmethod
+    def schema_class(cls, field_names):
+        """
+        Returns a subclass that knows the additional fields of its results
+        up front, so each result doesn't need to carry its own list.
+        
+        Generated once per set of field names and reused after that.
+        """
+        key = (cls, frozenset(field_names))
+        
+        try:
+            return _schema_classes[key]
+        except KeyError:
+            additional_fields = tuple([name for name in field_names if not name in cls.reserved_attrs])
+            attrs = {
+                '__module__': cls.__module__,
+                '_additional_fields': additional_fields,
+                '_denorm_keys': tuple([name for name in additional_fields if DOTATTR_SEPARATOR in name]),
+                '_schema_class': True,
+            }
+            klass = type(cls.__name__, (cls,), attrs)
+            _schema_classes[key] = klass
+            return klass
+    
+    @classmethod
+    def build_results(cls, rows):
+        """
+        Builds results in bulk from ``(app_label, model_name, pk, score,
+        additional_fields)`` tuples.
+        
+        Equivalent to calling the constructor for each row, but skips
+        ``__init__`` and reuses one generated class per set of fields.
+        """
+        results = []
+        new = object.__new__
+        classes = {}
+        
+        for app_label, model_name, pk, score, additional_fields in rows:
+            key = frozenset(additional_fields)
+            
+            try:
+                klass = classes[key]
+            except KeyError:
+                klass = classes[key] = cls.schema_class(key)
+            
+            if len(klass._additional_fields) == len(additional_fields):
+                data = dict(additional_fields)
+            else:
+                data = dict([(name, additional_fields[name]) for name in klass._additional_fields])
+            
+            data['app_label'] = app_label
+            data['model_name'] = model_name
+            data['pk'] = pk
+            data['score'] = score
+            result = new(klass)
+            result.__dict__ = data
+            results.append(result)
+        
+        return results
+    
+    def __reduce_ex__(self, protocol):
+        # Generated classes can't be looked up by name when unpickling, so
+        # they get rebuilt from their fields instead.
+        klass = type(self)
+        
+        if klass._schema_class:
+            return (rebuild_search_result, (klass.__bases__[0], klass._additional_fields, self.__dict__.copy()))
+        
+        return (rebuild_search_result, (klass, None, self.__dict__.copy()))
     
     def __repr__(self):
         return "<SearchResult: %s.%s (pk=%r)>" % (self.app_label, self.model_name, self.pk)
@@ -46,20 +189,31 @@ class SearchResult(BaseResult):
     
     def __getattribute__(self, name):
         # Process special attributes and methods
-        if name in set(
-            ['__dict__', '_additional_fields'] + SearchResult.__dict__.keys()):
+        if name in SearchResult.special_attrs:
             return object.__getattribute__(self, name)
-
-        # Process attributes that are not search backend fields
-        if (name in self.__dict__ and
-            name not in self._additional_fields and
-            not is_denorm_attr(self, name)
-            ):
+        
+        data = object.__getattribute__(self, '__dict__')
+        
+        if name in data and not SearchResult.has_denorm_attrs(self, name):
+            # Plain search backend fields need no proxy.
+            if name in data.get('_additional_fields', type(self)._additional_fields):
+                value = data[name]
+                
+                if type(value) is DeferredValue:
+                    value = data[name] = value.resolve()
+                
+                return value
+            
+            # Process attributes that are not search backend fields
             try:
                 return object.__getattribute__(self, name)
             except AttributeError:
                 return self.process_attr_error(name)
-
+        
+        # Make sure whatever the dotted lookup finds has been converted.
+        resolve_deferred(data, name)
+        resolve_deferred(data, name.replace('__', DOTATTR_SEPARATOR))
+        
         # Process dot attributes (attr1.attr2)
         try:
             # Because of we are subclass of BaseResult we can do
@@ -67,7 +221,33 @@ class SearchResult(BaseResult):
             return super(SearchResult, self).__getattribute__(name)
         except AttributeError:
             return self.process_attr_error(name)
-
+    
+    def __setattr__(self, name, value):
+        if DOTATTR_SEPARATOR in name:
+            data = object.__getattribute__(self, '__dict__')
+            denorm_keys = data.get('_denorm_keys', type(self)._denorm_keys)
+            
+            if not name in denorm_keys:
+                data['_denorm_keys'] = tuple(denorm_keys) + (name,)
+        
+        object.__setattr__(self, name, value)
+    
+    def has_denorm_attrs(self, name):
+        """
+        Whether there are denormalized attributes (``name0_0_0other``) under
+        ``name``. Same as ``is_denorm_attr``, but only has to look at the keys
+        known to be denormalized, so bookkeeping attributes (like ``_object``
+        from ``load_all``) don't slow it down.
+        """
+        data = object.__getattribute__(self, '__dict__')
+        marker = name + DOTATTR_SEPARATOR
+        
+        for key in data.get('_denorm_keys', type(self)._denorm_keys):
+            if marker in key:
+                return True
+        
+        return False
+    
     def process_attr_error(self, name):
         if not self._index_class:
             from haystack import site
@@ -182,3 +362,8 @@ class SearchResult(BaseResult):
                     self._stored_fields[fieldname] = getattr(self, fieldname, u'')
         
         return self._stored_fields
+
+
+# Attributes that always come straight from the class/instance, worked out
+# once rather than on every attribute access.
+SearchResult.special_attrs = frozenset(['__dict__', '_additional_fields'] + SearchResult.__dict__.keys())
@@ -2,8 +2,101 @@ import re
 from django.conf import settings
 from haystack import backend
 from haystack.backends import SQ
-from haystack.constants import REPR_OUTPUT_SIZE, ITERATOR_LOAD_PER_QUERY, DEFAULT_OPERATOR
-from haystack.exceptions import NotRegistered
+from haystack.constants import REPR_OUTPUT_SIZE, ITERATOR_LOAD_PER_QUERY, ITERATOR_MAX_LOAD_PER_QUERY, DEFAULT_OPERATOR
+from haystack.exceptions import HaystackError, NotRegistered
+
+
+class ResultCache(object):
+    """
+    A sparse, list-like store for the results fetched so far.
+    
+    Results are kept in fixed-size pages that are only created once something
+    is stored in them, so memory grows with the number of results fetched
+    rather than the total hit count. Positions that haven't been fetched yet
+    read as ``None``, just like the placeholders in a list would.
+    """
+    page_size = 100
+    
+    def __init__(self, size=0):
+        self.size = size
+        # The first position that hasn't been fetched yet.
+        self.filled_to = 0
+        self._pages = {}
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        for position in xrange(self.size):
+            yield self.get(position)
+    
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.get(position) for position in xrange(*k.indices(self.size))]
+        
+        if k < 0:
+            k += self.size
+        
+        if k < 0 or k >= self.size:
+            raise IndexError("ResultCache index out of range")
+        
+        return self.get(k)
+    
+    def __eq__(self, other):
+        if not isinstance(other, (ResultCache, list, tuple)):
+            return NotImplemented
+        
+        return len(self) == len(other) and list(self) == list(other)
+    
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        
+        if equal is NotImplemented:
+            return equal
+        
+        return not equal
+    
+    def get(self, position):
+        page = self._pages.get(position // self.page_size)
+        
+        if page is None:
+            return None
+        
+        return page[position % self.page_size]
+    
+    def store(self, start, results):
+        """Stores ``results`` at the positions from ``start`` onward."""
+        page_size = self.page_size
+        
+        for position, result in enumerate(results):
+            position += start
+            page_number, offset = divmod(position, page_size)
+            page = self._pages.get(page_number)
+            
+            if page is None:
+                page = self._pages[page_number] = [None] * page_size
+            
+            page[offset] = result
+        
+        self.size = max(self.size, start + len(results))
+        
+        while self.filled_to < self.size and self.get(self.filled_to) is not None:
+            self.filled_to += 1
+    
+    def is_missing(self, start, stop):
+        """
+        Returns ``True`` if any position within ``start:stop`` hasn't been
+        fetched yet.
+        """
+        start, stop, step = slice(start, stop).indices(self.size)
+        
+        if stop <= self.filled_to:
+            return False
+        
+        return None in self[max(start, self.filled_to):stop]
+    
+    def is_full(self):
+        return self.size > 0 and self.filled_to >= self.size
 
 
 class SearchQuerySet(object):
@@ -14,11 +107,12 @@ class SearchQuerySet(object):
     """
     def __init__(self, site=None, query=None):
         self.query = query or backend.SearchQuery()
-        self._result_cache = []
+        self._result_cache = ResultCache()
         self._result_count = None
         self._cache_full = False
         self._load_all = False
         self._ignored_result_count = 0
+        self._load_per_query = ITERATOR_LOAD_PER_QUERY
         
         if site is not None:
             self.site = site
@@ -78,12 +172,7 @@ class SearchQuerySet(object):
         if len(self) <= 0:
             return True
         
-        try:
-            self._result_cache.index(None)
-            return False
-        except ValueError:
-            # No ``None``s found in the results. Check the length of the cache.
-            return len(self._result_cache) > 0
+        return self._result_cache.is_full()
     
     def _manual_iter(self):
         # If we're here, our cache isn't fully populated.
@@ -92,13 +181,14 @@ class SearchQuerySet(object):
         # about generator functions.
         current_position = 0
         current_cache_max = 0
+        # The backend skips results it can't use (like those for models that
+        # aren't registered), so a load can come back short. Track how far
+        # into the backend's results we've got separately from the cache, so
+        # the next load neither repeats nor skips any.
+        query_position = 0
         
         while True:
-            if len(self._result_cache) > 0:
-                try:
-                    current_cache_max = self._result_cache.index(None)
-                except ValueError:
-                    current_cache_max = len(self._result_cache)
+            current_cache_max = self._result_cache.filled_to
             
             while current_position < current_cache_max:
                 yield self._result_cache[current_position]
@@ -107,13 +197,35 @@ class SearchQuerySet(object):
             if self._cache_is_full():
                 raise StopIteration
             
+            if self.query.has_run() and query_position >= self.query.get_count():
+                raise StopIteration
+            
             # We've run out of results and haven't hit our limit.
             # Fill more of the cache.
-            if not self._fill_cache(current_position, current_position + ITERATOR_LOAD_PER_QUERY):
+            query_position = max(query_position, current_position)
+            load_size = self._next_load_size()
+            
+            if not self._fill_cache(query_position, query_position + load_size, cache_start=current_position):
                 raise StopIteration
+            
+            query_position += load_size
     
-    def _fill_cache(self, start, end):
-        # Tell the query where to start from and how many we'd like.
+    def _next_load_size(self):
+        """
+        Returns how many results to load with the next query while iterating.
+        
+        Starts at ``ITERATOR_LOAD_PER_QUERY`` and doubles each time, up to
+        ``HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY``, so a short loop stays cheap
+        while a long one needs far fewer queries.
+        """
+        load_size = self._load_per_query
+        max_load_size = getattr(settings, 'HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY', ITERATOR_MAX_LOAD_PER_QUERY)
+        self._load_per_query = max(min(load_size * 2, max_load_size), 1)
+        return load_size
+    
+    def _fill_cache(self, start, end, cache_start=None):
+        # Tell the query where to start from and how many we'd like. The
+        # results get stored from ``cache_start`` (``start`` by default).
         self.query._reset()
         self.query.set_limits(start, end)
         results = self.query.get_results()
@@ -121,14 +233,11 @@ class SearchQuerySet(object):
         if len(results) == 0:
             return False
         
-        # Setup the full cache now that we know how many results there are.
-        # We need the ``None``s as placeholders to know what parts of the
-        # cache we have/haven't filled.
-        # Using ``None`` like this takes up very little memory. In testing,
-        # an array of 100,000 ``None``s consumed less than .5 Mb, which ought
-        # to be an acceptable loss for consistent and more efficient caching.
+        # Size the cache now that we know how many results there are. Only
+        # the pages that get results stored in them take up any memory, so a
+        # huge hit count costs nothing until those results are fetched.
         if len(self._result_cache) == 0:
-            self._result_cache = [None for i in xrange(self.query.get_count())]
+            self._result_cache = ResultCache(self.query.get_count())
         
         if start is None:
             start = 0
@@ -136,6 +245,17 @@ class SearchQuerySet(object):
         if end is None:
             end = self.query.get_count()
         
+        if cache_start is None:
+            cache_start = start
+        
+        self._result_cache.store(cache_start, self._post_process_results(results))
+        return True
+    
+    def _post_process_results(self, results):
+        """
+        Attaches the objects to the results when ``load_all`` is in use,
+        dropping (and counting) those whose object can't be found.
+        """
         # Check if we wish to load all objects.
         if self._load_all:
             original_results = []
@@ -171,9 +291,7 @@ class SearchQuerySet(object):
             
             to_cache.append(result)
         
-        # Assign by slice.
-        self._result_cache[start:start + len(to_cache)] = to_cache
-        return True
+        return to_cache
     
     
     def __getitem__(self, k):
@@ -203,7 +321,7 @@ class SearchQuerySet(object):
             bound = k + 1
         
         # We need check to see if we need to populate more of the cache.
-        if len(self._result_cache) <= 0 or (None in self._result_cache[start:bound] and not self._cache_is_full()):
+        if len(self._result_cache) <= 0 or (self._result_cache.is_missing(start, bound) and not self._cache_is_full()):
             try:
                 self._fill_cache(start, bound)
             except StopIteration:
@@ -313,6 +431,48 @@ class SearchQuerySet(object):
         clone.query.raw_search(query_string, **kwargs)
         return clone
     
+    def only(self, *fields):
+        """
+        Limits the stored fields fetched for each result to those provided.
+        """
+        clone = self._clone()
+        
+        for field in fields:
+            clone.query.add_field(field)
+        
+        return clone
+    
+    def values(self, *fields):
+        """
+        Returns dictionaries of the provided fields (or all of the fields, if
+        none are provided) rather than ``SearchResult`` objects.
+        """
+        clone = self.only(*fields)._clone(klass=ValuesSearchQuerySet)
+        clone._fields = list(fields)
+        return clone
+    
+    def values_list(self, *fields, **kwargs):
+        """
+        Returns tuples of the provided fields rather than ``SearchResult``
+        objects. With ``flat=True`` (and a single field), returns the values
+        themselves.
+        """
+        flat = kwargs.pop('flat', False)
+        
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments to values_list: %s" % kwargs.keys())
+        
+        if not fields:
+            raise TypeError("values_list requires at least one field.")
+        
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+        
+        clone = self.only(*fields)._clone(klass=ValuesListSearchQuerySet)
+        clone._fields = list(fields)
+        clone._flat = flat
+        return clone
+    
     def load_all(self):
         """Efficiently populates the objects in the search results."""
         clone = self._clone()
@@ -321,7 +481,6 @@ class SearchQuerySet(object):
     
     def load_all_queryset(self, model, queryset):
         # DRL_TODO: Remove before 1.0.
-        from haystack.exceptions import HaystackError
         raise HaystackError("This method is deprecated. Please use the `RelatedSearchQuerySet` instead.")
     
     def auto_query(self, query_string):
@@ -369,11 +528,121 @@ class SearchQuerySet(object):
     
     # Methods that do not return a SearchQuerySet.
     
+    def iterator(self, chunk_size=None):
+        """
+        Iterates over the results without caching them.
+        
+        Results are loaded ``chunk_size`` at a time. Without a ``chunk_size``,
+        the number loaded grows with each query (as it does when iterating
+        normally). Useful for going through large numbers of results (like
+        an export), since memory use stays bounded.
+        """
+        clone = self._clone()
+        query = clone.query
+        start = 0
+        
+        while True:
+            if chunk_size:
+                load_size = chunk_size
+            else:
+                load_size = clone._next_load_size()
+            
+            query._reset()
+            query.set_limits(start, start + load_size)
+            results = query.get_results()
+            
+            if not results:
+                break
+            
+            for result in clone._post_process_results(results):
+                yield result
+            
+            start += load_size
+            
+            if start >= query.get_count():
+                break
+    
     def count(self):
         """Returns the total number of matching results."""
         clone = self._clone()
         return len(clone)
     
+    def scan(self, page_size=None):
+        """
+        Streams all of the results, a page at a time, without using offsets.
+        
+        Each page seeks past the last result of the previous one using its
+        sort value and its unique ``id`` (which breaks ties), so fetching a
+        page deep into the results costs the same as fetching the first one.
+        Results are ordered by the (single) ``order_by`` field, falling back
+        to ``id`` alone. Nothing is cached on the ``SearchQuerySet``.
+        """
+        if page_size is None:
+            page_size = getattr(settings, 'HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY', ITERATOR_MAX_LOAD_PER_QUERY)
+        
+        clone = self._clone()
+        order_by = list(clone.query.order_by)
+        
+        if len(order_by) > 1:
+            raise HaystackError("Scanning can only follow the order of a single field, not %s." % ', '.join(order_by))
+        
+        sort_field = None
+        reverse = False
+        
+        if order_by:
+            sort_field = order_by[0].lstrip('-')
+            reverse = order_by[0].startswith('-')
+        
+        if reverse:
+            clone.query.add_order_by('-id')
+        else:
+            clone.query.add_order_by('id')
+        
+        last_result = None
+        
+        while True:
+            page = clone._clone()
+            
+            if last_result is not None:
+                page.query.add_filter(page._seek_filter(sort_field, reverse, last_result))
+            
+            page.query.set_limits(0, page_size)
+            results = page.query.get_results()
+            
+            if not results:
+                break
+            
+            for result in page._post_process_results(results):
+                yield result
+            
+            if len(results) < page_size:
+                break
+            
+            last_result = results[-1]
+    
+    def _seek_filter(self, sort_field, reverse, result):
+        """
+        Builds the filter that matches what comes after ``result`` when
+        ordered by ``sort_field`` (if any) and then ``id``.
+        """
+        if reverse:
+            after = 'lt'
+        else:
+            after = 'gt'
+        
+        last_id = u"%s.%s.%s" % (result.app_label, result.model_name, result.pk)
+        seek = SQ(**{'id__%s' % after: last_id})
+        
+        if sort_field is None:
+            return seek
+        
+        last_value = getattr(result, sort_field, None)
+        
+        if last_value is None:
+            raise HaystackError("Scanning by '%s' requires the field to be stored and present on every result." % sort_field)
+        
+        return SQ(**{'%s__%s' % (sort_field, after): last_value}) | (SQ(**{sort_field: last_value}) & seek)
+    
     def best_match(self):
         """Returns the best/top search result that matches the query."""
         clone = self._clone()
@@ -442,7 +711,79 @@ class EmptySearchQuerySet(SearchQuerySet):
     
     def _clone(self, klass=None):
         clone = super(EmptySearchQuerySet, self)._clone(klass=klass)
-        clone._result_cache = []
+        clone._result_cache = ResultCache()
+        return clone
+
+
+class ValuesSearchQuerySet(SearchQuerySet):
+    """
+    A ``SearchQuerySet`` that returns dictionaries of field values rather
+    than ``SearchResult`` objects.
+    
+    Only the fields asked for are fetched from the backend. The cache still
+    holds the ``SearchResult`` objects; they're converted on the way out.
+    """
+    def __init__(self, site=None, query=None):
+        super(ValuesSearchQuerySet, self).__init__(site=site, query=query)
+        self._fields = []
+    
+    def __iter__(self):
+        for result in super(ValuesSearchQuerySet, self).__iter__():
+            yield self._process_result(result)
+    
+    def __getitem__(self, k):
+        results = super(ValuesSearchQuerySet, self).__getitem__(k)
+        
+        if isinstance(k, slice):
+            return [self._process_result(result) for result in results]
+        
+        return self._process_result(results)
+    
+    def iterator(self, chunk_size=None):
+        for result in super(ValuesSearchQuerySet, self).iterator(chunk_size=chunk_size):
+            yield self._process_result(result)
+    
+    def scan(self, page_size=None):
+        for result in super(ValuesSearchQuerySet, self).scan(page_size=page_size):
+            yield self._process_result(result)
+    
+    def _process_result(self, result):
+        if result is None:
+            return None
+        
+        if not self._fields:
+            return result.get_additional_fields()
+        
+        return dict([(field, getattr(result, field, None)) for field in self._fields])
+    
+    def _clone(self, klass=None):
+        clone = super(ValuesSearchQuerySet, self)._clone(klass=klass)
+        clone._fields = self._fields[:]
+        return clone
+
+
+class ValuesListSearchQuerySet(ValuesSearchQuerySet):
+    """
+    A ``SearchQuerySet`` that returns tuples of field values (or, with
+    ``flat``, the value of a single field) rather than ``SearchResult``
+    objects.
+    """
+    def __init__(self, site=None, query=None):
+        super(ValuesListSearchQuerySet, self).__init__(site=site, query=query)
+        self._flat = False
+    
+    def _process_result(self, result):
+        if result is None:
+            return None
+        
+        if self._flat:
+            return getattr(result, self._fields[0], None)
+        
+        return tuple([getattr(result, field, None) for field in self._fields])
+    
+    def _clone(self, klass=None):
+        clone = super(ValuesListSearchQuerySet, self)._clone(klass=klass)
+        clone._flat = self._flat
         return clone
 
 
@@ -457,6 +798,11 @@ class RelatedSearchQuerySet(SearchQuerySet):
     _load_all_querysets = {}
     _result_cache = []
     
+    def __init__(self, site=None, query=None):
+        super(RelatedSearchQuerySet, self).__init__(site=site, query=query)
+        # Results are appended as they're loaded, so a plain list is enough.
+        self._result_cache = []
+    
     def _cache_is_full(self):
         return len(self._result_cache) >= len(self)
     
@@ -0,0 +1,302 @@
+"""
+An opt-in cache for the results of search queries.
+
+Enabled with the ``HAYSTACK_QUERY_CACHE`` setting, either as ``'locmem'`` (an
+in-process LRU cache) or ``'django'`` (Django's cache framework, shared
+between processes). Entries expire after ``HAYSTACK_QUERY_CACHE_TIMEOUT``
+seconds and are invalidated per model whenever a ``SearchIndex`` updates or
+removes objects.
+"""
+import copy
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.hashcompat import md5_constructor
+
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_SIZE = 1000
+
+# The generation shared by queries that aren't limited to certain models.
+ALL_MODELS = '*'
+
+
+def normalize(value):
+    """
+    Turns query parameters into something with a stable ``repr``, whatever
+    order the dicts/sets involved happen to be in.
+    """
+    if isinstance(value, dict):
+        items = [(normalize(key), normalize(item)) for key, item in value.items()]
+        items.sort()
+        return tuple(items)
+    
+    if isinstance(value, (set, frozenset)):
+        items = [normalize(item) for item in value]
+        items.sort()
+        return tuple(items)
+    
+    if isinstance(value, (list, tuple)):
+        return tuple([normalize(item) for item in value])
+    
+    return value
+
+
+def copy_results(results):
+    """
+    Copies the results from the backend, so that changes made to them (like
+    ``load_all`` attaching the objects) don't end up in the cache.
+    """
+    if not isinstance(results, dict):
+        # Counts & the like.
+        return results
+    
+    results = results.copy()
+    
+    if 'results' in results:
+        results['results'] = [copy.copy(result) for result in results['results']]
+    
+    return results
+
+
+class BaseQueryCache(object):
+    """
+    The common bits of the query caches.
+    
+    Rather than tracking which entries involve which models, each model has a
+    generation that's part of the key. Invalidating a model bumps its
+    generation (and the one for queries across all models), so the old
+    entries are never seen again and simply age out.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        raise NotImplementedError
+    
+    def set(self, key, results):
+        raise NotImplementedError
+    
+    def get_generation(self, name):
+        raise NotImplementedError
+    
+    def bump_generation(self, name):
+        raise NotImplementedError
+    
+    def make_key(self, backend, key_parts, models=None):
+        """
+        Builds the cache key for a query from the backend in use (see
+        ``BaseSearchBackend.cache_identity``), anything that identifies the
+        query (the built query & its params) and the generations of the
+        models it covers.
+        """
+        names = [model_name(model) for model in (models or [])]
+        names.sort()
+        
+        if not names:
+            names = [ALL_MODELS]
+        
+        generations = [(name, self.get_generation(name)) for name in names]
+        raw_key = repr((backend.cache_identity(), normalize(key_parts), generations))
+        return 'haystack:query:%s' % md5_constructor(raw_key).hexdigest()
+    
+    def invalidate(self, model):
+        """Makes any cached results involving ``model`` stale."""
+        self.bump_generation(model_name(model))
+        self.bump_generation(ALL_MODELS)
+    
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# The fields of the links in ``LocMemQueryCache``'s list of entries.
+PREV, NEXT, KEY, EXPIRES, RESULTS = 0, 1, 2, 3, 4
+
+
+class LocMemQueryCache(BaseQueryCache):
+    """
+    Keeps results in the current process, evicting the least recently used
+    entries once ``max_size`` is reached.
+    
+    The entries form a doubly linked list, least recently used first, with a
+    dict pointing at each link, so lookups, moving an entry to the end and
+    evicting the oldest are all constant time.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_size=DEFAULT_MAX_SIZE):
+        super(LocMemQueryCache, self).__init__(timeout=timeout)
+        self.max_size = max_size
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._reset()
+    
+    def _reset(self):
+        # ``[prev, next, key, expires, results]`` links, with a sentinel
+        # (``_root``) joining the two ends.
+        self._entries = {}
+        root = self._root = []
+        root[:] = [root, root, None, None, None]
+    
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+    
+    def _append(self, link):
+        root = self._root
+        last = root[PREV]
+        link[PREV] = last
+        link[NEXT] = root
+        last[NEXT] = root[PREV] = link
+    
+    def get(self, key):
+        self._lock.acquire()
+        
+        try:
+            link = self._entries.get(key)
+            
+            if link is not None and link[EXPIRES] < time.time():
+                self._unlink(link)
+                del(self._entries[key])
+                link = None
+            
+            if link is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            results = link[RESULTS]
+        finally:
+            self._lock.release()
+        
+        return copy_results(results)
+    
+    def set(self, key, results):
+        results = copy_results(results)
+        self._lock.acquire()
+        
+        try:
+            link = self._entries.get(key)
+            
+            if link is not None:
+                self._unlink(link)
+            elif len(self._entries) >= self.max_size:
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del(self._entries[oldest[KEY]])
+            
+            link = self._entries[key] = [None, None, key, time.time() + self.timeout, results]
+            self._append(link)
+        finally:
+            self._lock.release()
+    
+    def get_generation(self, name):
+        return self._generations.get(name, 0)
+    
+    def bump_generation(self, name):
+        self._lock.acquire()
+        
+        try:
+            self._generations[name] = self._generations.get(name, 0) + 1
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        self._lock.acquire()
+        
+        try:
+            self._reset()
+        finally:
+            self._lock.release()
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoQueryCache(BaseQueryCache):
+    """
+    Keeps results in Django's cache (``CACHE_BACKEND``), so they're shared by
+    every process using it.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, cache=None):
+        super(DjangoQueryCache, self).__init__(timeout=timeout)
+        
+        if cache is None:
+            from django.core.cache import cache
+        
+        self.cache = cache
+    
+    def get(self, key):
+        results = self.cache.get(key)
+        
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        
+        return results
+    
+    def set(self, key, results):
+        self.cache.set(key, results, self.timeout)
+    
+    def get_generation(self, name):
+        return self.cache.get('haystack:generation:%s' % name)
+    
+    def bump_generation(self, name):
+        # A fresh token rather than a counter. It lives as long as the
+        # entries made with it, so by the time it expires (and the
+        # generation resets), so have they.
+        self.cache.set('haystack:generation:%s' % name, '%.6f' % time.time(), self.timeout)
+
+
+def model_name(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.module_name)
+
+
+def load_query_cache():
+    """
+    Builds the query cache the settings ask for, or returns ``None`` when
+    caching is off.
+    """
+    cache_type = getattr(settings, 'HAYSTACK_QUERY_CACHE', None)
+    timeout = getattr(settings, 'HAYSTACK_QUERY_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+    
+    if not cache_type:
+        return None
+    
+    if cache_type == 'locmem':
+        return LocMemQueryCache(timeout=timeout, max_size=getattr(settings, 'HAYSTACK_QUERY_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE))
+    
+    if cache_type == 'django':
+        return DjangoQueryCache(timeout=timeout)
+    
+    raise ImproperlyConfigured("The HAYSTACK_QUERY_CACHE setting must be either 'locmem' or 'django', not '%s'." % cache_type)
+
+
+_query_cache = None
+_query_cache_loaded = False
+
+
+def get_query_cache():
+    """Returns the query cache in use (loading it on first use), if any."""
+    global _query_cache, _query_cache_loaded
+    
+    if not _query_cache_loaded:
+        _query_cache = load_query_cache()
+        _query_cache_loaded = True
+    
+    return _query_cache
+
+
+def invalidate_model(model):
+    """Invalidates the cached results for ``model``, if caching is on."""
+    query_cache = get_query_cache()
+    
+    if query_cache is not None:
+        query_cache.invalidate(model)
@@ -0,0 +1,217 @@
+"""
+Per-thread buffering of the index updates made by ``RealTimeSearchIndex``.
+
+Saving the same object several times in one request would otherwise send it
+to the search engine each time. While a buffer is open, updates & removals
+are collected instead, keyed by the object's identifier (so only the last
+action for each object counts), then sent in one bulk call per index when
+the buffer is flushed.
+
+A buffer is open for the length of each request when
+``HAYSTACK_BUFFER_UPDATES`` is ``True``, and within any function wrapped in
+``buffer_updates``.
+"""
+import logging
+import threading
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from django.utils.functional import wraps
+from haystack.query_cache import invalidate_model
+from haystack.utils import get_identifier
+
+
+UPDATE = 'update'
+REMOVE = 'remove'
+
+
+class UpdateBuffer(object):
+    """
+    Collects index changes until it's flushed. ``start`` & ``finish`` nest,
+    with only the outermost ``finish`` flushing.
+    
+    Each nesting level remembers what its changes replaced, so an inner level
+    that's discarded (say a failed ``buffer_updates`` function within the
+    request's buffer) undoes just its own changes.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """Closes every level, throwing away all of the changes."""
+        self.depth = 0
+        # Per open level, ``{identifier: change}`` with the change each
+        # object had before the level first touched it (``None`` if none).
+        self.levels = []
+        self.clear()
+    
+    def clear(self):
+        # ``{identifier: (index, action, instance)}``, plus the order the
+        # objects were first seen in.
+        self.changes = {}
+        self.order = []
+    
+    def is_active(self):
+        return self.depth > 0
+    
+    def start(self):
+        self.depth += 1
+        self.levels.append({})
+    
+    def finish(self, discard=False):
+        """
+        Closes the innermost level. The outermost one flushes the buffer, or
+        throws away the changes with ``discard=True``. An inner one keeps its
+        changes for the enclosing level, or undoes them with
+        ``discard=True``.
+        """
+        if self.depth == 0:
+            return
+        
+        self.depth -= 1
+        level = self.levels.pop()
+        
+        if self.depth == 0:
+            if discard:
+                self.clear()
+            else:
+                self.flush()
+        elif discard:
+            self.rollback(level)
+        else:
+            parent = self.levels[-1]
+            
+            for identifier, previous in level.items():
+                parent.setdefault(identifier, previous)
+    
+    def rollback(self, level):
+        """Puts back the changes ``level`` replaced."""
+        for identifier, previous in level.items():
+            if previous is None:
+                del(self.changes[identifier])
+                self.order.remove(identifier)
+            else:
+                self.changes[identifier] = previous
+    
+    def add(self, index, action, instance):
+        identifier = get_identifier(instance)
+        previous = self.changes.get(identifier)
+        
+        if self.levels and not identifier in self.levels[-1]:
+            self.levels[-1][identifier] = previous
+        
+        if previous is None:
+            self.order.append(identifier)
+        
+        self.changes[identifier] = (index, action, instance)
+    
+    def update(self, index, instance):
+        self.add(index, UPDATE, instance)
+    
+    def remove(self, index, instance):
+        self.add(index, REMOVE, instance)
+    
+    def flush(self):
+        """
+        Sends the buffered changes to the search engine, one ``update`` &
+        one ``remove_many`` call per index. Together they make up one
+        batch, as far as the ``HAYSTACK_COMMIT_POLICY`` goes.
+        """
+        changes, order = self.changes, self.order
+        self.clear()
+        indexes = []
+        updates = {}
+        removals = {}
+        
+        for identifier in order:
+            index, action, instance = changes[identifier]
+            
+            if not index in indexes:
+                indexes.append(index)
+            
+            if action == UPDATE:
+                updates.setdefault(index, []).append(instance)
+            else:
+                removals.setdefault(index, []).append(identifier)
+        
+        backends = []
+        
+        for index in indexes:
+            backend = index.backend
+            commit = backend.should_commit(batch=True)
+            
+            if index in updates:
+                backend.update(index, updates[index], commit=commit)
+            
+            if index in removals:
+                backend.remove_many(removals[index], commit=commit)
+            
+            if not backend in backends:
+                backends.append(backend)
+        
+        for backend in backends:
+            backend.commit_batch()
+        
+        for index in indexes:
+            invalidate_model(index.model)
+    
+    def __len__(self):
+        return len(self.changes)
+
+
+_local = threading.local()
+
+
+def get_buffer():
+    """Returns the current thread's buffer."""
+    update_buffer = getattr(_local, 'buffer', None)
+    
+    if update_buffer is None:
+        update_buffer = _local.buffer = UpdateBuffer()
+    
+    return update_buffer
+
+
+def buffer_updates(func):
+    """
+    Decorator that buffers the index changes made within ``func``, sending
+    them once it returns. If it raises an exception, the changes are thrown
+    away (much like ``transaction.commit_on_success``, which it pairs well
+    with).
+    """
+    def wrapper(*args, **kwargs):
+        update_buffer = get_buffer()
+        update_buffer.start()
+        
+        try:
+            result = func(*args, **kwargs)
+        except:
+            update_buffer.finish(discard=True)
+            raise
+        
+        update_buffer.finish()
+        return result
+    
+    return wraps(func)(wrapper)
+
+
+def start_request_buffer(**kwargs):
+    if getattr(settings, 'HAYSTACK_BUFFER_UPDATES', False):
+        get_buffer().start()
+
+
+def finish_request_buffer(**kwargs):
+    update_buffer = get_buffer()
+    
+    if not update_buffer.is_active():
+        return
+    
+    try:
+        update_buffer.finish()
+    except Exception:
+        # The response has already gone out, so there's no one to tell.
+        logging.getLogger('haystack').exception("Failed to send the buffered index updates.")
+        update_buffer.reset()
+
+
+request_started.connect(start_request_buffer)
+request_finished.connect(finish_request_buffer)
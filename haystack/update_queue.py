@@ -0,0 +1,315 @@
+"""
+A durable, local queue of pending index updates.
+
+``QueuedSearchIndex`` records ``(model, pk, action)`` here when objects are
+saved or deleted, rather than talking to the search engine during the
+request. The ``process_search_queue`` command (or ``process_queue``) drains
+it later in batches, collapsing repeated changes to the same object.
+
+The queue is a SQLite file at ``HAYSTACK_QUEUE_PATH``, so it survives
+restarts and can be shared by every process on the machine.
+
+Saves are queued from ``post_save``, before the surrounding transaction (if
+any) commits, so a new object may not be visible yet when its entry gets
+processed. Such entries are put back on the queue until they're older than
+``HAYSTACK_QUEUE_GRACE_PERIOD`` seconds; only then is a missing object treated
+as deleted.
+"""
+import os
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import get_model
+from haystack.backends import set_fail_silently
+from haystack.constants import DEFAULT_BATCH_SIZE
+from haystack.exceptions import NotRegistered
+from haystack.query_cache import invalidate_model
+
+
+UPDATE = 'update'
+DELETE = 'delete'
+
+DEFAULT_GRACE_PERIOD = 60
+
+
+class UpdateQueue(object):
+    """
+    A FIFO of ``(app_label, model_name, pk, action, created)`` entries, kept
+    in a SQLite database at ``path``.
+    
+    Each thread gets its own connection, as SQLite connections can't be
+    shared between threads.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._setup_lock = threading.Lock()
+        self._setup_complete = False
+    
+    def _get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            # With a write-ahead log, draining the queue doesn't block the
+            # processes adding to it, and each enqueue needs fewer fsyncs.
+            # Older SQLite versions just ignore this.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._setup(conn)
+        
+        return conn
+    
+    def _setup(self, conn):
+        self._setup_lock.acquire()
+        
+        try:
+            if not self._setup_complete:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS haystack_queue (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        app_label TEXT NOT NULL,
+                        model_name TEXT NOT NULL,
+                        pk TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        created REAL NOT NULL
+                    )
+                """)
+                conn.commit()
+                self._setup_complete = True
+        finally:
+            self._setup_lock.release()
+    
+    def enqueue(self, model, pk, action=UPDATE):
+        """Records that the object with ``pk`` needs updating or deleting."""
+        if not action in (UPDATE, DELETE):
+            raise ValueError("The action must be either '%s' or '%s', not '%s'." % (UPDATE, DELETE, action))
+        
+        conn = self._get_connection()
+        conn.execute(
+            "INSERT INTO haystack_queue (app_label, model_name, pk, action, created) VALUES (?, ?, ?, ?, ?)",
+            (model._meta.app_label, model._meta.module_name, unicode(pk), action, time.time())
+        )
+        conn.commit()
+    
+    def peek(self, limit=DEFAULT_BATCH_SIZE, max_id=None):
+        """
+        Returns up to ``limit`` of the oldest entries (no later than
+        ``max_id``, if given), as
+        ``(id, app_label, model_name, pk, action, created)`` tuples, without
+        removing them.
+        """
+        conn = self._get_connection()
+        
+        if max_id is None:
+            cursor = conn.execute("SELECT id, app_label, model_name, pk, action, created FROM haystack_queue ORDER BY id LIMIT ?", (limit,))
+        else:
+            cursor = conn.execute("SELECT id, app_label, model_name, pk, action, created FROM haystack_queue WHERE id <= ? ORDER BY id LIMIT ?", (max_id, limit))
+        
+        return cursor.fetchall()
+    
+    def last_id(self):
+        """Returns the id of the newest entry, or ``None`` if it's empty."""
+        conn = self._get_connection()
+        return conn.execute("SELECT MAX(id) FROM haystack_queue").fetchone()[0]
+    
+    def acknowledge(self, last_id, requeue=()):
+        """
+        Removes every entry up to (and including) ``last_id``.
+        
+        The ``requeue`` entries (as returned by ``peek``) are added back to
+        the end of the queue in the same transaction, keeping the time they
+        were first queued.
+        """
+        conn = self._get_connection()
+        
+        try:
+            conn.execute("DELETE FROM haystack_queue WHERE id <= ?", (last_id,))
+            conn.executemany(
+                "INSERT INTO haystack_queue (app_label, model_name, pk, action, created) VALUES (?, ?, ?, ?, ?)",
+                [entry[1:] for entry in requeue]
+            )
+        except:
+            conn.rollback()
+            raise
+        
+        conn.commit()
+    
+    def clear(self):
+        conn = self._get_connection()
+        conn.execute("DELETE FROM haystack_queue")
+        conn.commit()
+    
+    def __len__(self):
+        conn = self._get_connection()
+        return conn.execute("SELECT COUNT(*) FROM haystack_queue").fetchone()[0]
+
+
+def collapse(entries):
+    """
+    Reduces queue entries to the last action for each object, returning a
+    dictionary of ``{(app_label, model_name): {pk: action}}``.
+    """
+    actions = {}
+    
+    for entry_id, app_label, model_name, pk, action, created in entries:
+        actions.setdefault((app_label, model_name), {})[pk] = action
+    
+    return actions
+
+
+def process_batch(entries, site, grace_period=0):
+    """
+    Applies a batch of queue entries to the index, returning the number of
+    objects updated and removed, and the entries to try again later.
+    
+    Every queued object is looked up in its index's ``get_queryset`` first:
+    the ones found are updated and the rest removed, whatever the queued
+    action was. So a delete that got rolled back doesn't take a live object
+    out of the index, and an update for an object deleted since removes it.
+    Entries for models that aren't registered with ``site`` are skipped.
+    
+    An update for a missing object that was queued less than
+    ``grace_period`` seconds ago is left for later instead, as the
+    transaction that saved it may not have committed yet.
+    
+    Backends raise (rather than log) write errors while this runs, so a
+    batch that couldn't be applied isn't acknowledged.
+    """
+    updated = 0
+    removed = 0
+    retry = []
+    backends = []
+    models = []
+    # The last entry for each object is the one its action came from.
+    latest = {}
+    
+    for entry in entries:
+        latest[entry[1:4]] = entry
+    
+    cutoff = time.time() - grace_period
+    fail_silently = set_fail_silently(False)
+    
+    try:
+        for (app_label, model_name), actions in collapse(entries).items():
+            model = get_model(app_label, model_name)
+            
+            if model is None:
+                continue
+            
+            try:
+                index = site.get_index(model)
+            except NotRegistered:
+                continue
+            
+            backend = index.backend
+            commit = backend.should_commit(batch=True)
+            objects = list(index.get_queryset().filter(pk__in=actions.keys()))
+            found = set([unicode(obj.pk) for obj in objects])
+            delete_pks = []
+            
+            for pk, action in actions.items():
+                if pk in found:
+                    continue
+                
+                entry = latest[(app_label, model_name, pk)]
+                
+                if action == UPDATE and entry[5] > cutoff:
+                    retry.append(entry)
+                else:
+                    delete_pks.append(pk)
+            
+            if objects:
+                backend.update(index, objects, commit=commit)
+                updated += len(objects)
+            
+            if delete_pks:
+                backend.remove_many(["%s.%s.%s" % (app_label, model_name, pk) for pk in delete_pks], commit=commit)
+                removed += len(delete_pks)
+            
+            if not backend in backends:
+                backends.append(backend)
+            
+            models.append(model)
+        
+        for backend in backends:
+            backend.commit_batch()
+    finally:
+        set_fail_silently(fail_silently)
+    
+    for model in models:
+        invalidate_model(model)
+    
+    return updated, removed, retry
+
+
+def process_queue(queue=None, site=None, batch_size=DEFAULT_BATCH_SIZE, limit=None, grace_period=None):
+    """
+    Drains the entries queued so far in batches of ``batch_size`` entries,
+    stopping early once ``limit`` entries have been processed (if given).
+    
+    Entries are only removed once their batch has been applied, so a failure
+    leaves them in place to be retried. Updates for objects that can't be
+    found yet are put back on the queue until they're older than
+    ``grace_period`` (``HAYSTACK_QUEUE_GRACE_PERIOD``) seconds. Returns a
+    tuple of ``(entries, updated, removed)``.
+    """
+    if queue is None:
+        queue = get_queue()
+    
+    if site is None:
+        from haystack import site
+    
+    if grace_period is None:
+        grace_period = getattr(settings, 'HAYSTACK_QUEUE_GRACE_PERIOD', DEFAULT_GRACE_PERIOD)
+    
+    # Entries put back on the queue go after this, so they wait for the next run.
+    max_id = queue.last_id()
+    processed = updated = removed = 0
+    
+    if max_id is None:
+        return processed, updated, removed
+    
+    while limit is None or processed < limit:
+        size = batch_size
+        
+        if limit is not None:
+            size = min(size, limit - processed)
+        
+        entries = queue.peek(size, max_id)
+        
+        if not entries:
+            break
+        
+        batch_updated, batch_removed, retry = process_batch(entries, site, grace_period)
+        queue.acknowledge(entries[-1][0], retry)
+        processed += len(entries)
+        updated += batch_updated
+        removed += batch_removed
+    
+    return processed, updated, removed
+
+
+_queue = None
+
+
+def get_queue():
+    """Returns the queue at ``HAYSTACK_QUEUE_PATH``, opening it on first use."""
+    global _queue
+    
+    if _queue is None:
+        if not getattr(settings, 'HAYSTACK_QUEUE_PATH', None):
+            raise ImproperlyConfigured('You must specify a HAYSTACK_QUEUE_PATH in your settings to queue index updates.')
+        
+        _queue = UpdateQueue(settings.HAYSTACK_QUEUE_PATH)
+    
+    return _queue
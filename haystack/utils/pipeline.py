@@ -0,0 +1,137 @@
+"""
+A small, bounded, multi-stage pipeline for indexing.
+
+Indexing a batch involves three steps that use different resources: pulling
+objects out of the database, preparing them (Python/templates) and sending the
+documents to the search engine. Run in sequence, each step waits on the
+others. The ``IndexingPipeline`` runs them concurrently instead:
+
+    fetch (the calling thread) -> [prepare workers] -> [write workers]
+
+Stages are connected by bounded queues, so a fast stage blocks (backpressure)
+rather than buffering an unbounded amount of data when the next stage is slow.
+"""
+import sys
+import threading
+import Queue
+
+
+# Marks the end of the work for a stage.
+STOP = object()
+
+
+class IndexingPipeline(object):
+    """
+    Runs ``prepare`` and ``write`` over an iterable in chunks, each stage in
+    its own thread(s).
+    
+    ``prepare`` is called with a list of objects and should return a list of
+    documents. ``write`` is called with each list of documents. The first
+    exception raised by any stage is re-raised from ``run`` once everything
+    has shut down.
+    """
+    def __init__(self, prepare, write, prepare_workers=1, write_workers=1,
+                 chunk_size=100, queue_size=4):
+        self.prepare = prepare
+        self.write = write
+        self.prepare_workers = max(int(prepare_workers), 1)
+        self.write_workers = max(int(write_workers), 1)
+        self.chunk_size = max(int(chunk_size), 1)
+        self.queue_size = max(int(queue_size), 1)
+        self._error = None
+        self._error_lock = threading.Lock()
+    
+    def _fail(self):
+        self._error_lock.acquire()
+        
+        try:
+            if self._error is None:
+                self._error = sys.exc_info()
+        finally:
+            self._error_lock.release()
+    
+    def _prepare_worker(self, in_queue, out_queue):
+        while True:
+            chunk = in_queue.get()
+            
+            if chunk is STOP:
+                break
+            
+            # Keep draining after a failure so the fetch stage never blocks.
+            if self._error is not None:
+                continue
+            
+            try:
+                docs = self.prepare(chunk)
+            except:
+                self._fail()
+                continue
+            
+            if docs:
+                out_queue.put(docs)
+    
+    def _write_worker(self, in_queue):
+        while True:
+            docs = in_queue.get()
+            
+            if docs is STOP:
+                break
+            
+            if self._error is not None:
+                continue
+            
+            try:
+                self.write(docs)
+            except:
+                self._fail()
+    
+    def _start(self, count, target, args):
+        threads = []
+        
+        for i in range(count):
+            thread = threading.Thread(target=target, args=args)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        
+        return threads
+    
+    def run(self, iterable):
+        self._error = None
+        prepare_queue = Queue.Queue(self.queue_size)
+        write_queue = Queue.Queue(self.queue_size)
+        preparers = self._start(self.prepare_workers, self._prepare_worker, (prepare_queue, write_queue))
+        writers = self._start(self.write_workers, self._write_worker, (write_queue,))
+        
+        try:
+            chunk = []
+            
+            for obj in iterable:
+                if self._error is not None:
+                    break
+                
+                chunk.append(obj)
+                
+                if len(chunk) >= self.chunk_size:
+                    prepare_queue.put(chunk)
+                    chunk = []
+            
+            if chunk and self._error is None:
+                prepare_queue.put(chunk)
+        except:
+            self._fail()
+        
+        for thread in preparers:
+            prepare_queue.put(STOP)
+        
+        for thread in preparers:
+            thread.join()
+        
+        for thread in writers:
+            write_queue.put(STOP)
+        
+        for thread in writers:
+            thread.join()
+        
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
@@ -0,0 +1,272 @@
+"""
+A thread-safe pool of keep-alive HTTP connections.
+
+Opening a fresh connection for every request to the search engine means a
+TCP handshake (and often a ``TIME_WAIT`` socket left behind) each time. The
+``ConnectionPool`` keeps finished connections around so later requests to the
+same host can reuse them. Pools are shared process-wide, one per host, via
+``get_pool``.
+
+Sockets must not be shared between processes, so a pool that finds itself in a
+forked child (like an ``update_index --workers`` process) drops the idle
+connections it inherited and starts afresh.
+"""
+import errno
+import httplib
+import os
+import select
+import socket
+import threading
+import time
+from urlparse import urlsplit
+
+
+DEFAULT_MAX_SIZE = 10
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_TIMEOUT = 10
+
+# Socket errors, while sending a request, that mean a reused connection was
+# closed by the other end while it sat in the pool.
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+def is_empty_status_line(e):
+    """
+    Whether a ``BadStatusLine`` means the server closed the connection without
+    sending a single byte of response. Depending on the Python version,
+    ``httplib`` reports that as ``''``, ``"''"`` or with a message.
+    """
+    line = getattr(e, 'line', '')
+    return not line or line == "''" or line.startswith('No status line received')
+
+
+class ConnectionPool(object):
+    """
+    Hands out connections to a single host, keeping up to ``max_size`` idle
+    ones around for reuse.
+    
+    Idle connections are dropped once they've been unused for longer than
+    ``idle_timeout`` seconds, or when a check of the socket shows the server
+    has closed them.
+    """
+    def __init__(self, scheme, host, port=None, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # ``(last_used, connection)`` pairs, most recently used last.
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+    
+    def check_pid(self):
+        """
+        Forgets the idle connections (and the lock) inherited from the parent
+        process after a fork, so the two processes never share a socket.
+        """
+        if self._pid == os.getpid():
+            return
+        
+        idle, self._idle = self._idle, []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        
+        # Only closes this process's copy; the parent's connection stays open.
+        for last_used, conn in idle:
+            conn.close()
+    
+    def new_connection(self):
+        if self.scheme == 'https':
+            klass = httplib.HTTPSConnection
+        else:
+            klass = httplib.HTTPConnection
+        
+        conn = klass(self.host, self.port, timeout=self.timeout)
+        conn.connect()
+        # Small requests on a reused connection would otherwise wait on
+        # Nagle's algorithm for the previous response's ACK.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.created += 1
+        return conn
+    
+    def is_usable(self, conn):
+        """
+        Whether an idle connection still looks open. An idle keep-alive
+        socket should have nothing to read; if it's readable, the server has
+        either closed it or sent something we didn't ask for.
+        """
+        sock = conn.sock
+        
+        if sock is None:
+            return False
+        
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        
+        return not readable
+    
+    def get(self):
+        """
+        Returns an idle connection if a usable one is available, otherwise a
+        new one. The second value says whether the connection was reused.
+        """
+        now = time.time()
+        self.check_pid()
+        self._lock.acquire()
+        
+        try:
+            while self._idle:
+                last_used, conn = self._idle.pop()
+                
+                if now - last_used <= self.idle_timeout and self.is_usable(conn):
+                    self.reused += 1
+                    return conn, True
+                
+                conn.close()
+        finally:
+            self._lock.release()
+        
+        return self.new_connection(), False
+    
+    def put(self, conn):
+        """Returns a connection to the pool, closing it if the pool is full."""
+        self.check_pid()
+        self._lock.acquire()
+        
+        try:
+            if len(self._idle) < self.max_size:
+                self._idle.append((time.time(), conn))
+                return
+        finally:
+            self._lock.release()
+        
+        conn.close()
+    
+    def send(self, conn, reused, method, path, body, headers):
+        """
+        Sends a request on ``conn`` and waits for the response to start.
+        
+        Returns ``None`` (rather than raising) if ``conn`` was reused and
+        turns out to have been closed before the server saw the request, as
+        that's the only case where it's safe to send the request again. Once
+        the server may have seen the request (including a timeout waiting on
+        it), the error is raised, so writes are never sent twice.
+        """
+        try:
+            conn.request(method, path, body, headers)
+        except socket.timeout:
+            raise
+        except httplib.CannotSendRequest:
+            if reused:
+                return None
+            
+            raise
+        except socket.error, e:
+            if reused and e.args and e.args[0] in STALE_ERRNOS:
+                return None
+            
+            raise
+        
+        try:
+            return conn.getresponse()
+        except httplib.BadStatusLine, e:
+            if reused and is_empty_status_line(e):
+                return None
+            
+            raise
+    
+    def request(self, method, path, body=None, headers=None):
+        """
+        Sends a request, returning ``(status, headers, body)``.
+        
+        If a reused connection turns out to have been closed underneath us
+        before the server saw the request, the request is retried once on a
+        fresh connection.
+        """
+        if headers is None:
+            headers = {}
+        
+        conn, reused = self.get()
+        
+        try:
+            response = self.send(conn, reused, method, path, body, headers)
+            
+            if response is None:
+                conn.close()
+                conn = self.new_connection()
+                response = self.send(conn, False, method, path, body, headers)
+            
+            data = response.read()
+        except:
+            conn.close()
+            raise
+        
+        if response.will_close:
+            conn.close()
+        else:
+            self.put(conn)
+        
+        return response.status, dict(response.getheaders()), data
+    
+    def clear(self):
+        """Closes all of the idle connections."""
+        self._lock.acquire()
+        
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        
+        for last_used, conn in idle:
+            conn.close()
+    
+    def __len__(self):
+        return len(self._idle)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(url, **kwargs):
+    """
+    Returns the process-wide pool for the host in ``url``, creating it (with
+    ``kwargs``) on first use. Forked children get pools of their own.
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    key = (os.getpid(), scheme, netloc)
+    _pools_lock.acquire()
+    
+    try:
+        if not key in _pools:
+            if ':' in netloc:
+                host, port = netloc.rsplit(':', 1)
+                port = int(port)
+            else:
+                host, port = netloc, None
+            
+            _pools[key] = ConnectionPool(scheme, host, port, **kwargs)
+        
+        return _pools[key]
+    finally:
+        _pools_lock.release()
+
+
+def clear_pools():
+    """Closes every idle connection in every pool."""
+    _pools_lock.acquire()
+    
+    try:
+        pools = _pools.values()
+    finally:
+        _pools_lock.release()
+    
+    for pool in pools:
+        pool.clear()
@@ -0,0 +1,195 @@
+"""
+Codecs for turning Python data into text a search engine can store, as used by
+``PickleField``.
+
+Encoded values look like ``~1pz:<payload>``: a marker, the format version, the
+codec's tag, a ``z`` if the payload was compressed with zlib, then the payload
+itself. Binary payloads are base64-encoded, as the engines only store text.
+Values without the marker are in the original ``PickleField`` format (a
+base64-encoded pickle) and are only decoded when the field allows it.
+
+Unpickling can run code, so tagged pickles are only decoded for a field that
+uses the pickle codec itself.
+"""
+import base64
+import cPickle as pickle
+import zlib
+from haystack.exceptions import MissingDependency, SearchFieldError
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        from django.utils import simplejson as json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+FORMAT_MARKER = '~'
+FORMAT_VERSION = '1'
+COMPRESSED_FLAG = 'z'
+
+
+class Codec(object):
+    """
+    Serializes data to a string & back. ``binary`` codecs produce bytes that
+    need base64-encoding before they can be stored. Only ``safe`` codecs can
+    decode data from a source you don't trust.
+    """
+    name = None
+    tag = None
+    binary = True
+    safe = True
+    
+    def is_available(self):
+        return True
+    
+    def dumps(self, data):
+        raise NotImplementedError
+    
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """
+    Handles any picklable data, using the highest pickle protocol. Only use
+    it on data from a source you trust, as unpickling can run code.
+    """
+    name = 'pickle'
+    tag = 'p'
+    safe = False
+    
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    """
+    Handles lists, dicts, strings, numbers, booleans & ``None``. Stored as
+    is (no base64) and safe to decode no matter where the data came from.
+    """
+    name = 'json'
+    tag = 'j'
+    binary = False
+    
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+    
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Handles the same types as ``JSONCodec`` in a compact binary format.
+    Requires the ``msgpack`` library.
+    """
+    name = 'msgpack'
+    tag = 'm'
+    
+    def is_available(self):
+        return msgpack is not None
+    
+    def dumps(self, data):
+        return msgpack.packb(data)
+    
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+
+CODECS = {}
+CODECS_BY_TAG = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+    CODECS_BY_TAG[codec.tag] = codec
+
+
+register_codec(PickleCodec())
+register_codec(JSONCodec())
+register_codec(MsgpackCodec())
+
+
+def get_codec(name):
+    """Returns the codec registered under ``name``."""
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise SearchFieldError("Unknown codec '%s'. Choose from: %s." % (name, ', '.join(sorted(CODECS.keys()))))
+    
+    check_available(codec)
+    return codec
+
+
+def check_available(codec):
+    if not codec.is_available():
+        raise MissingDependency("The '%s' codec requires a library that isn't installed." % codec.name)
+
+
+def encode(data, codec, compress_threshold=None):
+    """
+    Encodes ``data`` with ``codec``, compressing payloads of at least
+    ``compress_threshold`` bytes (when given) if that makes them smaller.
+    """
+    payload = codec.dumps(data)
+    flags = ''
+    
+    if compress_threshold is not None and len(payload) >= compress_threshold:
+        compressed = zlib.compress(payload)
+        
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags = COMPRESSED_FLAG
+    
+    if codec.binary or flags:
+        payload = base64.b64encode(payload)
+    
+    return '%s%s%s%s:%s' % (FORMAT_MARKER, FORMAT_VERSION, codec.tag, flags, payload)
+
+
+def decode(value, codec, allow_legacy=False):
+    """
+    Decodes a value made by ``encode`` for a field using ``codec``. Values
+    in the original format (untagged pickles) are only decoded if
+    ``allow_legacy`` is set.
+    
+    Data stored with an unsafe codec (pickle) is refused unless ``codec`` is
+    that same codec, so a field set to ``'json'`` never unpickles anything.
+    """
+    if not value.startswith(FORMAT_MARKER):
+        if not allow_legacy:
+            raise SearchFieldError("Stored data isn't tagged with a codec. Data in the original (pickled) format is only decoded if the field allows it.")
+        
+        return pickle.loads(base64.b64decode(value))
+    
+    header, payload = value[len(FORMAT_MARKER):].split(':', 1)
+    version, tag, flags = header[:1], header[1:2], header[2:]
+    
+    if version != FORMAT_VERSION:
+        raise SearchFieldError("Stored data is in format version '%s', which isn't supported." % version)
+    
+    stored_codec = CODECS_BY_TAG.get(tag)
+    
+    if stored_codec is None:
+        raise SearchFieldError("Stored data uses an unknown codec '%s'." % tag)
+    
+    if not stored_codec.safe and stored_codec is not codec:
+        raise SearchFieldError("Stored data uses the '%s' codec, which is only decoded by fields using it." % stored_codec.name)
+    
+    check_available(stored_codec)
+    
+    if stored_codec.binary or flags:
+        payload = base64.b64decode(payload)
+    
+    if COMPRESSED_FLAG in flags:
+        payload = zlib.decompress(payload)
+    
+    return stored_codec.loads(payload)
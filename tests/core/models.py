@@ -34,3 +34,10 @@ class AnotherMockModel(models.Model):
     
     def __unicode__(self):
         return self.author
+
+
+class CharPKMockModel(models.Model):
+    key = models.CharField(max_length=10, primary_key=True)
+    
+    def __unicode__(self):
+        return self.key
@@ -7,9 +7,13 @@ from core.tests.backends import *
 from core.tests.fields import *
 from core.tests.forms import *
 from core.tests.indexes import *
+from core.tests.management import *
 from core.tests.models import *
 from core.tests.query import *
+from core.tests.query_cache import *
 from core.tests.sites import *
 from core.tests.templatetags import *
+from core.tests.update_buffer import *
+from core.tests.update_queue import *
 from core.tests.views import *
 from core.tests.utils import *
@@ -1,6 +1,10 @@
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 import haystack
+from haystack import indexes
+from core.models import MockModel
+from core.tests.mocks import MockSearchBackend
 
 
 class LoadBackendTestCase(TestCase):
@@ -22,3 +26,88 @@ class LoadBackendTestCase(TestCase):
             self.fail()
         except ImproperlyConfigured:
             pass
+
+
+class CommitRecordingMockSearchBackend(MockSearchBackend):
+    def __init__(self):
+        super(CommitRecordingMockSearchBackend, self).__init__()
+        self.writes = []
+        self.commits = 0
+    
+    def update(self, index, iterable, commit=True):
+        self.writes.append(('update', commit))
+        super(CommitRecordingMockSearchBackend, self).update(index, iterable, commit=commit)
+    
+    def remove(self, obj, commit=True):
+        self.writes.append(('remove', commit))
+    
+    def clear(self, models=[], commit=True):
+        self.writes.append(('clear', commit))
+    
+    def commit(self):
+        self.commits += 1
+
+
+class CommitMockSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, model_attr='author')
+
+
+class CommitPolicyTestCase(TestCase):
+    def setUp(self):
+        super(CommitPolicyTestCase, self).setUp()
+        self.old_policy = getattr(settings, 'HAYSTACK_COMMIT_POLICY', 'immediate')
+        self.msb = CommitRecordingMockSearchBackend()
+        self.mi = CommitMockSearchIndex(MockModel, backend=self.msb)
+    
+    def tearDown(self):
+        settings.HAYSTACK_COMMIT_POLICY = self.old_policy
+        super(CommitPolicyTestCase, self).tearDown()
+    
+    def test_should_commit(self):
+        expected = {
+            'immediate': (True, True),
+            'within': (True, True),
+            'batch': (True, False),
+            'none': (False, False),
+        }
+        
+        for policy, (single, batch) in expected.items():
+            settings.HAYSTACK_COMMIT_POLICY = policy
+            self.assertEqual(self.msb.should_commit(), single)
+            self.assertEqual(self.msb.should_commit(batch=True), batch)
+            self.msb.commit_batch()
+        
+        # Only the ``'batch'`` policy commits at the end of a batch.
+        self.assertEqual(self.msb.commits, 1)
+        
+        settings.HAYSTACK_COMMIT_POLICY = 'sometimes'
+        self.assertRaises(ImproperlyConfigured, self.msb.should_commit)
+    
+    def test_immediate(self):
+        settings.HAYSTACK_COMMIT_POLICY = 'immediate'
+        self.mi.update()
+        self.mi.update_object(MockModel.objects.get(pk=1))
+        self.mi.remove_object(MockModel.objects.get(pk=1))
+        self.mi.clear()
+        self.assertEqual(self.msb.writes, [('update', True), ('update', True), ('remove', True), ('clear', True)])
+        self.assertEqual(self.msb.commits, 0)
+    
+    def test_batch(self):
+        settings.HAYSTACK_COMMIT_POLICY = 'batch'
+        self.mi.update()
+        self.assertEqual(self.msb.writes, [('update', False)])
+        self.assertEqual(self.msb.commits, 1)
+        
+        # Single objects are a batch of their own.
+        self.mi.update_object(MockModel.objects.get(pk=1))
+        self.assertEqual(self.msb.writes[-1], ('update', True))
+        self.assertEqual(self.msb.commits, 1)
+    
+    def test_none(self):
+        settings.HAYSTACK_COMMIT_POLICY = 'none'
+        self.mi.update()
+        self.mi.update_object(MockModel.objects.get(pk=1))
+        self.mi.remove_object(MockModel.objects.get(pk=1))
+        self.mi.clear()
+        self.assertEqual(self.msb.writes, [('update', False), ('update', False), ('remove', False), ('clear', False)])
+        self.assertEqual(self.msb.commits, 0)
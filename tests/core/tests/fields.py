@@ -1,6 +1,9 @@
+import base64
+import cPickle
 import datetime
 from django.template import TemplateDoesNotExist
 from django.test import TestCase
+import haystack.fields
 from haystack.fields import *
 from core.models import MockModel, MockTag
 
@@ -104,6 +107,54 @@ class CharFieldTestCase(TestCase):
         username = CharField(model_attr='user__username')
 
         self.assertEqual(username.prepare(mock), u'root')
+    
+    def test_prepare_cached_accessors(self):
+        tag_name = CharField(model_attr='tag__name')
+        mock = MockModel()
+        mock.tag = MockTag(name='primary')
+        
+        self.assertEqual(tag_name.prepare(mock), u'primary')
+        self.assertEqual(tag_name._accessor_cache[MockModel], (('tag', ('tag__name',), MockModel), ('name', (), MockTag)))
+        
+        mock = MockModel()
+        mock.tag = MockTag(name='secondary')
+        self.assertEqual(tag_name.prepare(mock), u'secondary')
+        
+        # A dynamic attribute on the instance takes priority, as before.
+        mock = MockModel()
+        mock.tag = MockTag(name='secondary')
+        mock.tag__name = 'dynamic'
+        self.assertEqual(tag_name.prepare(mock), 'dynamic')
+        
+        # Empty values behave the same.
+        mock = MockModel()
+        mock.tag = MockTag(name=None)
+        self.assertRaises(SearchFieldError, tag_name.prepare, mock)
+        
+        # Related objects of a different class get looked up afresh.
+        class Plain(object):
+            pass
+        
+        plain = Plain()
+        plain.tag = MockTag(name='primary')
+        self.assertEqual(tag_name.prepare(plain), u'primary')
+        
+        plain = Plain()
+        plain.tag = MockModel()
+        plain.tag.name = 'model'
+        self.assertEqual(tag_name.prepare(plain), 'model')
+        
+        plain = Plain()
+        plain.tag = object()
+        self.assertRaises(SearchFieldError, tag_name.prepare, plain)
+        
+        # Dynamic compound attributes aren't cached.
+        mock = MockModel()
+        mock.one__two__three = 'ok'
+        one_two = CharField(model_attr='one__two__three')
+        
+        self.assertEqual(one_two.prepare(mock), 'ok')
+        self.assertEqual(one_two._accessor_cache, {})
 
 
 class IntegerFieldTestCase(TestCase):
@@ -264,6 +315,78 @@ class MultiValueFieldTestCase(TestCase):
         self.assertEqual(multy_none.prepare(mock), None)
 
 
+class PickleFieldTestCase(TestCase):
+    def setUp(self):
+        super(PickleFieldTestCase, self).setUp()
+        self.data = {'tags': [u'one', u'two'], 'count': 3, 'nested': {'flag': True}}
+    
+    def prepared(self, data, **kwargs):
+        mock = MockModel()
+        mock.data = data
+        return PickleField(model_attr='data', **kwargs).prepare(mock)
+    
+    def test_init(self):
+        try:
+            foo = PickleField(model_attr='foo')
+        except:
+            self.fail()
+        
+        self.assertRaises(SearchFieldError, PickleField, codec='yaml')
+    
+    def test_codecs(self):
+        field = PickleField()
+        
+        for codec in ('pickle', 'json'):
+            prepared = self.prepared(self.data, codec=codec)
+            self.assertEqual(prepared[:4], '~1%s:' % codec[0])
+            self.assertEqual(field.convert(prepared), self.data)
+            
+            # Solr hands back unicode.
+            self.assertEqual(field.convert(unicode(prepared)), self.data)
+        
+        # JSON is stored as is.
+        self.assertEqual(self.prepared([1, 2], codec='json'), '~1j:[1,2]')
+        
+        # Pickle handles more than JSON does.
+        when = datetime.datetime(2009, 2, 25, 1, 2, 3)
+        self.assertEqual(field.convert(self.prepared(when)), when)
+        self.assertEqual(field.convert(None), None)
+    
+    def test_compression(self):
+        field = PickleField()
+        data = [u'repeated text'] * 100
+        
+        for codec in ('pickle', 'json'):
+            uncompressed = self.prepared(data, codec=codec)
+            compressed = self.prepared(data, codec=codec, compress_threshold=100)
+            self.assertEqual(compressed[:5], '~1%sz:' % codec[0])
+            self.assert_(len(compressed) < len(uncompressed))
+            self.assertEqual(field.convert(compressed), data)
+        
+        # Small payloads are left alone.
+        self.assertEqual(self.prepared([1, 2], codec='json', compress_threshold=100), '~1j:[1,2]')
+    
+    def test_unsafe_codecs(self):
+        pickled = self.prepared(self.data)
+        json_field = PickleField(codec='json')
+        self.assertEqual(json_field.convert(self.prepared(self.data, codec='json')), self.data)
+        
+        # JSON fields never unpickle.
+        self.assertRaises(SearchFieldError, json_field.convert, pickled)
+        self.assertRaises(SearchFieldError, json_field.convert, self.prepared(self.data, compress_threshold=1))
+        self.assertRaises(SearchFieldError, json_field.convert, base64.b64encode(cPickle.dumps(self.data)))
+    
+    def test_legacy_format(self):
+        legacy = base64.b64encode(cPickle.dumps(self.data))
+        self.assertRaises(SearchFieldError, PickleField().convert, legacy)
+        
+        field = PickleField(allow_legacy=True)
+        self.assertEqual(field.convert(legacy), self.data)
+        
+        self.assertRaises(SearchFieldError, field.convert, '~9p:abc')
+        self.assertRaises(SearchFieldError, field.convert, '~1q:abc')
+
+
 class CharFieldWithTemplateTestCase(TestCase):
     def test_init(self):
         try:
@@ -294,3 +417,37 @@ class CharFieldWithTemplateTestCase(TestCase):
         template3 = CharField(use_template=True)
         template3.instance_name = 'template'
         self.assertEqual(template3.prepare(mock), u'Indexed!\n1')
+    
+    def test_template_cache(self):
+        mock = MockModel()
+        mock.pk = 1
+        clear_template_cache()
+        template = CharField(use_template=True)
+        template.instance_name = 'template'
+        self.assertEqual(template.prepare(mock), u'Indexed!\n1')
+        self.assertEqual(template._template_names, {MockModel: 'search/indexes/core/mockmodel_template.txt'})
+        self.assert_('search/indexes/core/mockmodel_template.txt' in haystack.fields._template_cache)
+        
+        mock.pk = 2
+        self.assertEqual(template.prepare(mock), u'Indexed!\n2')
+        
+        clear_template_cache()
+        self.assertEqual(haystack.fields._template_cache, {})
+
+
+class CharFieldWithTextAttrsTestCase(TestCase):
+    def test_prepare(self):
+        mock = MockModel()
+        mock.author = 'daniel'
+        mock.tag = MockTag(name='primary')
+        text = CharField(document=True, text_attrs=['author', 'tag__name', 'hello'])
+        
+        self.assertEqual(text.prepare(mock), u'daniel\nprimary\nWorld!')
+        
+        # Empty values are skipped.
+        mock.tag = None
+        self.assertEqual(text.prepare(mock), u'daniel\nWorld!')
+        
+        # Missing attributes aren't.
+        text = CharField(document=True, text_attrs=['author', 'nope'])
+        self.assertRaises(SearchFieldError, text.prepare, mock)
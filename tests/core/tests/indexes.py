@@ -1,4 +1,5 @@
 import datetime
+from django.db import models
 from django.test import TestCase
 from haystack import indexes
 from core.models import MockModel
@@ -53,6 +54,20 @@ class GoodNullableMockSearchIndex(indexes.SearchIndex):
     author = indexes.CharField(model_attr='author', null=True)
 
 
+class GoodRelatedMockSearchIndex(indexes.SearchIndex):
+    content = indexes.CharField(document=True, use_template=True)
+    author = indexes.CharField(model_attr='author')
+    tag_name = indexes.CharField(model_attr='tag__name', null=True)
+    tag = indexes.CharField(model_attr='tag', null=True)
+    hello = indexes.CharField(model_attr='hello__func__world', null=True)
+
+
+class GoodRealTimeMockSearchIndex(indexes.RealTimeSearchIndex):
+    content = indexes.CharField(document=True, use_template=True)
+    author = indexes.CharField(model_attr='author')
+    pub_date = indexes.DateTimeField(model_attr='pub_date')
+
+
 class SearchIndexTestCase(TestCase):
     def setUp(self):
         super(SearchIndexTestCase, self).setUp()
@@ -115,7 +130,34 @@ class SearchIndexTestCase(TestCase):
     
     def test_get_queryset(self):
         self.assertEqual(len(self.mi.get_queryset()), 3)
+
+    def test_get_select_related(self):
+        self.assertEqual(self.mi.get_select_related(), [])
+        self.assertEqual(self.mi.get_queryset().query.select_related, False)
+        
+        rmi = GoodRelatedMockSearchIndex(MockModel, backend=self.msb)
+        self.assertEqual(rmi.get_select_related(), ['tag'])
+        self.assertEqual(rmi.get_queryset().query.select_related, {'tag': {}})
+        
+        # The related objects come along with the batch.
+        objs = list(rmi.get_queryset().order_by('pk'))
+        self.assertEqual(len(objs), 3)
+        self.assertEqual([hasattr(obj, '_tag_cache') for obj in objs], [True, True, True])
+        self.assertEqual([rmi.prepare(obj)['tag_name'] for obj in objs], [u'primary', u'primary', u'secondary'])
     
+    def test_get_batches(self):
+        batches = list(self.mi.get_batches(batch_size=2))
+        self.assertEqual([[obj.pk for obj in batch] for batch in batches], [[1, 2], [3]])
+
+        batches = list(self.mi.get_batches(batch_size=3))
+        self.assertEqual([[obj.pk for obj in batch] for batch in batches], [[1, 2, 3]])
+
+        batches = list(self.mi.get_batches(MockModel.objects.filter(pk__gte=2).order_by('-pk'), batch_size=1))
+        self.assertEqual([[obj.pk for obj in batch] for batch in batches], [[2], [3]])
+
+        batches = list(self.mi.get_batches(MockModel.objects.none(), batch_size=2))
+        self.assertEqual(batches, [])
+
     def test_prepare(self):
         mock = MockModel()
         mock.pk = 20
@@ -184,6 +226,20 @@ class SearchIndexTestCase(TestCase):
         self.assertEqual(self.msb.docs, {})
         self.msb.clear()
     
+    def test_remove_objects(self):
+        self.msb.docs = {
+            'core.mockmodel.1': 'Indexed!\n1',
+            'core.mockmodel.2': 'Indexed!\n2',
+            'core.mockmodel.20': 'Indexed!\n20',
+        }
+        
+        mock = MockModel()
+        mock.pk = 20
+        
+        self.mi.remove_objects([mock, 'core.mockmodel.1'])
+        self.assertEqual(self.msb.docs, {'core.mockmodel.2': 'Indexed!\n2'})
+        self.msb.clear()
+    
     def test_clear(self):
         self.msb.docs = {
             'core.mockmodel.1': 'Indexed!\n1',
@@ -236,6 +292,44 @@ class SearchIndexTestCase(TestCase):
         prepared_data = self.cnmi.prepare(mock)
         self.assertEqual(len(prepared_data), 4)
         self.assertEqual(sorted(prepared_data.keys()), ['content', 'django_ct', 'django_id', 'id'])
+    
+    def test_prepare_plan(self):
+        mock = MockModel()
+        mock.pk = 20
+        mock.author = 'daniel%s' % mock.id
+        mock.pub_date = datetime.datetime(2009, 1, 31, 4, 19, 0)
+        
+        # The plan is built on the first ``prepare``.
+        self.assertEqual(self.cmi._prepare_plan_fields, None)
+        self.cmi.prepare(mock)
+        self.cnmi.prepare(mock)
+        self.assertEqual(sorted([field_name for field_name, prepare in self.cmi._prepare_plan]), ['author', 'content', 'extra', 'hello', 'pub_date'])
+        self.assertEqual([field_name for field_name, prepare in self.cmi._prepare_overrides], ['author'])
+        self.assertEqual(self.cmi._null_fields, [])
+        self.assertEqual(self.cnmi._null_fields, ['author'])
+        
+        # It's only built once.
+        prepare_plan = self.cmi._prepare_plan
+        self.cmi.prepare(mock)
+        self.assert_(self.cmi._prepare_plan is prepare_plan)
+        
+        # Changes to the fields are picked up by the next ``prepare``.
+        self.cnmi.fields = self.cnmi.fields.copy()
+        del(self.cnmi.fields['author'])
+        self.assertEqual(sorted(self.cnmi.prepare(mock).keys()), ['content', 'django_ct', 'django_id', 'id'])
+        self.assertEqual(self.cnmi._null_fields, [])
+        self.assertEqual([field_name for field_name, prepare in self.cnmi._prepare_plan], ['content'])
+        
+        self.cnmi.fields['author'] = indexes.CharField(model_attr='author')
+        self.assertEqual(self.cnmi.prepare(mock)['author'], u'daniel20')
+        self.assertEqual(sorted([field_name for field_name, prepare in self.cnmi._prepare_plan]), ['author', 'content'])
+        
+        # Plain dicts work too, and are tracked from then on.
+        self.cnmi.fields = {'content': self.cnmi.fields['content']}
+        self.assertEqual(sorted(self.cnmi.prepare(mock).keys()), ['content', 'django_ct', 'django_id', 'id'])
+        self.assert_(isinstance(self.cnmi.fields, indexes.SearchFieldDict))
+        self.cnmi.fields.update({'author': indexes.CharField(model_attr='author')})
+        self.assertEqual(self.cnmi.prepare(mock)['author'], u'daniel20')
 
 
 class BasicModelSearchIndex(indexes.ModelSearchIndex):
@@ -260,6 +354,12 @@ class FieldsWithOverrideModelSearchIndex(indexes.ModelSearchIndex):
         fields = ['author', 'foo']
 
 
+class TextAttrsModelSearchIndex(indexes.ModelSearchIndex):
+    class Meta:
+        fields = ['author']
+        text_attrs = ['author', 'tag__name']
+
+
 class ModelSearchIndexTestCase(TestCase):
     def setUp(self):
         super(ModelSearchIndexTestCase, self).setUp()
@@ -268,6 +368,7 @@ class ModelSearchIndexTestCase(TestCase):
         self.fmsi = FieldsModelSearchIndex(MockModel, backend=self.msb)
         self.emsi = ExcludesModelSearchIndex(MockModel, backend=self.msb)
         self.fwomsi = FieldsWithOverrideModelSearchIndex(MockModel, backend=self.msb)
+        self.tamsi = TextAttrsModelSearchIndex(MockModel, backend=self.msb)
     
     def test_basic(self):
         self.assertEqual(len(self.bmsi.fields), 4)
@@ -309,3 +410,41 @@ class ModelSearchIndexTestCase(TestCase):
         self.assert_(isinstance(self.fwomsi.fields['foo'], indexes.IntegerField))
         self.assert_('text' in self.fwomsi.fields)
         self.assert_(isinstance(self.fwomsi.fields['text'], indexes.CharField))
+    
+    def test_text_attrs(self):
+        self.assertEqual(self.tamsi.fields['text'].text_attrs, ['author', 'tag__name'])
+        self.assertEqual(self.tamsi.get_select_related(), ['tag'])
+        
+        # The field shared with other indexes is left alone.
+        self.assertEqual(self.bmsi.fields['text'].text_attrs, None)
+        self.assertEqual(indexes.ModelSearchIndex.fields['text'].text_attrs, None)
+        
+        mock = MockModel.objects.get(pk=3)
+        self.assertEqual(self.tamsi.prepare(mock)['text'], u'daniel3\nsecondary')
+        self.assertEqual(self.bmsi.prepare(mock)['text'], u'Indexed!\n3')
+
+
+class RealTimeSearchIndexTestCase(TestCase):
+    def setUp(self):
+        super(RealTimeSearchIndexTestCase, self).setUp()
+        self.msb = MockSearchBackend()
+        self.rtmi = GoodRealTimeMockSearchIndex(MockModel, backend=self.msb)
+        self.rtmi._setup_save(MockModel)
+        self.rtmi._setup_delete(MockModel)
+    
+    def tearDown(self):
+        self.rtmi._teardown_save(MockModel)
+        self.rtmi._teardown_delete(MockModel)
+        super(RealTimeSearchIndexTestCase, self).tearDown()
+    
+    def test_signals(self):
+        # The model signals must not be shadowed by ``haystack.fields``.
+        self.assert_(indexes.signals is models.signals)
+        
+        mock = MockModel(author='daniel10', pub_date=datetime.datetime(2009, 3, 17, 6, 0))
+        mock.save()
+        self.assertEqual(self.msb.docs.keys(), ['core.mockmodel.%s' % mock.pk])
+        self.assertEqual(self.msb.docs['core.mockmodel.%s' % mock.pk]['author'], u'daniel10')
+        
+        mock.delete()
+        self.assertEqual(self.msb.docs, {})
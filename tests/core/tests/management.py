@@ -0,0 +1,100 @@
+import itertools
+from django.test import TestCase
+from haystack import indexes
+from haystack.management.commands import update_index
+from haystack.sites import SearchSite
+from core.models import MockModel, CharPKMockModel
+from core.tests.mocks import MockSearchBackend
+
+
+class WorkersMockSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, model_attr='author')
+
+
+# Loaded by path (like ``--site``) in the workers.
+workers_site = SearchSite()
+workers_site.register(MockModel, WorkersMockSearchIndex)
+
+
+class InlinePool(object):
+    """Stands in for ``multiprocessing.Pool``, running the tasks in-process."""
+    def __init__(self, site_path):
+        update_index.init_worker(site_path)
+        update_index._worker_backend = self.backend = MockSearchBackend()
+    
+    def imap_unordered(self, func, tasks):
+        return itertools.imap(func, tasks)
+    
+    def close(self):
+        pass
+    
+    def join(self):
+        pass
+
+
+class InlinePoolCommand(update_index.Command):
+    def create_pool(self):
+        self.pool = InlinePool(self.site)
+        return self.pool
+
+
+class BuildPkRangesTestCase(TestCase):
+    def test_empty(self):
+        MockModel.objects.all().delete()
+        self.assertEqual(list(update_index.build_pk_ranges(MockModel.objects.order_by('pk'), 2)), [])
+    
+    def test_ranges(self):
+        qs = MockModel.objects.order_by('pk')
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 1)), [(None, 1), (1, 2), (2, 3)])
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 2)), [(None, 2), (2, None)])
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 3)), [(None, 3)])
+    
+    def test_larger_than_table(self):
+        qs = MockModel.objects.order_by('pk')
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 1000)), [(None, None)])
+    
+    def test_sparse_pks(self):
+        MockModel.objects.filter(pk=2).delete()
+        mock = MockModel(author='daniel100')
+        mock.pk = 100
+        mock.save()
+        
+        qs = MockModel.objects.order_by('pk')
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 1)), [(None, 1), (1, 3), (3, 100)])
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 2)), [(None, 3), (3, None)])
+    
+    def test_non_integer_pks(self):
+        for key in ('d', 'a', 'c', 'b', 'e'):
+            CharPKMockModel.objects.create(key=key)
+        
+        qs = CharPKMockModel.objects.order_by('pk')
+        self.assertEqual(list(update_index.build_pk_ranges(qs, 2)), [(None, u'b'), (u'b', u'd'), (u'd', None)])
+        self.assertEqual(list(update_index.build_pk_ranges(qs.filter(key__gt='c'), 5)), [(None, None)])
+
+
+class UpdateIndexWorkersTestCase(TestCase):
+    def tearDown(self):
+        update_index._worker_site = None
+        update_index._worker_backend = None
+        super(UpdateIndexWorkersTestCase, self).tearDown()
+    
+    def test_update_worker(self):
+        InlinePool('core.tests.management.workers_site')
+        msb = update_index._worker_backend
+        
+        pid, lower, upper, indexed, elapsed = update_index.update_worker(('core', 'mockmodel', 1, None, {}))
+        self.assertEqual((lower, upper, indexed), (1, None, 2))
+        self.assertEqual(sorted(msb.docs.keys()), ['core.mockmodel.2', 'core.mockmodel.3'])
+        
+        pid, lower, upper, indexed, elapsed = update_index.update_worker(('core', 'mockmodel', None, 3, {'author': 'daniel1'}))
+        self.assertEqual(indexed, 1)
+        self.assertEqual(sorted(msb.docs.keys()), ['core.mockmodel.1', 'core.mockmodel.2', 'core.mockmodel.3'])
+    
+    def test_workers(self):
+        command = InlinePoolCommand()
+        command.handle(site='core.tests.management.workers_site', workers=2, batchsize=2, verbosity=0)
+        self.assertEqual(sorted(command.pool.backend.docs.keys()), ['core.mockmodel.1', 'core.mockmodel.2', 'core.mockmodel.3'])
+        self.assertEqual(command.pool.backend.docs['core.mockmodel.2']['text'], u'daniel2')
+    
+    def test_negative_workers(self):
+        self.assertRaises(update_index.CommandError, update_index.Command().handle, workers=-1, verbosity=0)
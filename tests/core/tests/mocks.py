@@ -16,7 +16,8 @@ MOCK_SEARCH_RESULTS = [MockSearchResult('core', 'MockModel', i, 1 - (i / 100.0))
 
 
 class MockSearchBackend(BaseSearchBackend):
-    def __init__(self):
+    def __init__(self, site=None):
+        super(MockSearchBackend, self).__init__(site=site)
         self.docs = {}
     
     def update(self, index, iterable, commit=True):
@@ -58,6 +59,10 @@ class MockSearchBackend(BaseSearchBackend):
             'hits': hits,
         }
     
+    def count(self, query_string, **kwargs):
+        # The hits depend on the results returned, so fetch them all.
+        return self.search(query_string, **kwargs)['hits']
+    
     def more_like_this(self, model_instance, additional_query_string=None):
         return {
             'results': MOCK_SEARCH_RESULTS,
@@ -1,6 +1,10 @@
+import base64
+import copy
 import logging
+import pickle
 from django.test import TestCase
-from haystack.models import SearchResult
+from haystack.fields import PickleField
+from haystack.models import DeferredValue, SearchResult
 from core.models import MockModel
 from core.tests.mocks import MockSearchResult
 
@@ -127,3 +131,103 @@ class SearchResultTestCase(TestCase):
         self.assertEqual(awol2.verbose_name_plural, u'')
         self.assertEqual(awol2.stored, None)
         self.assertEqual(len(CaptureHandler.logs_seen), 9)
+    
+    def test_schema_class_results(self):
+        results = SearchResult.build_results([
+            ('core', 'mockmodel', '1', 2, {'stored': 'I am stored data.'}),
+            ('core', 'mockmodel', '2', 3, {'stored': 'Also stored.'}),
+            ('core', 'mockmodel', '3', 4, {'stored': 'More.', 'pk': 'nope', 'log': 'nope', 'extra': 1}),
+        ])
+        self.assertEqual([result.pk for result in results], ['1', '2', '3'])
+        self.assertEqual([result.score for result in results], [2, 3, 4])
+        self.assertEqual(results[0].__dict__, {'app_label': 'core', 'model_name': 'mockmodel', 'pk': '1', 'score': 2, 'stored': 'I am stored data.'})
+        self.assertEqual(results[0].app_label, 'core')
+        self.assertEqual(results[0].model_name, 'mockmodel')
+        self.assertEqual(results[0].model, MockModel)
+        self.assertEqual(results[0].stored, 'I am stored data.')
+        self.assertEqual(results[0].get_additional_fields(), {'stored': 'I am stored data.'})
+        self.assertEqual(results[2].get_additional_fields(), {'stored': 'More.', 'extra': 1})
+        self.assertEqual(repr(results[0]), "<SearchResult: core.mockmodel (pk='1')>")
+        
+        # Results with the same fields share a class.
+        self.assert_(isinstance(results[0], SearchResult))
+        self.assert_(type(results[0]) is type(results[1]))
+        self.assert_(type(results[0]) is not type(results[2]))
+    
+    def test_pickling(self):
+        results = [self.extra_data_sr, SearchResult.build_results([('core', 'mockmodel', '1', 2, {'stored': 'I am stored data.'})])[0]]
+        
+        for result in results:
+            for clone in (pickle.loads(pickle.dumps(result)), pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)), copy.copy(result), copy.deepcopy(result)):
+                self.assert_(type(clone) is type(result))
+                self.assertEqual(clone.pk, result.pk)
+                self.assertEqual(clone.score, result.score)
+                self.assertEqual(clone.get_additional_fields(), result.get_additional_fields())
+    
+    def test_plain_attribute_access(self):
+        results = SearchResult.build_results([
+            ('core', 'mockmodel', '1', 2, {'title': 'Hello', 'author': 'daniel', 'author0_0_0name': 'Daniel'}),
+        ])
+        results.append(MockSearchResult('core', 'mockmodel', '1', 2, title='Hello', author='daniel', author0_0_0name='Daniel'))
+        
+        for result in results:
+            # Plain fields come back as they are.
+            self.assert_(type(result.title) is str)
+            self.assertEqual(result.title, 'Hello')
+            self.assert_(type(result.pk) is str)
+            
+            # Denormalized ones still allow dotted access.
+            self.assertEqual(result.author, 'daniel')
+            self.assertEqual(result.author.name, 'Daniel')
+            self.assertEqual(result.author__name, 'Daniel')
+            
+            # As do ones added after the fact.
+            result.title0_0_0slug = 'hello'
+            self.assertEqual(result.title.slug, 'hello')
+            
+            # Bookkeeping attributes aren't mistaken for denormalized ones.
+            result._object = MockModel.objects.get(pk=1)
+            self.assert_(result.model is MockModel)
+            self.assertEqual(result._denorm_keys, ('author0_0_0name', 'title0_0_0slug'))
+            self.assertEqual(result.has_denorm_attrs('title'), True)
+            self.assertEqual(result.has_denorm_attrs('pk'), False)
+            self.assertEqual(result.author.name, 'Daniel')
+    
+    def test_values_converted_on_access(self):
+        class CountingPickleField(PickleField):
+            conversions = 0
+            
+            def convert(self, value):
+                CountingPickleField.conversions += 1
+                return super(CountingPickleField, self).convert(value)
+        
+        field = CountingPickleField()
+        raw = base64.b64encode(pickle.dumps({'tags': ['a', 'b']}))
+        results = SearchResult.build_results([
+            ('core', 'mockmodel', '1', 2, {'data': DeferredValue(field, raw), 'author': DeferredValue(field, raw), 'author0_0_0name': DeferredValue(field, raw)}),
+        ])
+        result = results[0]
+        self.assertEqual(CountingPickleField.conversions, 0)
+        
+        # Converted the first time it's read, then kept.
+        self.assertEqual(result.data, {'tags': ['a', 'b']})
+        self.assertEqual(CountingPickleField.conversions, 1)
+        self.assert_(result.data is result.data)
+        self.assertEqual(CountingPickleField.conversions, 1)
+        
+        # Dotted access converts what it touches.
+        self.assertEqual(result.author__name, {'tags': ['a', 'b']})
+        self.assertEqual(CountingPickleField.conversions, 2)
+        self.assertEqual(result.author, {'tags': ['a', 'b']})
+        self.assertEqual(CountingPickleField.conversions, 3)
+        
+        # Copies stay lazy, pickles carry the converted values.
+        fresh = SearchResult.build_results([('core', 'mockmodel', '1', 2, {'data': DeferredValue(field, raw)})])[0]
+        clone = copy.copy(fresh)
+        self.assertEqual(CountingPickleField.conversions, 3)
+        self.assertEqual(clone.data, {'tags': ['a', 'b']})
+        self.assertEqual(CountingPickleField.conversions, 4)
+        unpickled = pickle.loads(pickle.dumps(fresh, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(CountingPickleField.conversions, 5)
+        self.assertEqual(unpickled.__dict__['data'], {'tags': ['a', 'b']})
+        self.assertEqual(unpickled.get_additional_fields(), {'data': {'tags': ['a', 'b']}})
@@ -8,10 +8,10 @@ from haystack.backends.dummy_backend import SearchBackend as DummySearchBackend
 from haystack.backends.dummy_backend import SearchQuery as DummySearchQuery
 from haystack.exceptions import HaystackError
 from haystack.models import SearchResult
-from haystack.query import SearchQuerySet, EmptySearchQuerySet
+from haystack.query import ResultCache, SearchQuerySet, EmptySearchQuerySet, ValuesSearchQuerySet, ValuesListSearchQuerySet
 from haystack.sites import SearchSite
 from core.models import MockModel, AnotherMockModel
-from core.tests.mocks import MockSearchQuery, MockSearchBackend, MixedMockSearchBackend, MOCK_SEARCH_RESULTS
+from core.tests.mocks import MockSearchQuery, MockSearchBackend, MixedMockSearchBackend, MockSearchResult, MOCK_SEARCH_RESULTS
 
 
 class SQTestCase(TestCase):
@@ -172,6 +172,16 @@ class BaseSearchQueryTestCase(TestCase):
         self.bsq.add_narrow_query('moof:baz')
         self.assertEqual(self.bsq.narrow_queries, set(['foo:bar', 'moof:baz']))
     
+    def test_add_field(self):
+        self.assertEqual(self.bsq.build_params().get('fields'), None)
+        
+        self.bsq.add_field('title')
+        self.bsq.add_field('pub_date')
+        self.bsq.add_field('title')
+        self.assertEqual(self.bsq.fields, ['title', 'pub_date'])
+        self.assertEqual(self.bsq.build_params()['fields'], ['title', 'pub_date'])
+        self.assertEqual(self.bsq._clone().fields, ['title', 'pub_date'])
+    
     def test_run(self):
         # Stow.
         old_site = haystack.site
@@ -185,6 +195,36 @@ class BaseSearchQueryTestCase(TestCase):
         
         # Restore.
         haystack.site = old_site
+    
+    def test_run_count(self):
+        # Stow.
+        old_site = haystack.site
+        test_site = SearchSite()
+        test_site.register(MockModel)
+        haystack.site = test_site
+        
+        msq = MockSearchQuery(backend=MockSearchBackend())
+        self.assertEqual(msq.get_count(), 100)
+        # Only the count was fetched.
+        self.assertEqual(msq._results, None)
+        self.assertEqual(msq.has_run(), False)
+        self.assertEqual(len(msq.get_results()), 100)
+        
+        # The default asks the backend for no results.
+        self.assertEqual(DummySearchBackend().count('foo'), 0)
+        
+        # Narrowed raw searches get counted with their narrowing.
+        msb = MockSearchBackend()
+        counted = []
+        msb.count = lambda query_string, **kwargs: counted.append((query_string, kwargs)) or 0
+        msq = MockSearchQuery(backend=msb)
+        msq.raw_search('foo', bar='baz')
+        msq.add_narrow_query('moof:1')
+        self.assertEqual(msq.get_count(), 0)
+        self.assertEqual(counted, [('foo', {'narrow_queries': set(['moof:1']), 'bar': 'baz'})])
+        
+        # Restore.
+        haystack.site = old_site
 
 
     
@@ -215,7 +255,29 @@ class BaseSearchQueryTestCase(TestCase):
         self.assertEqual(len(clone.narrow_queries), 1)
         self.assertEqual(clone.start_offset, self.bsq.start_offset)
         self.assertEqual(clone.end_offset, self.bsq.end_offset)
-        self.assertEqual(clone.backend, self.bsq.backend)
+        self.assert_(clone.backend is self.bsq.backend)
+    
+    def test_shared_backend(self):
+        # Stow.
+        old_site = haystack.site
+        test_site = SearchSite()
+        haystack.site = test_site
+        
+        try:
+            backend = DummySearchBackend.shared()
+            self.assert_(backend is DummySearchBackend.shared())
+            self.assert_(backend is DummySearchBackend.shared(site=test_site))
+            self.assert_(backend.site is test_site)
+            
+            # Each site & backend class gets its own.
+            self.assert_(DummySearchBackend.shared(site=SearchSite()) is not backend)
+            self.assert_(backends.BaseSearchBackend.shared() is not backend)
+            
+            # Queries use it unless they're given a backend.
+            self.assert_(DummySearchQuery().backend is backend)
+            self.assert_(DummySearchQuery()._clone().backend is backend)
+        finally:
+            haystack.site = old_site
     
     def test_log_query(self):
         backends.reset_search_queries()
@@ -254,6 +316,50 @@ class BaseSearchQueryTestCase(TestCase):
 
 
 
+class ResultCacheTestCase(TestCase):
+    def test_store(self):
+        cache = ResultCache(5000000)
+        self.assertEqual(len(cache), 5000000)
+        self.assertEqual(cache.filled_to, 0)
+        self.assertEqual(cache.is_missing(0, 10), True)
+        
+        cache.store(0, range(1, 11))
+        self.assertEqual(cache.filled_to, 10)
+        self.assertEqual(len(cache._pages), 1)
+        self.assertEqual(cache[0:10], range(1, 11))
+        self.assertEqual(cache[9], 10)
+        self.assertEqual(cache[10], None)
+        self.assertEqual(cache.is_missing(0, 10), False)
+        self.assertEqual(cache.is_missing(5, 15), True)
+        self.assertRaises(IndexError, cache.__getitem__, 5000000)
+        
+        # A window further along leaves a gap.
+        cache.store(4999995, range(5))
+        self.assertEqual(len(cache._pages), 2)
+        self.assertEqual(cache.filled_to, 10)
+        self.assertEqual(cache[4999993:], [None, None, 0, 1, 2, 3, 4])
+        self.assertEqual(cache.is_missing(4999995, None), False)
+        self.assertEqual(cache.is_full(), False)
+    
+    def test_is_full(self):
+        cache = ResultCache()
+        self.assertEqual(cache, [])
+        self.assertEqual(cache.is_full(), False)
+        
+        cache = ResultCache(250)
+        cache.store(100, range(100, 250))
+        self.assertEqual(cache.filled_to, 0)
+        cache.store(0, range(100))
+        self.assertEqual(cache.filled_to, 250)
+        self.assertEqual(cache.is_full(), True)
+        self.assertEqual(list(cache), range(250))
+        
+        # Storing past the end grows it, as slice assignment on a list would.
+        cache.store(250, [250])
+        self.assertEqual(len(cache), 251)
+        self.assertEqual(cache.is_full(), True)
+
+
 class SearchQuerySetTestCase(TestCase):
     def setUp(self):
         super(SearchQuerySetTestCase, self).setUp()
@@ -300,7 +406,8 @@ class SearchQuerySetTestCase(TestCase):
         msqs = self.msqs.all()
         results = [result for result in msqs]
         self.assertEqual(results, MOCK_SEARCH_RESULTS)
-        self.assertEqual(len(backends.queries), 10)
+        # 10, 20, 40 & 80 results at a time.
+        self.assertEqual(len(backends.queries), 4)
     
     def test_slice(self):
         backends.reset_search_queries()
@@ -324,7 +431,7 @@ class SearchQuerySetTestCase(TestCase):
         for offset, result in enumerate(results._manual_iter()):
             self.assertEqual(result, MOCK_SEARCH_RESULTS[offset])
         
-        self.assertEqual(len(backends.queries), 10)
+        self.assertEqual(len(backends.queries), 4)
         
         backends.reset_search_queries()
         self.assertEqual(len(backends.queries), 0)
@@ -333,8 +440,58 @@ class SearchQuerySetTestCase(TestCase):
         # This will hang indefinitely if broken.
         results = self.mmsqs.all()
         loaded = [result.pk for result in results._manual_iter()]
-        self.assertEqual(loaded, [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 15, 16, 17, 18, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29])
-        self.assertEqual(len(backends.queries), 8)
+        self.assertEqual(loaded, [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29])
+        self.assertEqual(len(backends.queries), 4)
+    
+    def test_next_load_size(self):
+        results = self.msqs.all()
+        self.assertEqual([results._next_load_size() for i in xrange(9)], [10, 20, 40, 80, 160, 320, 640, 1000, 1000])
+        
+        old_max = getattr(settings, 'HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY', None)
+        settings.HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY = 25
+        results = self.msqs.all()
+        self.assertEqual([results._next_load_size() for i in xrange(4)], [10, 20, 25, 25])
+        
+        if old_max is None:
+            del(settings.HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY)
+        else:
+            settings.HAYSTACK_ITERATOR_MAX_LOAD_PER_QUERY = old_max
+    
+    def test_iterator(self):
+        backends.reset_search_queries()
+        self.assertEqual(len(backends.queries), 0)
+        results = self.msqs.all()
+        self.assertEqual(list(results.iterator()), MOCK_SEARCH_RESULTS)
+        self.assertEqual(len(backends.queries), 4)
+        # Nothing gets cached.
+        self.assertEqual(len(results._result_cache), 0)
+        
+        backends.reset_search_queries()
+        self.assertEqual(list(results.iterator(chunk_size=30)), MOCK_SEARCH_RESULTS)
+        self.assertEqual(len(backends.queries), 4)
+        
+        # Results from models not in the site are skipped.
+        loaded = [result.pk for result in self.mmsqs.all().iterator(chunk_size=10)]
+        self.assertEqual(loaded, [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29])
+        
+        self.assertEqual(list(self.bsqs.iterator()), [])
+    
+    def test_scan(self):
+        backends.reset_search_queries()
+        self.assertEqual(len(backends.queries), 0)
+        # The mock backend ignores filters, so only the first page is checked.
+        results = self.msqs.all().scan(page_size=200)
+        self.assertEqual(list(results), MOCK_SEARCH_RESULTS)
+        self.assertEqual(len(backends.queries), 1)
+        
+        self.assertRaises(HaystackError, list, self.msqs.order_by('pub_date', 'title').scan())
+        self.assertEqual(list(self.bsqs.scan()), [])
+        
+        result = MockSearchResult('core', 'mockmodel', 5, 1.0, pub_date=datetime.date(2009, 2, 25))
+        self.assertEqual(repr(self.msqs._seek_filter(None, False, result)), '<SQ: AND id__gt=core.mockmodel.5>')
+        self.assertEqual(repr(self.msqs._seek_filter('pub_date', False, result)), '<SQ: OR (pub_date__gt=2009-02-25 OR (pub_date__exact=2009-02-25 AND id__gt=core.mockmodel.5))>')
+        self.assertEqual(repr(self.msqs._seek_filter('pub_date', True, result)), '<SQ: OR (pub_date__lt=2009-02-25 OR (pub_date__exact=2009-02-25 AND id__lt=core.mockmodel.5))>')
+        self.assertRaises(HaystackError, self.msqs._seek_filter, 'title', False, result)
     
     def test_fill_cache(self):
         backends.reset_search_queries()
@@ -383,7 +540,7 @@ class SearchQuerySetTestCase(TestCase):
         results = self.msqs.all()
         fire_the_iterator_and_fill_cache = [result for result in results]
         self.assertEqual(results._cache_is_full(), True)
-        self.assertEqual(len(backends.queries), 10)
+        self.assertEqual(len(backends.queries), 4)
     
     def test_all(self):
         sqs = self.bsqs.all()
@@ -444,6 +601,37 @@ class SearchQuerySetTestCase(TestCase):
         self.assertEqual(len(self.bsqs.raw_search('foo')), 0)
         self.assertEqual(len(self.bsqs.raw_search('(content__exact hello AND content__exact world)')), 1)
     
+    def test_only(self):
+        sqs = self.msqs.only('title', 'pub_date')
+        self.assert_(isinstance(sqs, SearchQuerySet))
+        self.assertEqual(sqs.query.fields, ['title', 'pub_date'])
+        self.assertEqual(self.msqs.query.fields, [])
+    
+    def test_values(self):
+        sqs = self.msqs.values('pk', 'score')
+        self.assert_(isinstance(sqs, ValuesSearchQuerySet))
+        self.assertEqual(sqs.query.fields, ['pk', 'score'])
+        self.assertEqual(sqs[0], {'pk': 0, 'score': 1.0})
+        self.assertEqual(sqs[1:3], [{'pk': 1, 'score': 0.99}, {'pk': 2, 'score': 0.98}])
+        self.assertEqual(len([result for result in sqs]), 100)
+        self.assertEqual(list(sqs.iterator())[5], {'pk': 5, 'score': 0.95})
+        # Still values after chaining.
+        self.assertEqual(sqs.filter(content='foo')[0], {'pk': 0, 'score': 1.0})
+    
+    def test_values_list(self):
+        sqs = self.msqs.values_list('pk', 'score')
+        self.assert_(isinstance(sqs, ValuesListSearchQuerySet))
+        self.assertEqual(sqs[0], (0, 1.0))
+        self.assertEqual(sqs[1:3], [(1, 0.99), (2, 0.98)])
+        
+        sqs = self.msqs.values_list('pk', flat=True)
+        self.assertEqual(sqs[0:5], [0, 1, 2, 3, 4])
+        self.assertEqual(list(sqs.order_by('pk')), range(100))
+        
+        self.assertRaises(TypeError, self.msqs.values_list)
+        self.assertRaises(TypeError, self.msqs.values_list, 'pk', 'score', flat=True)
+        self.assertRaises(TypeError, self.msqs.values_list, 'pk', flatten=True)
+    
     def test_load_all(self):
         # If nothing is registered, you get nothing.
         haystack.site.unregister(MockModel)
@@ -0,0 +1,150 @@
+from django.test import TestCase
+import haystack.query_cache
+from haystack.query_cache import LocMemQueryCache, invalidate_model
+from haystack.sites import SearchSite
+from core.models import MockModel, AnotherMockModel
+from core.tests.mocks import MockSearchBackend, MockSearchQuery
+
+
+class CountingMockSearchBackend(MockSearchBackend):
+    def __init__(self):
+        super(CountingMockSearchBackend, self).__init__()
+        self.searches = 0
+    
+    def search(self, query_string, **kwargs):
+        self.searches += 1
+        return super(CountingMockSearchBackend, self).search(query_string, **kwargs)
+
+
+class LocMemQueryCacheTestCase(TestCase):
+    def setUp(self):
+        super(LocMemQueryCacheTestCase, self).setUp()
+        self.cache = LocMemQueryCache(timeout=60, max_size=3)
+        self.backend = MockSearchBackend()
+    
+    def test_make_key(self):
+        key = self.cache.make_key(self.backend, ('search', 'foo', {'start_offset': 0, 'end_offset': 10}))
+        self.assertEqual(key, self.cache.make_key(self.backend, ('search', 'foo', {'end_offset': 10, 'start_offset': 0})))
+        self.assertNotEqual(key, self.cache.make_key(self.backend, ('search', 'bar', {'start_offset': 0, 'end_offset': 10})))
+        self.assertNotEqual(key, self.cache.make_key(self.backend, ('search', 'foo', {'start_offset': 0, 'end_offset': 10}), set([MockModel])))
+        
+        # Model order doesn't matter.
+        self.assertEqual(self.cache.make_key(self.backend, 'foo', [MockModel, AnotherMockModel]), self.cache.make_key(self.backend, 'foo', set([AnotherMockModel, MockModel])))
+        
+        # Backends for sites with other models registered get keys of their own.
+        mock_site = SearchSite()
+        mock_site.register(MockModel)
+        same_site = SearchSite()
+        same_site.register(MockModel)
+        another_site = SearchSite()
+        another_site.register(AnotherMockModel)
+        key = self.cache.make_key(MockSearchBackend(site=mock_site), 'foo')
+        self.assertEqual(key, self.cache.make_key(MockSearchBackend(site=same_site), 'foo'))
+        self.assertNotEqual(key, self.cache.make_key(MockSearchBackend(site=another_site), 'foo'))
+        self.assertNotEqual(key, self.cache.make_key(CountingMockSearchBackend(), 'foo'))
+    
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.set('a', {'results': [1, 2], 'hits': 2})
+        self.assertEqual(self.cache.get('a'), {'results': [1, 2], 'hits': 2})
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+        
+        # Changing what comes back leaves the cached copy alone.
+        self.cache.get('a')['results'].append(3)
+        self.assertEqual(self.cache.get('a')['results'], [1, 2])
+    
+    def test_lru(self):
+        self.cache.set('a', {'hits': 1})
+        self.cache.set('b', {'hits': 2})
+        self.cache.set('c', {'hits': 3})
+        
+        # Touch 'a', so 'b' is the least recently used.
+        self.cache.get('a')
+        self.cache.set('d', {'hits': 4})
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), {'hits': 1})
+        self.assertEqual(self.cache.get('d'), {'hits': 4})
+    
+    def test_lru_many(self):
+        self.cache.max_size = 100
+        
+        for i in xrange(250):
+            self.cache.set(i, {'hits': i})
+            
+            if i % 10 == 0:
+                # Keep touching the first one, so it stays.
+                self.cache.get(0)
+        
+        self.assertEqual(len(self.cache), 100)
+        self.assertEqual(self.cache.get(0), {'hits': 0})
+        self.assertEqual(self.cache.get(150), None)
+        self.assertEqual(self.cache.get(151), {'hits': 151})
+        self.assertEqual(self.cache.get(249), {'hits': 249})
+        
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.get(249), None)
+    
+    def test_timeout(self):
+        self.cache.timeout = -1
+        self.cache.set('a', {'hits': 1})
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+    
+    def test_invalidate(self):
+        mock_key = self.cache.make_key(self.backend, 'foo', [MockModel])
+        another_key = self.cache.make_key(self.backend, 'foo', [AnotherMockModel])
+        all_key = self.cache.make_key(self.backend, 'foo')
+        self.cache.invalidate(MockModel)
+        self.assertNotEqual(self.cache.make_key(self.backend, 'foo', [MockModel]), mock_key)
+        self.assertEqual(self.cache.make_key(self.backend, 'foo', [AnotherMockModel]), another_key)
+        self.assertNotEqual(self.cache.make_key(self.backend, 'foo'), all_key)
+
+
+class QueryCacheSearchQueryTestCase(TestCase):
+    def setUp(self):
+        super(QueryCacheSearchQueryTestCase, self).setUp()
+        self.old_query_cache = haystack.query_cache._query_cache
+        self.old_query_cache_loaded = haystack.query_cache._query_cache_loaded
+        haystack.query_cache._query_cache = LocMemQueryCache()
+        haystack.query_cache._query_cache_loaded = True
+        self.backend = CountingMockSearchBackend()
+    
+    def tearDown(self):
+        haystack.query_cache._query_cache = self.old_query_cache
+        haystack.query_cache._query_cache_loaded = self.old_query_cache_loaded
+        super(QueryCacheSearchQueryTestCase, self).tearDown()
+    
+    def run_query(self, query_string='foo', models=None):
+        query = MockSearchQuery(backend=self.backend)
+        query.raw_search(query_string)
+        
+        for model in models or []:
+            query.add_model(model)
+        
+        query.run_raw()
+        return query
+    
+    def test_run(self):
+        first = self.run_query()
+        self.assertEqual(self.backend.searches, 1)
+        
+        second = self.run_query()
+        self.assertEqual(self.backend.searches, 1)
+        self.assertEqual(second._hit_count, first._hit_count)
+        self.assertEqual([result.pk for result in second._results], [result.pk for result in first._results])
+        
+        self.run_query('bar')
+        self.assertEqual(self.backend.searches, 2)
+        self.assertEqual(haystack.query_cache._query_cache.stats(), {'hits': 1, 'misses': 2})
+    
+    def test_invalidate_model(self):
+        self.run_query(models=[MockModel])
+        self.run_query(models=[AnotherMockModel])
+        self.assertEqual(self.backend.searches, 2)
+        
+        invalidate_model(MockModel)
+        self.run_query(models=[MockModel])
+        self.run_query(models=[AnotherMockModel])
+        self.assertEqual(self.backend.searches, 3)
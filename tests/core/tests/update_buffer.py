@@ -0,0 +1,141 @@
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from django.test import TestCase
+from haystack import indexes
+from haystack.sites import SearchSite
+from haystack.update_buffer import UpdateBuffer, buffer_updates, get_buffer
+from core.models import MockModel
+from core.tests.mocks import MockSearchBackend
+
+
+class CountingMockSearchBackend(MockSearchBackend):
+    def __init__(self):
+        super(CountingMockSearchBackend, self).__init__()
+        self.updates = []
+        self.removed = []
+    
+    def update(self, index, iterable, commit=True):
+        iterable = list(iterable)
+        self.updates.append([obj.pk for obj in iterable])
+        super(CountingMockSearchBackend, self).update(index, iterable, commit=commit)
+    
+    def remove(self, obj_or_string, commit=True):
+        self.removed.append(obj_or_string)
+
+
+class RealTimeMockSearchIndex(indexes.RealTimeSearchIndex):
+    text = indexes.CharField(document=True, model_attr='author')
+
+
+class UpdateBufferTestCase(TestCase):
+    def setUp(self):
+        super(UpdateBufferTestCase, self).setUp()
+        self.site = SearchSite()
+        self.site.register(MockModel, RealTimeMockSearchIndex)
+        self.index = self.site.get_index(MockModel)
+        self.index.backend = CountingMockSearchBackend()
+        self.old_buffer_updates = getattr(settings, 'HAYSTACK_BUFFER_UPDATES', False)
+    
+    def tearDown(self):
+        settings.HAYSTACK_BUFFER_UPDATES = self.old_buffer_updates
+        self.site.unregister(MockModel)
+        super(UpdateBufferTestCase, self).tearDown()
+    
+    def test_unbuffered(self):
+        mock = MockModel.objects.get(pk=1)
+        mock.save()
+        mock.save()
+        self.assertEqual(self.index.backend.updates, [[1], [1]])
+    
+    def test_coalescing(self):
+        update_buffer = UpdateBuffer()
+        mock = MockModel.objects.get(pk=1)
+        update_buffer.update(self.index, mock)
+        update_buffer.update(self.index, mock)
+        update_buffer.update(self.index, MockModel.objects.get(pk=2))
+        update_buffer.remove(self.index, MockModel.objects.get(pk=3))
+        update_buffer.update(self.index, MockModel.objects.get(pk=3))
+        update_buffer.remove(self.index, MockModel.objects.get(pk=2))
+        self.assertEqual(len(update_buffer), 3)
+        self.assertEqual(self.index.backend.updates, [])
+        
+        update_buffer.flush()
+        self.assertEqual(self.index.backend.updates, [[1, 3]])
+        self.assertEqual(self.index.backend.removed, [u'core.mockmodel.2'])
+        self.assertEqual(len(update_buffer), 0)
+    
+    def test_buffer_updates(self):
+        def save_often():
+            mock = MockModel.objects.get(pk=1)
+            
+            for i in xrange(5):
+                mock.save()
+            
+            nested()
+            self.assertEqual(self.index.backend.updates, [])
+            
+            new = MockModel(author='daniel4')
+            new.save()
+            self.new_pk = new.pk
+            new.delete()
+            self.assertEqual(self.index.backend.updates, [])
+            self.assertEqual(self.index.backend.removed, [])
+        
+        # Nested buffers leave the flush to the outermost one.
+        nested = buffer_updates(lambda: MockModel.objects.get(pk=2).save())
+        buffer_updates(save_often)()
+        self.assertEqual(self.index.backend.updates, [[1, 2]])
+        self.assertEqual(self.index.backend.removed, [u'core.mockmodel.%s' % self.new_pk])
+        self.assertEqual(get_buffer().is_active(), False)
+    
+    def test_buffer_updates_failure(self):
+        def fail():
+            MockModel.objects.get(pk=1).save()
+            raise ValueError("Rolled back.")
+        
+        self.assertRaises(ValueError, buffer_updates(fail))
+        self.assertEqual(self.index.backend.updates, [])
+        self.assertEqual(len(get_buffer()), 0)
+        self.assertEqual(get_buffer().is_active(), False)
+    
+    def test_nested_failure(self):
+        settings.HAYSTACK_BUFFER_UPDATES = True
+        
+        def fail():
+            MockModel.objects.get(pk=1).delete()
+            MockModel.objects.get(pk=2).save()
+            MockModel.objects.get(pk=3).save()
+            raise ValueError("Rolled back.")
+        
+        request_started.send(sender=self.__class__)
+        MockModel.objects.get(pk=1).save()
+        self.assertRaises(ValueError, buffer_updates(fail))
+        
+        # Only the failed function's changes are gone.
+        self.assertEqual(get_buffer().is_active(), True)
+        self.assertEqual(len(get_buffer()), 1)
+        
+        buffer_updates(lambda: MockModel.objects.get(pk=2).save())()
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.index.backend.updates, [[1, 2]])
+        self.assertEqual(self.index.backend.removed, [])
+        self.assertEqual(get_buffer().is_active(), False)
+    
+    def test_request_buffer(self):
+        settings.HAYSTACK_BUFFER_UPDATES = True
+        request_started.send(sender=self.__class__)
+        mock = MockModel.objects.get(pk=1)
+        mock.save()
+        mock.save()
+        self.assertEqual(self.index.backend.updates, [])
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.index.backend.updates, [[1]])
+        self.assertEqual(get_buffer().is_active(), False)
+        
+        # Off by default.
+        settings.HAYSTACK_BUFFER_UPDATES = False
+        request_started.send(sender=self.__class__)
+        mock.save()
+        self.assertEqual(self.index.backend.updates, [[1], [1]])
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.index.backend.updates, [[1], [1]])
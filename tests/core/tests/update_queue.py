@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from haystack import indexes
+from haystack.sites import SearchSite
+from haystack.update_queue import UpdateQueue, UPDATE, DELETE, collapse, process_queue
+from core.models import MockModel, AnotherMockModel
+from core.tests.mocks import MockSearchBackend
+
+
+class RecordingMockSearchBackend(MockSearchBackend):
+    def __init__(self):
+        super(RecordingMockSearchBackend, self).__init__()
+        self.removed = []
+    
+    def remove(self, obj_or_string, commit=True):
+        self.removed.append(obj_or_string)
+
+
+class QueuedMockSearchIndex(indexes.QueuedSearchIndex):
+    text = indexes.CharField(document=True, model_attr='author')
+    
+    def should_update(self, instance, **kwargs):
+        return instance.author != 'skip me'
+
+
+class UpdateQueueTestCase(TestCase):
+    def setUp(self):
+        super(UpdateQueueTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = UpdateQueue(os.path.join(self.tmpdir, 'queue', 'updates.db'))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(UpdateQueueTestCase, self).tearDown()
+    
+    def test_enqueue(self):
+        self.assertEqual(len(self.queue), 0)
+        self.queue.enqueue(MockModel, 1)
+        self.queue.enqueue(MockModel, 2, DELETE)
+        self.queue.enqueue(AnotherMockModel, 1, UPDATE)
+        self.assertEqual(len(self.queue), 3)
+        self.assertRaises(ValueError, self.queue.enqueue, MockModel, 1, 'frob')
+        
+        entries = self.queue.peek(2)
+        self.assertEqual([entry[1:5] for entry in entries], [(u'core', u'mockmodel', u'1', u'update'), (u'core', u'mockmodel', u'2', u'delete')])
+        
+        # Survives reopening.
+        self.assertEqual(len(UpdateQueue(self.queue.path)), 3)
+        
+        self.queue.acknowledge(entries[-1][0])
+        self.assertEqual([entry[1:5] for entry in self.queue.peek()], [(u'core', u'anothermockmodel', u'1', u'update')])
+        
+        self.queue.clear()
+        self.assertEqual(self.queue.peek(), [])
+    
+    def test_collapse(self):
+        entries = [
+            (1, 'core', 'mockmodel', '1', UPDATE, 1.0),
+            (2, 'core', 'mockmodel', '1', UPDATE, 2.0),
+            (3, 'core', 'mockmodel', '2', UPDATE, 3.0),
+            (4, 'core', 'mockmodel', '2', DELETE, 4.0),
+            (5, 'core', 'anothermockmodel', '2', DELETE, 5.0),
+        ]
+        self.assertEqual(collapse(entries), {
+            ('core', 'mockmodel'): {'1': UPDATE, '2': DELETE},
+            ('core', 'anothermockmodel'): {'2': DELETE},
+        })
+    
+    def test_queued_search_index(self):
+        site = SearchSite()
+        site.register(MockModel, QueuedMockSearchIndex)
+        index = site.get_index(MockModel)
+        index.queue = self.queue
+        index.backend = RecordingMockSearchBackend()
+        
+        try:
+            mock = MockModel.objects.get(pk=1)
+            mock.save()
+            mock.save()
+            MockModel.objects.get(pk=2).save()
+            
+            skipped = MockModel(author='skip me')
+            skipped.save()
+            
+            new = MockModel(author='daniel4')
+            new.save()
+            new_pk = new.pk
+            new.delete()
+            
+            # Nothing reached the backend yet.
+            self.assertEqual(index.backend.docs, {})
+            self.assertEqual(len(self.queue), 5)
+            
+            # The deleted object's update lands in the first batch, after
+            # it's gone from the database, so (with no grace period) it gets
+            # removed there too.
+            processed, updated, removed = process_queue(self.queue, site=site, batch_size=4, grace_period=0)
+            self.assertEqual((processed, updated, removed), (5, 2, 2))
+            self.assertEqual(sorted(index.backend.docs.keys()), [u'core.mockmodel.1', u'core.mockmodel.2'])
+            self.assertEqual(index.backend.removed, [u'core.mockmodel.%s' % new_pk] * 2)
+            self.assertEqual(len(self.queue), 0)
+        finally:
+            site.unregister(MockModel)
+    
+    def test_process_queue(self):
+        site = SearchSite()
+        site.register(MockModel, QueuedMockSearchIndex)
+        index = site.get_index(MockModel)
+        index.backend = RecordingMockSearchBackend()
+        
+        try:
+            self.queue.enqueue(MockModel, 1)
+            self.queue.enqueue(MockModel, 1)
+            # Gone from the database, so it gets removed instead.
+            self.queue.enqueue(MockModel, 999)
+            self.queue.enqueue(MockModel, 998, DELETE)
+            # Still in the database (the delete was rolled back), so it
+            # gets updated instead.
+            self.queue.enqueue(MockModel, 2, DELETE)
+            # Not registered, so skipped.
+            self.queue.enqueue(AnotherMockModel, 1)
+            
+            self.assertEqual(process_queue(self.queue, site=site, limit=2, grace_period=0), (2, 1, 0))
+            self.assertEqual(len(self.queue), 4)
+            self.assertEqual(process_queue(self.queue, site=site, grace_period=0), (4, 1, 2))
+            self.assertEqual(sorted(index.backend.docs.keys()), [u'core.mockmodel.1', u'core.mockmodel.2'])
+            self.assertEqual(sorted(index.backend.removed), [u'core.mockmodel.998', u'core.mockmodel.999'])
+            self.assertEqual(process_queue(self.queue, site=site), (0, 0, 0))
+        finally:
+            site.unregister(MockModel)
+    
+    def test_uncommitted_objects(self):
+        site = SearchSite()
+        site.register(MockModel, QueuedMockSearchIndex)
+        index = site.get_index(MockModel)
+        index.queue = self.queue
+        index.backend = RecordingMockSearchBackend()
+        
+        try:
+            # Queued on save, but processed before the transaction that
+            # created it has committed, so it isn't in the database yet.
+            self.queue.enqueue(MockModel, 999)
+            self.assertEqual(process_queue(self.queue, site=site), (1, 0, 0))
+            self.assertEqual(index.backend.removed, [])
+            self.assertEqual([entry[1:5] for entry in self.queue.peek()], [(u'core', u'mockmodel', u'999', u'update')])
+            
+            # Once it's committed, the next run indexes it.
+            mock = MockModel(author='daniel999')
+            mock.pk = 999
+            mock.save()
+            self.assertEqual(process_queue(self.queue, site=site), (2, 1, 0))
+            self.assertEqual(index.backend.docs.keys(), [u'core.mockmodel.999'])
+            self.assertEqual(len(self.queue), 0)
+            
+            # Still missing after the grace period, so it was rolled back
+            # (or deleted since) and gets removed.
+            self.queue.enqueue(MockModel, 998)
+            self.assertEqual(process_queue(self.queue, site=site), (1, 0, 0))
+            self.assertEqual(process_queue(self.queue, site=site, grace_period=0), (1, 0, 1))
+            self.assertEqual(index.backend.removed, [u'core.mockmodel.998'])
+            self.assertEqual(len(self.queue), 0)
+        finally:
+            site.unregister(MockModel)
+    
+    def test_failures_leave_the_queue(self):
+        class FailingMockSearchBackend(RecordingMockSearchBackend):
+            def update(self, index, iterable, commit=True):
+                raise IOError("The search engine is down.")
+        
+        site = SearchSite()
+        site.register(MockModel, QueuedMockSearchIndex)
+        site.get_index(MockModel).backend = FailingMockSearchBackend()
+        
+        try:
+            self.queue.enqueue(MockModel, 1)
+            self.assertRaises(IOError, process_queue, self.queue, site=site)
+            self.assertEqual(len(self.queue), 1)
+        finally:
+            site.unregister(MockModel)
@@ -1,5 +1,13 @@
+import BaseHTTPServer
+import os
+import socket
+import SocketServer
+import threading
+import time
 from django.test import TestCase
 from haystack.utils import get_identifier, Highlighter
+from haystack.utils.pipeline import IndexingPipeline
+from haystack.utils.pool import ConnectionPool, get_pool
 from core.models import MockModel
 
 
@@ -19,6 +27,186 @@ class GetIdentifierTestCase(TestCase):
         self.assertEqual(get_identifier(mock), 'core.mockmodel.1')
 
 
+class IndexingPipelineTestCase(TestCase):
+    def test_run(self):
+        written = []
+        pipeline = IndexingPipeline(lambda objs: [obj * 2 for obj in objs], written.append, prepare_workers=3, write_workers=2, chunk_size=4, queue_size=1)
+        pipeline.run(xrange(25))
+        self.assertEqual(sorted([len(docs) for docs in written]), [1, 4, 4, 4, 4, 4, 4])
+        self.assertEqual(sorted(sum(written, [])), range(0, 50, 2))
+        
+        # Nothing to do.
+        written = []
+        pipeline.run([])
+        self.assertEqual(written, [])
+    
+    def test_run_errors(self):
+        def prepare(objs):
+            if 7 in objs:
+                raise ValueError("Bad object.")
+            
+            return objs
+        
+        written = []
+        pipeline = IndexingPipeline(prepare, written.append, prepare_workers=2, chunk_size=2, queue_size=1)
+        self.assertRaises(ValueError, pipeline.run, xrange(100))
+        self.assert_(len(written) < 50)
+        
+        def write(docs):
+            raise IOError("Connection refused.")
+        
+        pipeline = IndexingPipeline(lambda objs: objs, write)
+        self.assertRaises(IOError, pipeline.run, xrange(10))
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    # The paths of the POSTs received, in order.
+    posts = []
+    
+    def do_GET(self):
+        body = 'port %d' % self.client_address[1]
+        status = 200
+        
+        if self.path == '/missing/':
+            status = 404
+        
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        
+        if self.path == '/close/':
+            self.send_header('Connection', 'close')
+        
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.posts.append(self.path)
+        
+        if self.path == '/slow/':
+            time.sleep(0.5)
+        
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+    
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Each keep-alive connection needs its own thread.
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        # Clients that give up on a response (see ``test_timeout``) are
+        # expected, so don't print their broken pipes.
+        pass
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/solr' % self.server.server_address[1]
+        self.pool = ConnectionPool('http', '127.0.0.1', self.server.server_address[1], max_size=2)
+    
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        super(ConnectionPoolTestCase, self).tearDown()
+    
+    def test_reuse(self):
+        status, headers, body = self.pool.request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.pool), 1)
+        
+        # The same connection (so the same client port) gets used again.
+        self.assertEqual(self.pool.request('GET', '/')[2], body)
+        status, headers, missing_body = self.pool.request('GET', '/missing/')
+        self.assertEqual((status, headers['content-length'], missing_body), (404, str(len(body)), body))
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 2))
+        
+        # Connections the server closes don't go back in the pool.
+        self.assertEqual(self.pool.request('GET', '/close/')[2], body)
+        self.assertEqual(len(self.pool), 0)
+        self.assertNotEqual(self.pool.request('GET', '/')[2], body)
+        self.assertEqual(self.pool.created, 2)
+    
+    def test_max_size(self):
+        conns = [self.pool.get()[0] for i in range(3)]
+        
+        for conn in conns:
+            self.pool.put(conn)
+        
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(conns[2].sock, None)
+    
+    def test_stale_connections(self):
+        body = self.pool.request('GET', '/')[2]
+        
+        # Too long idle.
+        self.pool.idle_timeout = -1
+        self.assertNotEqual(self.pool.request('GET', '/')[2], body)
+        self.assertEqual(self.pool.created, 2)
+        
+        # Closed by the server.
+        self.pool.idle_timeout = 30
+        conn = self.pool.get()[0]
+        conn.sock.shutdown(socket.SHUT_RD)
+        self.pool.put(conn)
+        self.assertEqual(self.pool.request('GET', '/')[0], 200)
+        self.assertEqual(self.pool.created, 3)
+    
+    def test_timeout(self):
+        del KeepAliveHandler.posts[:]
+        self.pool.timeout = 0.2
+        self.pool.request('POST', '/', 'a=1')
+        
+        # A reused connection timing out waiting on the response isn't
+        # stale, so the write isn't sent again.
+        self.assertRaises(socket.timeout, self.pool.request, 'POST', '/slow/', 'a=2')
+        self.assertEqual(KeepAliveHandler.posts, ['/', '/slow/'])
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 1))
+        self.assertEqual(len(self.pool), 0)
+    
+    def test_get_pool(self):
+        pool = get_pool(self.url, max_size=5)
+        self.assert_(get_pool(self.url.replace('/solr', '/other')) is pool)
+        self.assertEqual(pool.max_size, 5)
+        self.assertEqual(pool.port, self.server.server_address[1])
+        self.assert_(get_pool('http://localhost:8983/solr') is not pool)
+        
+        # A forked child gets a pool of its own.
+        old_getpid = os.getpid
+        os.getpid = lambda: -1
+        
+        try:
+            self.assert_(get_pool(self.url) is not pool)
+        finally:
+            os.getpid = old_getpid
+        
+        self.assert_(get_pool(self.url) is pool)
+    
+    def test_fork(self):
+        body = self.pool.request('GET', '/')[2]
+        self.assertEqual(len(self.pool), 1)
+        
+        # Connections inherited from the parent process aren't reused.
+        self.pool._pid = -1
+        self.assertNotEqual(self.pool.request('GET', '/')[2], body)
+        self.assertEqual(self.pool._pid, os.getpid())
+        self.assertEqual((self.pool.created, self.pool.reused), (2, 0))
+        self.assertEqual(len(self.pool), 1)
+
+
 class HighlighterTestCase(TestCase):
     def setUp(self):
         super(HighlighterTestCase, self).setUp()
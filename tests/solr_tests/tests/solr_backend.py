@@ -1,12 +1,16 @@
 import datetime
 import logging
+import os
 import pysolr
+import shutil
 import StringIO
+import tempfile
+import time
 from django.conf import settings
 from django.test import TestCase
 from haystack import backends
 from haystack import indexes
-from haystack.backends.solr_backend import SearchBackend, SearchQuery
+from haystack.backends.solr_backend import PooledSolr, SearchBackend, SearchQuery
 from haystack.exceptions import HaystackError
 from haystack.query import SearchQuerySet, RelatedSearchQuerySet, SQ
 from haystack.sites import SearchSite
@@ -35,6 +39,10 @@ class SolrMaintainTypeMockSearchIndex(indexes.RealTimeSearchIndex):
         return "%02d" % obj.pub_date.month
 
 
+class SolrQueueMockSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, model_attr='author')
+
+
 class SolrSearchBackendTestCase(TestCase):
     def setUp(self):
         super(SolrSearchBackendTestCase, self).setUp()
@@ -75,6 +83,32 @@ class SolrSearchBackendTestCase(TestCase):
         self.assertEqual(self.raw_solr.search('*:*').hits, 3)
         self.assertEqual(self.raw_solr.search('*:*').docs, [{'django_id': 1, 'name': 'daniel1', 'text': 'Indexed!\n1', 'id': 'core.mockmodel.1', 'django_ct': 'core.mockmodel', 'tag0_0_0name': 'tag1', 'hello0_0_0funcd0_0_0world': 'Hello World!', 'pub_date': '2009-02-24T00:00:00Z', 'hello': 'World!'}, {'django_id': 2, 'name': 'daniel2', 'text': 'Indexed!\n2', 'id': 'core.mockmodel.2', 'django_ct': 'core.mockmodel', 'tag0_0_0name': 'tag2', 'hello0_0_0funcd0_0_0world': 'Hello World!', 'pub_date': '2009-02-23T00:00:00Z', 'hello': 'World!'}, {'django_id': 3, 'name': 'daniel3', 'text': 'Indexed!\n3', 'id': 'core.mockmodel.3', 'django_ct': 'core.mockmodel', 'tag0_0_0name': 'tag3', 'hello0_0_0funcd0_0_0world': 'Hello World!', 'pub_date': '2009-02-22T00:00:00Z', 'hello': 'World!'}])
     
+    def test_update_batches(self):
+        fetched = []
+        
+        def batches():
+            for obj in self.sample_objs:
+                fetched.append(obj.pk)
+                yield [obj]
+        
+        self.sb.update_batches(self.smmi, batches())
+        self.assertEqual(fetched, [1, 2, 3])
+        self.assertEqual(self.raw_solr.search('*:*').hits, 3)
+        
+        old_workers = getattr(settings, 'HAYSTACK_PIPELINE_PREPARE_WORKERS', 0)
+        settings.HAYSTACK_PIPELINE_PREPARE_WORKERS = 2
+        
+        try:
+            self.sb.clear()
+            fetched = []
+            
+            # One pipeline pulls all of the batches.
+            self.sb.update_batches(self.smmi, batches())
+            self.assertEqual(fetched, [1, 2, 3])
+            self.assertEqual(sorted([doc['id'] for doc in self.raw_solr.search('*:*').docs]), ['core.mockmodel.1', 'core.mockmodel.2', 'core.mockmodel.3'])
+        finally:
+            settings.HAYSTACK_PIPELINE_PREPARE_WORKERS = old_workers
+    
     def test_remove(self):
         self.sb.update(self.smmi, self.sample_objs)
         self.assertEqual(self.raw_solr.search('*:*').hits, 3)
@@ -83,6 +117,14 @@ class SolrSearchBackendTestCase(TestCase):
         self.assertEqual(self.raw_solr.search('*:*').hits, 2)
         self.assertEqual(self.raw_solr.search('*:*').docs, [{'django_id': 2, 'name': 'daniel2', 'text': 'Indexed!\n2', 'id': 'core.mockmodel.2', 'django_ct': 'core.mockmodel', 'tag0_0_0name': 'tag2', 'hello0_0_0funcd0_0_0world': 'Hello World!', 'pub_date': '2009-02-23T00:00:00Z', 'hello': 'World!'}, {'django_id': 3, 'name': 'daniel3', 'text': 'Indexed!\n3', 'id': 'core.mockmodel.3', 'django_ct': 'core.mockmodel', 'tag0_0_0name': 'tag3', 'hello0_0_0funcd0_0_0world': 'Hello World!', 'pub_date': '2009-02-22T00:00:00Z', 'hello': 'World!'}])
     
+    def test_remove_many(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        self.assertEqual(self.raw_solr.search('*:*').hits, 3)
+        
+        self.sb.remove_many([self.sample_objs[0], 'core.mockmodel.3', 'core.mockmodel.999'])
+        self.assertEqual(self.raw_solr.search('*:*').hits, 1)
+        self.assertEqual([doc['id'] for doc in self.raw_solr.search('*:*').docs], ['core.mockmodel.2'])
+    
     def test_clear(self):
         self.sb.update(self.smmi, self.sample_objs)
         self.assertEqual(self.raw_solr.search('*:*').hits, 3)
@@ -105,6 +147,49 @@ class SolrSearchBackendTestCase(TestCase):
         self.sb.clear([AnotherMockModel, MockModel])
         self.assertEqual(self.raw_solr.search('*:*').hits, 0)
     
+    def test_commit_policy(self):
+        old_policy = getattr(settings, 'HAYSTACK_COMMIT_POLICY', 'immediate')
+        old_within = getattr(settings, 'HAYSTACK_COMMIT_WITHIN', 1000)
+        
+        try:
+            settings.HAYSTACK_COMMIT_POLICY = 'none'
+            self.sb.update(self.smmi, self.sample_objs, commit=self.sb.should_commit())
+            self.assertEqual(self.raw_solr.search('*:*').hits, 0)
+            self.sb.commit()
+            self.assertEqual(self.raw_solr.search('*:*').hits, 3)
+            
+            settings.HAYSTACK_COMMIT_POLICY = 'within'
+            settings.HAYSTACK_COMMIT_WITHIN = 100
+            self.sb.remove(self.sample_objs[0])
+            self.sb.update(self.smmi, self.sample_objs[:1])
+            time.sleep(1)
+            self.assertEqual(self.raw_solr.search('*:*').hits, 3)
+        finally:
+            settings.HAYSTACK_COMMIT_POLICY = old_policy
+            settings.HAYSTACK_COMMIT_WITHIN = old_within
+    
+    def test_count(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        self.assertEqual(self.raw_solr.search('*:*').hits, 3)
+        
+        self.assertEqual(self.sb.count(''), 0)
+        self.assertEqual(self.sb.count('*:*'), 3)
+        self.assertEqual(self.sb.count('Index'), 3)
+        self.assertEqual(self.sb.count('Indx'), 0)
+        self.assertEqual(self.sb.count('Index', narrow_queries=set(['name:daniel1'])), 1)
+    
+    def test_connection_pool(self):
+        self.assert_(isinstance(self.sb.conn, PooledSolr))
+        
+        # Every backend shares the connections.
+        self.assert_(SearchBackend().conn.pool is self.sb.conn.pool)
+        
+        self.sb.update(self.smmi, self.sample_objs)
+        created = self.sb.conn.pool.created
+        self.assertEqual(self.sb.count('*:*'), 3)
+        self.assertEqual(self.sb.search('*:*')['hits'], 3)
+        self.assertEqual(self.sb.conn.pool.created, created)
+    
     def test_search(self):
         self.sb.update(self.smmi, self.sample_objs)
         self.assertEqual(self.raw_solr.search('*:*').hits, 3)
@@ -245,6 +330,90 @@ class FailedSolrSearchBackendTestCase(TestCase):
         settings.HAYSTACK_SOLR_URL = old_solr_url
         logging.getLogger('haystack').removeHandler(cap)
         logging.getLogger('haystack').addHandler(haystack.stream)
+    
+    def test_queue_failures(self):
+        from haystack.update_queue import UpdateQueue, DELETE, process_queue
+        tmpdir = tempfile.mkdtemp()
+        queue = UpdateQueue(os.path.join(tmpdir, 'updates.db'))
+        
+        # Stow.
+        old_solr_url = settings.HAYSTACK_SOLR_URL
+        settings.HAYSTACK_SOLR_URL = "%s/foo/" % settings.HAYSTACK_SOLR_URL
+        import haystack
+        logging.getLogger('haystack').removeHandler(haystack.stream)
+        
+        try:
+            site = SearchSite()
+            site.register(MockModel, SolrQueueMockSearchIndex)
+            site.get_index(MockModel).backend = SearchBackend(site=site)
+            
+            # The backend only logs failed writes, unless the queue is
+            # applying them. Then they leave the entries queued.
+            queue.enqueue(MockModel, 1)
+            self.assertRaises(pysolr.SolrError, process_queue, queue, site=site)
+            self.assertEqual(len(queue), 1)
+            
+            queue.clear()
+            queue.enqueue(MockModel, 999, DELETE)
+            self.assertRaises(pysolr.SolrError, process_queue, queue, site=site)
+            self.assertEqual(len(queue), 1)
+            
+            self.assertEqual(backends.get_fail_silently(), True)
+            site.get_index(MockModel).backend.update(site.get_index(MockModel), MockModel.objects.all())
+        finally:
+            # Restore.
+            settings.HAYSTACK_SOLR_URL = old_solr_url
+            logging.getLogger('haystack').addHandler(haystack.stream)
+            shutil.rmtree(tmpdir)
+    
+    def test_pipeline_failures(self):
+        sample_objs = []
+        
+        for i in xrange(1, 6):
+            mock = MockModel()
+            mock.id = i
+            mock.author = 'daniel%s' % i
+            mock.pub_date = datetime.date(2009, 2, 25) - datetime.timedelta(days=i)
+            mock.tag = MockTag(name='tag%s' % i)
+            sample_objs.append(mock)
+        
+        # Stow.
+        old_solr_url = settings.HAYSTACK_SOLR_URL
+        settings.HAYSTACK_SOLR_URL = "%s/foo/" % settings.HAYSTACK_SOLR_URL
+        old_chunk_size = getattr(settings, 'HAYSTACK_PIPELINE_CHUNK_SIZE', 100)
+        settings.HAYSTACK_PIPELINE_CHUNK_SIZE = 2
+        cap = CaptureHandler()
+        CaptureHandler.logs_seen = []
+        logging.getLogger('haystack').addHandler(cap)
+        import haystack
+        logging.getLogger('haystack').removeHandler(haystack.stream)
+        
+        try:
+            site = SearchSite()
+            site.register(MockModel, SolrMockSearchIndex)
+            sb = SearchBackend(site=site)
+            smmi = SolrMockSearchIndex(MockModel, backend=sb)
+            
+            # Failed chunks are logged (naming the documents involved) and
+            # the rest are still written.
+            sb.update_pipelined(smmi, sample_objs)
+            self.assertEqual(len(CaptureHandler.logs_seen), 3)
+            self.assert_("'core.mockmodel.1' to 'core.mockmodel.2'" in CaptureHandler.logs_seen[0].getMessage())
+            
+            # Unless failing silently is off, in which case the first error
+            # stops the pipeline & is raised.
+            old_fail_silently = backends.set_fail_silently(False)
+            
+            try:
+                self.assertRaises(pysolr.SolrError, sb.update_pipelined, smmi, sample_objs)
+            finally:
+                backends.set_fail_silently(old_fail_silently)
+        finally:
+            # Restore.
+            settings.HAYSTACK_SOLR_URL = old_solr_url
+            settings.HAYSTACK_PIPELINE_CHUNK_SIZE = old_chunk_size
+            logging.getLogger('haystack').removeHandler(cap)
+            logging.getLogger('haystack').addHandler(haystack.stream)
 
 
 class LiveSolrSearchQueryTestCase(TestCase):
@@ -346,7 +515,7 @@ class LiveSolrSearchQuerySetTestCase(TestCase):
         sqs = self.sqs.all()
         results = [int(result.pk) for result in sqs]
         self.assertEqual(results, range(1, 24))
-        self.assertEqual(len(backends.queries), 3)
+        self.assertEqual(len(backends.queries), 2)
     
     def test_slice(self):
         backends.reset_search_queries()
@@ -368,6 +537,24 @@ class LiveSolrSearchQuerySetTestCase(TestCase):
         self.assertEqual(len(backends.queries), 0)
         results = [int(result.pk) for result in results._manual_iter()]
         self.assertEqual(results, range(1, 24))
+        self.assertEqual(len(backends.queries), 2)
+    
+    def test_values(self):
+        backends.reset_search_queries()
+        self.assertEqual(len(backends.queries), 0)
+        results = self.sqs.all().values_list('id', flat=True)
+        self.assertEqual(results[:3], [u'core.mockmodel.1', u'core.mockmodel.2', u'core.mockmodel.3'])
+        self.assertEqual(backends.queries[0]['additional_kwargs']['fields'], ['id'])
+        
+        results = self.sqs.all().values('id')
+        self.assertEqual(results[0], {'id': u'core.mockmodel.1'})
+    
+    def test_scan(self):
+        backends.reset_search_queries()
+        self.assertEqual(len(backends.queries), 0)
+        results = [int(result.pk) for result in self.sqs.all().scan(page_size=10)]
+        # Ordered by ``id``, which is a string.
+        self.assertEqual(results, sorted(range(1, 24), key=str))
         self.assertEqual(len(backends.queries), 3)
     
     def test_fill_cache(self):
@@ -390,7 +577,7 @@ class LiveSolrSearchQuerySetTestCase(TestCase):
         results = self.sqs.all()
         fire_the_iterator_and_fill_cache = [result for result in results]
         self.assertEqual(results._cache_is_full(), True)
-        self.assertEqual(len(backends.queries), 3)
+        self.assertEqual(len(backends.queries), 2)
     
     def test___and__(self):
         sqs1 = self.sqs.filter(content='foo')
@@ -510,6 +697,11 @@ class LiveSolrRegressionsTestCase(TestCase):
         for pk in page_2:
             if pk in page_1:
                 self.fail("Result with id '%s' seen more than once in the results." % pk)
+    
+    def test_raw_search_narrow_count(self):
+        sqs = self.sqs.raw_search('*:*').narrow('django_id:(1 OR 2 OR 3)')
+        self.assertEqual(sqs.count(), 3)
+        self.assertEqual(len(list(sqs)), 3)
 
 
 class LiveSolrMoreLikeThisTestCase(TestCase):
@@ -4,11 +4,13 @@ import shutil
 from whoosh.fields import TEXT, ID, KEYWORD, STORED
 from whoosh.qparser import QueryParser
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.datetime_safe import datetime, date
 from django.test import TestCase
 from haystack import backends
 from haystack import indexes
 from haystack.backends.whoosh_backend import SearchBackend, SearchQuery
+from haystack.models import DeferredValue
 from haystack.query import SearchQuerySet, SQ
 from haystack.sites import SearchSite
 from core.models import MockModel, AnotherMockModel
@@ -107,6 +109,45 @@ class WhooshSearchBackendTestCase(TestCase):
         self.assertEqual(len(self.whoosh_search(u'*')), 22)
         self.assertEqual([dict(doc)['id'] for doc in self.whoosh_search(u'*')], [u'core.mockmodel.23', u'core.mockmodel.22', u'core.mockmodel.21', u'core.mockmodel.20', u'core.mockmodel.19', u'core.mockmodel.18', u'core.mockmodel.17', u'core.mockmodel.16', u'core.mockmodel.15', u'core.mockmodel.14', u'core.mockmodel.13', u'core.mockmodel.12', u'core.mockmodel.11', u'core.mockmodel.10', u'core.mockmodel.9', u'core.mockmodel.8', u'core.mockmodel.7', u'core.mockmodel.6', u'core.mockmodel.5', u'core.mockmodel.4', u'core.mockmodel.3', u'core.mockmodel.2'])
     
+    def test_remove_many(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        self.assertEqual(self.sb.search(u'*')['hits'], 23)
+        
+        self.sb.remove_many(self.sample_objs[:10] + [u'core.mockmodel.20', u'core.mockmodel.999'])
+        self.assertEqual(self.sb.search(u'*')['hits'], 12)
+        self.assertEqual(sorted([result.pk for result in self.sb.search(u'*', end_offset=100)['results']]), [u'11', u'12', u'13', u'14', u'15', u'16', u'17', u'18', u'19', u'21', u'22', u'23'])
+    
+    def test_session(self):
+        self.sb.update(self.smmi, self.sample_objs[:10])
+        
+        self.sb.start_session()
+        self.sb.update(self.smmi, self.sample_objs[10:15])
+        self.sb.update(self.smmi, self.sample_objs[15:])
+        
+        # Nested sessions share the writer.
+        self.sb.start_session()
+        self.sb.remove_many([self.sample_objs[0]])
+        self.sb.end_session()
+        
+        # Nothing's committed until the session ends.
+        self.assertEqual(self.sb.search(u'*')['hits'], 10)
+        self.sb.end_session(merge='optimize')
+        self.assertEqual(self.sb.search(u'*')['hits'], 22)
+        
+        self.sb.start_session()
+        self.sb.remove(self.sample_objs[1])
+        self.sb.cancel_session()
+        self.assertEqual(self.sb.search(u'*')['hits'], 22)
+        
+        # Outside a session, writes commit as usual.
+        self.sb.remove(self.sample_objs[1])
+        self.assertEqual(self.sb.search(u'*')['hits'], 21)
+        
+        self.sb.start_session()
+        self.assertRaises(ImproperlyConfigured, self.sb.end_session, merge='sometimes')
+        self.sb.update(self.smmi, self.sample_objs[:1])
+        self.assertEqual(self.sb.search(u'*')['hits'], 22)
+    
     def test_clear(self):
         self.sb.update(self.smmi, self.sample_objs)
         self.assertEqual(len(self.whoosh_search(u'*')), 23)
@@ -179,6 +220,44 @@ class WhooshSearchBackendTestCase(TestCase):
         # results = self.sb.search('Index*', narrow_queries=set(['name:daniel1']))
         # self.assertEqual(results['hits'], 1)
     
+    def test_count(self):
+        self.assertEqual(self.sb.count(u'*'), 0)
+        self.sb.update(self.smmi, self.sample_objs)
+        
+        self.assertEqual(self.sb.count(u''), 0)
+        self.assertEqual(self.sb.count(u'a'), 0)
+        self.assertEqual(self.sb.count(u'*'), 23)
+        self.assertEqual(self.sb.count(u'index*'), 23)
+        self.assertEqual(self.sb.count(u'Indx'), 0)
+        self.assertEqual(self.sb.count(u'index*', narrow_queries=set([u'name:daniel1'])), self.sb.search(u'index*', narrow_queries=set([u'name:daniel1']))['hits'])
+        
+        # The searcher gets closed, rather than leaking its files.
+        from whoosh.searching import Searcher
+        closed = []
+        old_close = Searcher.close
+        
+        def close(searcher):
+            closed.append(searcher)
+            return old_close(searcher)
+        
+        Searcher.close = close
+        
+        try:
+            self.assertEqual(self.sb.count(u'index*'), 23)
+        finally:
+            Searcher.close = old_close
+        
+        self.assert_(closed)
+    
+    def test_deferred_conversion(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        result = self.sb.search(u'name:daniel3')['results'][0]
+        
+        # Stored fields are only converted once they're read.
+        self.assert_(isinstance(result.__dict__['pub_date'], DeferredValue))
+        self.assertEqual(result.pub_date, date(2009, 7, 17))
+        self.assertEqual(result.__dict__['pub_date'], date(2009, 7, 17))
+    
     def test_more_like_this(self):
         self.sb.update(self.smmi, self.sample_objs)
         self.assertEqual(len(self.whoosh_search(u'*')), 23)
@@ -541,6 +620,79 @@ class LiveWhooshSearchQuerySetTestCase(TestCase):
         self.assertEqual(len(backends.queries), 1)
 
 
+    def test_values(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        
+        results = self.sqs.auto_query('Indexed!').only('name')
+        self.assertEqual([result.name for result in results], [u'daniel3', u'daniel2', u'daniel1'])
+        self.assertEqual(['pub_date' in result.get_additional_fields() for result in results], [False, False, False])
+        
+        results = self.sqs.auto_query('Indexed!').values('name', 'pub_date')
+        self.assertEqual(results[0], {'name': u'daniel3', 'pub_date': date(2009, 2, 22)})
+        
+        results = self.sqs.auto_query('Indexed!').values_list('name', flat=True)
+        self.assertEqual(list(results), [u'daniel3', u'daniel2', u'daniel1'])
+    
+    def test_scan(self):
+        self.sb.update(self.smmi, self.sample_objs)
+        
+        backends.reset_search_queries()
+        self.assertEqual(len(backends.queries), 0)
+        results = [int(result.pk) for result in self.sqs.auto_query('Indexed!').scan(page_size=2)]
+        self.assertEqual(results, [1, 2, 3])
+        self.assertEqual(len(backends.queries), 2)
+        
+        results = [int(result.pk) for result in self.sqs.auto_query('Indexed!').order_by('pub_date').scan(page_size=1)]
+        self.assertEqual(results, [3, 2, 1])
+        
+        results = [int(result.pk) for result in self.sqs.auto_query('Indexed!').order_by('-pub_date').scan(page_size=2)]
+        self.assertEqual(results, [1, 2, 3])
+    
+    def test_prune_index(self):
+        from django.core.management import call_command
+        from haystack.management.commands.prune_index import find_stale
+        stale_objs = []
+        
+        for i in (4, 12):
+            mock = MockModel()
+            mock.id = i
+            mock.author = 'daniel%s' % i
+            mock.pub_date = date(2009, 2, 25)
+            stale_objs.append(mock)
+        
+        self.sb.update(self.smmi, self.sample_objs + stale_objs)
+        self.assertEqual(self.sqs.count(), 5)
+        
+        # Only MockModels 1-3 are in the database.
+        self.assertEqual(list(find_stale(self.site, MockModel, 2)), [[u'core.mockmodel.12'], [u'core.mockmodel.4']])
+        
+        self.site.get_index(MockModel).backend = self.sb
+        call_command('prune_index', dry_run=True, verbosity=0)
+        self.assertEqual(self.sqs.count(), 5)
+        
+        call_command('prune_index', batchsize=2, verbosity=0)
+        self.assertEqual(sorted([int(result.pk) for result in self.sqs.all()]), [1, 2, 3])
+        
+        # Another site's documents are scanned through its index's backend.
+        self.sb.update(self.smmi, stale_objs)
+        other_site = SearchSite()
+        other_site.register(MockModel, WhooshMockSearchIndex)
+        other_sb = SearchBackend(site=other_site)
+        other_site.get_index(MockModel).backend = other_sb
+        searches = []
+        other_search = other_sb.search
+        other_sb.search = lambda query_string, **kwargs: searches.append(query_string) or other_search(query_string, **kwargs)
+        self.assertEqual(list(find_stale(other_site, MockModel, 2)), [[u'core.mockmodel.12'], [u'core.mockmodel.4']])
+        self.assert_(len(searches) > 0)
+    
+    def test_update_index_workers(self):
+        from django.core.management.base import CommandError
+        from haystack.management.commands.update_index import Command
+        
+        # Whoosh only allows one writer at a time.
+        self.assertRaises(CommandError, Command().handle, workers=2, verbosity=0)
+
+
 class WhooshRoundTripSearchIndex(indexes.SearchIndex):
     text = indexes.CharField(document=True, default='')
     name = indexes.CharField()